@@ -0,0 +1,55 @@
+"""Renders the same synthetic script with the MoviePy and ffmpeg engines and reports wall time and CPU time.
+
+Run from the repository root:
+    python benchmarks/bench_render_engines.py --seconds 30 60
+"""
+import argparse
+import glob
+import os
+import resource
+import tempfile
+import time
+
+from synthetic import available_videos, make_synthetic_audio, synthetic_sentences
+
+from common.video_creation import create_video, INPUTS_DIR
+
+
+def cpu_seconds():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def run_engine(engine, seconds, work_dir, disclaimer_video_path):
+    sentences = synthetic_sentences(seconds, video_names=available_videos())
+    audio_path = make_synthetic_audio(os.path.join(work_dir, 'audio.mp3'), seconds)
+    video_path = os.path.join(work_dir, f'{engine}_{seconds}.mp4')
+    shorts_path = os.path.join(work_dir, f'{engine}_{seconds}_shorts.mp4')
+    wall_start, cpu_start = time.perf_counter(), cpu_seconds()
+    create_video(audio_path=audio_path, video_path=video_path, sentences_list_with_timings=sentences,
+                 background_videos=glob.glob(os.path.join(INPUTS_DIR, "*.mp4")),
+                 disclaimer_video_path=disclaimer_video_path,
+                 youtube_shorts_video_path=shorts_path, engine=engine)
+    return time.perf_counter() - wall_start, cpu_seconds() - cpu_start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seconds', type=int, nargs='+', default=[30])
+    parser.add_argument('--engines', default='moviepy,ffmpeg')
+    parser.add_argument('--disclaimer', default=os.path.join(INPUTS_DIR, '..', 'results', 'disclaimer_video.mp4'))
+    args = parser.parse_args()
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        for seconds in args.seconds:
+            for engine in args.engines.split(','):
+                wall, cpu = run_engine(engine, seconds, work_dir, args.disclaimer)
+                results.append((engine, seconds, wall, cpu))
+    print(f"{'engine':8s} {'script':>7s} {'wall':>8s} {'cpu':>8s} {'wall/s':>7s} {'cpu/s':>7s}")
+    for engine, seconds, wall, cpu in results:
+        print(f"{engine:8s} {seconds:6d}s {wall:7.1f}s {cpu:7.1f}s {wall / seconds:7.2f} {cpu / seconds:7.2f}")
+
+
+if __name__ == '__main__':
+    main()
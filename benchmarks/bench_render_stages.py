@@ -0,0 +1,93 @@
+"""Renders synthetic scripts of several lengths through create_video for each engine and encoder profile, and
+reports per-stage timings, output FPS and, optionally, SSIM against a reference profile.
+
+Run from the repository root:
+    python benchmarks/bench_render_stages.py --seconds 30 60 120 --engines ffmpeg --profiles fast,balanced,quality \
+        --ssim-reference quality --json bench_output.json
+"""
+import argparse
+import glob
+import json
+import os
+import re
+import subprocess
+import tempfile
+import time
+
+import ffmpeg
+from synthetic import available_videos, make_synthetic_audio, synthetic_sentences
+
+from common.utils.consts import VIDEO_FPS
+from common.video_creation import INPUTS_DIR, create_video
+
+STAGES = ['background', 'text_clips', 'composite', 'encode', 'join', 'shorts', 'disclaimer']
+
+
+def output_frames(video_path):
+    return int(round(float(ffmpeg.probe(video_path)['format']['duration']) * VIDEO_FPS))
+
+
+def ssim(video_path, reference_path):
+    result = subprocess.run(['ffmpeg', '-hide_banner', '-i', video_path, '-i', reference_path,
+                             '-lavfi', '[0:v][1:v]ssim', '-f', 'null', '-'], capture_output=True, text=True)
+    match = re.search(r"All:([\d.]+)", result.stderr)
+    return float(match.group(1)) if match else None
+
+
+def run(engine, profile, seconds, work_dir, disclaimer_video_path):
+    sentences = synthetic_sentences(seconds, video_names=available_videos())
+    audio_path = make_synthetic_audio(os.path.join(work_dir, f'audio_{seconds}.mp3'), seconds)
+    video_path = os.path.join(work_dir, f'{engine}_{profile}_{seconds}.mp4')
+    shorts_path = os.path.join(work_dir, f'{engine}_{profile}_{seconds}_shorts.mp4')
+    start = time.perf_counter()
+    timer = create_video(audio_path=audio_path, video_path=video_path, sentences_list_with_timings=sentences,
+                         background_videos=glob.glob(os.path.join(INPUTS_DIR, "*.mp4")),
+                         disclaimer_video_path=disclaimer_video_path, youtube_shorts_video_path=shorts_path,
+                         engine=engine, encoder_profile=profile)
+    wall = time.perf_counter() - start
+    frames = output_frames(video_path)
+    return {
+        "engine": engine, "profile": profile, "seconds": seconds, "wall": wall, "frames": frames,
+        "fps": frames / wall, "stages": timer.timings, "video_path": video_path,
+        "bytes": os.path.getsize(video_path),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seconds', type=int, nargs='+', default=[30, 60])
+    parser.add_argument('--engines', default='ffmpeg')
+    parser.add_argument('--profiles', default='fast,balanced')
+    parser.add_argument('--ssim-reference', help="profile whose output every other profile is compared with")
+    parser.add_argument('--disclaimer', default=os.path.join(INPUTS_DIR, '..', 'results', 'disclaimer_video.mp4'))
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args()
+    profiles = args.profiles.split(',')
+    if args.ssim_reference and args.ssim_reference not in profiles:
+        profiles.insert(0, args.ssim_reference)
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        for seconds in args.seconds:
+            for engine in args.engines.split(','):
+                runs = {profile: run(engine, profile, seconds, work_dir, args.disclaimer) for profile in profiles}
+                for profile, result in runs.items():
+                    if args.ssim_reference:
+                        result["ssim"] = ssim(result["video_path"], runs[args.ssim_reference]["video_path"])
+                    results.append(result)
+
+    print(f"{'engine':9s} {'profile':9s} {'script':>6s} {'wall':>7s} {'fps':>6s} {'MB':>6s} {'ssim':>6s}  " +
+          " ".join(f"{stage:>10s}" for stage in STAGES))
+    for result in results:
+        quality = f"{result['ssim']:.4f}" if result.get('ssim') is not None else '-'
+        stages = " ".join(f"{result['stages'][stage]:9.1f}s" if stage in result['stages'] else f"{'-':>10s}"
+                          for stage in STAGES)
+        print(f"{result['engine']:9s} {result['profile']:9s} {result['seconds']:5d}s {result['wall']:6.1f}s "
+              f"{result['fps']:6.1f} {result['bytes'] / 1e6:6.1f} {quality:>6s}  {stages}")
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump([{key: value for key, value in result.items() if key != 'video_path'} for result in results],
+                      file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+"""Compares word caption clip generation: cached PIL rasters vs. per-word ImageMagick TextClips.
+
+Run from the repository root:
+    python benchmarks/bench_word_clips.py --seconds 60
+"""
+import argparse
+import time
+
+from synthetic import synthetic_sentences
+
+from common.video_creation import generate_text_clips
+
+
+def time_renderer(sentences, renderer):
+    start = time.perf_counter()
+    clips = generate_text_clips(sentences, renderer=renderer)
+    # force the ImageClip/TextClip frames to exist, as the compositor would
+    for clip in clips:
+        clip.get_frame(0)
+    elapsed = time.perf_counter() - start
+    for clip in clips:
+        clip.close()
+    return elapsed, len(clips)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seconds', type=int, default=60)
+    parser.add_argument('--renderers', default='raster,imagemagick')
+    args = parser.parse_args()
+    sentences = synthetic_sentences(args.seconds)
+    for renderer in args.renderers.split(','):
+        try:
+            elapsed, count = time_renderer(sentences, renderer)
+        except Exception as e:
+            print(f"{renderer:12s} failed: {e}")
+            continue
+        print(f"{renderer:12s} {count} clips in {elapsed:.2f}s ({elapsed / count * 1000:.1f} ms/clip)")
+        if renderer == 'raster':
+            # second pass hits the in-process LRU, which is the steady state within a run
+            elapsed, count = time_renderer(sentences, renderer)
+            print(f"{'raster warm':12s} {count} clips in {elapsed:.2f}s ({elapsed / count * 1000:.1f} ms/clip)")
+
+
+if __name__ == '__main__':
+    main()
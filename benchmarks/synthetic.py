@@ -0,0 +1,39 @@
+import os
+import random
+import subprocess
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'dags'))
+
+WORDS = ("the stock NVIDIA shares premarket analysts expect revenue growth data center demand chips "
+         "investors market open today could rise fall percent guidance quarter earnings").split()
+
+
+def available_videos():
+    from common.video_creation import INPUTS_DIR
+    return sorted(name for name in os.listdir(INPUTS_DIR) if name.endswith('.mp4'))
+
+
+def synthetic_sentences(seconds, words_per_second=2.5, seed=0, video_names=None):
+    # speech-mark shaped timings, the same structure text_to_audio returns
+    rng = random.Random(seed)
+    video_names = video_names or [None]
+    sentences = []
+    time_ms = 0
+    while time_ms < seconds * 1000:
+        words = []
+        for _ in range(rng.randint(8, 18)):
+            duration = int(1000 / words_per_second)
+            words.append({"word": rng.choice(WORDS), "start": time_ms, "end": time_ms + duration})
+            time_ms += duration
+        sentences.append({"sentence": " ".join(w["word"] for w in words), "start": words[0]["start"],
+                          "end": time_ms, "words_in_sentence": words,
+                          "video_name": video_names[len(sentences) % len(video_names)]})
+    sentences[-1]["is_last_sentence"] = True
+    return sentences
+
+
+def make_synthetic_audio(audio_path, seconds):
+    subprocess.run(['ffmpeg', '-loglevel', 'error', '-y', '-f', 'lavfi', '-i', f'sine=frequency=220:duration={seconds}',
+                    '-ar', '22050', '-ac', '1', '-b:a', '48k', audio_path], check=True)
+    return audio_path
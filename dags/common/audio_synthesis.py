@@ -1,104 +1,254 @@
+import hashlib
 import os
-import boto3
+import re
 import json
-from pydub import AudioSegment
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 
+from common.utils.cache import DiskCache, make_key
+from common.utils.clients import get_boto3_client, rate_limiter
+from common.utils.metrics import in_stage_context, metrics
+
 load_dotenv()
 
+VOICE_ID = 'Gregory'
+ENGINE = 'neural'
+POLLY_MAX_CHARS = 3000  # Polly's per-request limit on billed characters
+POLLY_CONCURRENCY = int(os.getenv('POLLY_CONCURRENCY', 4))
+STREAM_CHUNK_SIZE = 64 * 1024
+TTS_CACHE_ENABLED = os.getenv('TTS_CACHE_ENABLED', 'true').lower() == 'true'
 
-def text_to_audio(
-        text,
-        audio_path="common/results/output_audio.mp3",
-        conn_id='aws_default'
-):
-    if os.environ.get("LOCAL"):
-        aws_access_key_id = os.getenv('AWS_ACCESS_KEY_ID')
-        aws_secret_access_key = os.getenv('AWS_SECRET_ACCESS_KEY')
-        region_name = os.getenv('AWS_REGION_NAME', 'us-east-1')
-    else:
-        from airflow.hooks.base_hook import BaseHook
-        conn = BaseHook.get_connection(conn_id)
-        extra = conn.extra_dejson or {}
-        aws_access_key_id = conn.login
-        aws_secret_access_key = conn.password
-        region_name = extra.get('region_name', 'us-east-1')
-
-    polly_client = boto3.Session(
-        aws_access_key_id=aws_access_key_id,
-        aws_secret_access_key=aws_secret_access_key,
-        region_name=region_name
-    ).client('polly')
+tts_cache = DiskCache('tts',
+                      max_bytes=int(os.getenv('TTS_CACHE_MAX_BYTES', 512 * 1024 * 1024)),
+                      ttl_seconds=int(os.getenv('TTS_CACHE_TTL_SECONDS', 7 * 24 * 3600)),
+                      use_s3=os.getenv('TTS_CACHE_S3', 'true').lower() == 'true')
+
+MP3_BITRATES = {  # kbps by (is_mpeg1, bitrate index) for Layer III
+    True: [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    False: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+MP3_SAMPLE_RATES = {3: [44100, 48000, 32000], 2: [22050, 24000, 16000], 0: [11025, 12000, 8000]}
+
+
+def skip_id3(data) -> int:
+    if data[:3] != b'ID3' or len(data) < 10:
+        return 0
+    size = (data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9]
+    return 10 + size
+
+
+def mp3_duration_ms(audio_path) -> int:
+    # walks the MPEG audio frame headers instead of decoding the audio
+    with open(audio_path, 'rb') as file:
+        data = file.read()
+    position = skip_id3(data)
+    total_samples = 0
+    sample_rate = None
+    while position + 4 <= len(data):
+        header = int.from_bytes(data[position:position + 4], 'big')
+        version = (header >> 19) & 0x3
+        layer = (header >> 17) & 0x3
+        bitrate_index = (header >> 12) & 0xF
+        sample_rate_index = (header >> 10) & 0x3
+        if (header >> 21) != 0x7FF or version == 1 or layer != 1 or bitrate_index in (0, 15) \
+                or sample_rate_index == 3:
+            position += 1
+            continue
+        is_mpeg1 = version == 3
+        sample_rate = MP3_SAMPLE_RATES[version][sample_rate_index]
+        bitrate = MP3_BITRATES[is_mpeg1][bitrate_index] * 1000
+        padding = (header >> 9) & 0x1
+        samples_per_frame = 1152 if is_mpeg1 else 576
+        frame_length = samples_per_frame // 8 * bitrate // sample_rate + padding
+        total_samples += samples_per_frame
+        position += frame_length
+    if not sample_rate:
+        return 0
+    return int(round(total_samples * 1000 / sample_rate))
 
-    print(f"AWS Connection was successful...")
 
+def split_sentences(text):
+    return [sentence for sentence in re.split(r'(?<=[.!?])\s+', text.strip()) if sentence]
+
+
+def split_text_into_chunks(text, max_chars=POLLY_MAX_CHARS):
+    sentences = split_sentences(text)
+    chunks = []
+    current = ""
+    for sentence in sentences:
+        while len(sentence) > max_chars:
+            # a single sentence over the limit is cut at the last space that fits
+            cut = sentence.rfind(' ', 0, max_chars)
+            cut = cut if cut > 0 else max_chars
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(sentence[:cut].strip())
+            sentence = sentence[cut:].strip()
+        candidate = f"{current} {sentence}".strip()
+        if len(candidate) > max_chars:
+            chunks.append(current)
+            current = sentence
+        else:
+            current = candidate
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def synthesize_audio(polly_client, text, audio_path):
+    rate_limiter('polly').acquire()
     response_audio = polly_client.synthesize_speech(
         Text=text,
         OutputFormat='mp3',
-        VoiceId='Gregory',
-        Engine='neural'
+        VoiceId=VOICE_ID,
+        Engine=ENGINE
     )
-
-    if "AudioStream" in response_audio:
-        audio_path = os.path.abspath(audio_path)
-        os.makedirs(os.path.dirname(audio_path), exist_ok=True)
-        with open(audio_path, 'wb') as file:
-            file.write(response_audio['AudioStream'].read())
-    else:
+    if "AudioStream" not in response_audio:
         raise Exception("Could not stream audio")
+    metrics.count('tts_characters', int(response_audio.get('RequestCharacters', len(text))), kind='audio')
+    with open(audio_path, 'wb') as file:
+        for chunk in response_audio['AudioStream'].iter_chunks(STREAM_CHUNK_SIZE):
+            file.write(chunk)
+            metrics.count('bytes_transferred', len(chunk), service='polly', direction='download')
+    return audio_path
 
-    audio_segment = AudioSegment.from_mp3(audio_path)
-    audio_duration_ms = len(audio_segment)
 
+def synthesize_speech_marks(polly_client, text):
+    rate_limiter('polly').acquire()
     response_marks = polly_client.synthesize_speech(
         Text=text,
         OutputFormat='json',
         SpeechMarkTypes=['word', 'sentence'],
-        VoiceId='Gregory',
-        Engine='neural'
+        VoiceId=VOICE_ID,
+        Engine=ENGINE
     )
+    if 'AudioStream' not in response_marks:
+        raise Exception("Could not retrieve speech marks")
+    metrics.count('tts_characters', int(response_marks.get('RequestCharacters', len(text))), kind='speech_marks')
+    speech_marks_body = response_marks['AudioStream'].read()
+    metrics.count('bytes_transferred', len(speech_marks_body), service='polly', direction='download')
+    speech_marks_data = speech_marks_body.decode('utf-8').split('\n')
+    return [json.loads(mark) for mark in speech_marks_data if mark.strip()]
 
-    print(f"Preparing speech marks...")
-    if 'AudioStream' in response_marks:
-        speech_marks_data = response_marks['AudioStream'].read().decode('utf-8').split('\n')
-        speech_marks = [json.loads(mark) for mark in speech_marks_data if mark.strip()]
-
-        list_of_sentences = []
-        current_sentence = None
-        current_words_in_sentence = []
-
-        for mark in speech_marks:
-            if mark['type'] == 'sentence':
-                if current_sentence is not None:
-                    current_sentence['end'] = mark['time']
-                    if current_words_in_sentence:
-                        current_words_in_sentence[-1]['end'] = mark['time']
-                    current_sentence['words_in_sentence'] = current_words_in_sentence
-                    list_of_sentences.append(current_sentence)
-                current_sentence = {
-                    "sentence": mark['value'],
-                    "start": mark['time'],
-                }
-                current_words_in_sentence = []
-            elif mark['type'] == 'word':
-                word_dict = {
-                    "word": mark['value'],
-                    "start": mark['time'],
-                }
+
+def build_sentences(speech_marks, audio_duration_ms):
+    list_of_sentences = []
+    current_sentence = None
+    current_words_in_sentence = []
+
+    for mark in speech_marks:
+        if mark['type'] == 'sentence':
+            if current_sentence is not None:
+                current_sentence['end'] = mark['time']
                 if current_words_in_sentence:
                     current_words_in_sentence[-1]['end'] = mark['time']
-                current_words_in_sentence.append(word_dict)
-
-        if current_sentence is not None:
+                current_sentence['words_in_sentence'] = current_words_in_sentence
+                list_of_sentences.append(current_sentence)
+            current_sentence = {
+                "sentence": mark['value'],
+                "start": mark['time'],
+            }
+            current_words_in_sentence = []
+        elif mark['type'] == 'word':
+            word_dict = {
+                "word": mark['value'],
+                "start": mark['time'],
+            }
             if current_words_in_sentence:
-                current_words_in_sentence[-1]['end'] = audio_duration_ms
-            current_sentence['end'] = audio_duration_ms
-            current_sentence['words_in_sentence'] = current_words_in_sentence
-            list_of_sentences.append(current_sentence)
+                current_words_in_sentence[-1]['end'] = mark['time']
+            current_words_in_sentence.append(word_dict)
 
-        if list_of_sentences:
-            list_of_sentences[-1]["is_last_sentence"] = True
+    if current_sentence is not None:
+        if current_words_in_sentence:
+            current_words_in_sentence[-1]['end'] = audio_duration_ms
+        current_sentence['end'] = audio_duration_ms
+        current_sentence['words_in_sentence'] = current_words_in_sentence
+        list_of_sentences.append(current_sentence)
 
-        return list_of_sentences
-    else:
-        raise Exception("Could not retrieve speech marks")
+    if list_of_sentences:
+        list_of_sentences[-1]["is_last_sentence"] = True
+
+    return list_of_sentences
+
+
+def tts_cache_key(text, output_format='mp3'):
+    return make_key(hashlib.sha256(text.encode('utf-8')).hexdigest(), VOICE_ID, ENGINE, output_format)
+
+
+def read_cached_audio(text, audio_path):
+    cache_key = tts_cache_key(text)
+    sentences = tts_cache.get_text(f"{cache_key}-sentences")
+    if sentences is None:
+        return None
+    audio = tts_cache.get(f"{cache_key}-audio")
+    if audio is None:
+        return None
+    with open(audio_path, 'wb') as file:
+        file.write(audio)
+    return json.loads(sentences)
+
+
+def write_cached_audio(text, audio_path, list_of_sentences):
+    cache_key = tts_cache_key(text)
+    with open(audio_path, 'rb') as file:
+        tts_cache.set(f"{cache_key}-audio", file.read())
+    # sentences last, so a reader that finds them can rely on the audio being there
+    tts_cache.set_text(f"{cache_key}-sentences", json.dumps(list_of_sentences))
+
+
+def text_to_audio(
+        text,
+        audio_path="common/results/output_audio.mp3",
+        conn_id='aws_default',
+        use_cache=TTS_CACHE_ENABLED
+):
+    audio_path = os.path.abspath(audio_path)
+    os.makedirs(os.path.dirname(audio_path), exist_ok=True)
+    if use_cache:
+        list_of_sentences = read_cached_audio(text, audio_path)
+        if list_of_sentences is not None:
+            print("Audio found in TTS cache, skipping Polly...")
+            return list_of_sentences
+
+    polly_client = get_boto3_client('polly', conn_id)
+
+    print(f"AWS Connection was successful...")
+
+    chunks = split_text_into_chunks(text)
+    chunk_paths = [audio_path] if len(chunks) == 1 else [f"{audio_path}.part{i}.mp3" for i in range(len(chunks))]
+    print(f"Synthesizing {len(chunks)} audio chunk(s)...")
+
+    # audio and speech marks for every chunk are requested at the same time
+    with ThreadPoolExecutor(max_workers=max(2, POLLY_CONCURRENCY)) as executor:
+        audio_futures = [executor.submit(in_stage_context(synthesize_audio), polly_client, chunk, chunk_path)
+                         for chunk, chunk_path in zip(chunks, chunk_paths)]
+        marks_futures = [executor.submit(in_stage_context(synthesize_speech_marks), polly_client, chunk)
+                         for chunk in chunks]
+        chunk_marks = [future.result() for future in marks_futures]
+        for future in audio_futures:
+            future.result()
+
+    print(f"Preparing speech marks...")
+    speech_marks = []
+    offset_ms = 0
+    for chunk_path, marks in zip(chunk_paths, chunk_marks):
+        for mark in marks:
+            mark['time'] += offset_ms
+        speech_marks.extend(marks)
+        offset_ms += mp3_duration_ms(chunk_path)
+    audio_duration_ms = offset_ms
+
+    if len(chunk_paths) > 1:
+        # MP3 is a plain sequence of frames, so the chunks can be joined byte for byte
+        with open(audio_path, 'wb') as output_file:
+            for chunk_path in chunk_paths:
+                with open(chunk_path, 'rb') as chunk_file:
+                    shutil.copyfileobj(chunk_file, output_file)
+                os.unlink(chunk_path)
+
+    list_of_sentences = build_sentences(speech_marks, audio_duration_ms)
+    if use_cache:
+        write_cached_audio(text, audio_path, list_of_sentences)
+    return list_of_sentences
@@ -1,36 +1,52 @@
-from typing import Optional
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
 
 import yfinance as yf
 import datetime
 import asyncio
 import logging
-from tqdm import tqdm
 
+from common.utils.article_store import article_store
+from common.utils.artifacts import artifact_store
+from common.utils.bar_store import bar_store, premarket_stats
+from common.utils.clients import call_with_retries
 from common.utils.consts import MARKET_TIME_ZONE
-from common.utils.open_ai import generate_stock_opening_analysis, summarize_with_open_ai
+from common.utils.metrics import in_stage_context, metrics
+from common.utils.near_duplicates import near_duplicate_clusters
+from common.utils.open_ai import generate_stock_opening_analysis, summarize_articles
 from common.utils.stock_market_time import StockMarketTime
-from common.utils.utils import get_text_by_url, save_to_s3, read_from_s3
+from common.utils.text_extraction import prepare_article_text
+from common.utils.utils import get_text_by_url
+
+NEWS_FETCH_CONCURRENCY = int(os.getenv('NEWS_FETCH_CONCURRENCY', 8))
+HEADLINE_DUPLICATE_THRESHOLD = float(os.getenv('HEADLINE_DUPLICATE_THRESHOLD', 0.7))
+BODY_DUPLICATE_THRESHOLD = float(os.getenv('BODY_DUPLICATE_THRESHOLD', 0.8))
 
 
 def save_file(data: str, stock_symbol: str, now_date: str,
               dag_name: str = "daily_stock_analysis",
               prefix: str = 'data') -> None:
     file_name = f"{stock_symbol}/{dag_name}/{prefix}/{now_date}"
-    save_to_s3(file_type="txt", file_name=file_name, data=data)
+    artifact_store.put_text(data, f"{file_name}.txt")
 
 
 def read_file(stock_symbol: str, now_date: str,
               dag_name: str = "daily_stock_analysis",
               prefix: str = 'data') -> Optional[str]:
     file_name = f"{stock_symbol}/{dag_name}/{prefix}/{now_date}"
-    return read_from_s3(file_name)
-
-
-def create_content(use_temp_file=False,
-                   stock_symbol='NVDA',
-                   company_name='NVIDIA Corporation',
-                   stock_market_time=None,
-                   ) -> str:
+    try:
+        return artifact_store.get_text(f"{file_name}.txt")
+    except FileNotFoundError:
+        print(f"File {file_name}.txt not found")
+        return None
+
+
+def load_stock_info(use_temp_file=False,
+                    stock_symbol='NVDA',
+                    company_name='NVIDIA Corporation',
+                    stock_market_time=None,
+                    ) -> str:
     now_date = stock_market_time.now.strftime("%Y-%m-%d")
     stock_info = read_file(stock_symbol=stock_symbol,
                            now_date=now_date) if use_temp_file else None
@@ -40,8 +56,21 @@ def create_content(use_temp_file=False,
         save_file(data=stock_info,
                   stock_symbol=stock_symbol,
                   now_date=now_date)
+    return stock_info
+
+
+def create_content(use_temp_file=False,
+                   stock_symbol='NVDA',
+                   company_name='NVIDIA Corporation',
+                   stock_market_time=None,
+                   stock_info=None,
+                   ) -> str:
+    now_date = stock_market_time.now.strftime("%Y-%m-%d")
+    if not stock_info:
+        stock_info = load_stock_info(use_temp_file, stock_symbol, company_name, stock_market_time)
     print("Generating stock opening analysis...")
-    result = generate_stock_opening_analysis(stock_info, company_name, stock_symbol)
+    with metrics.span('analysis'):
+        result = generate_stock_opening_analysis(stock_info, company_name, stock_symbol)
     save_file(data=result,
               stock_symbol=stock_symbol,
               now_date=now_date,
@@ -49,82 +78,150 @@ def create_content(use_temp_file=False,
     return result
 
 
-def get_stock_data(stock_symbol: str, company_name: str, stock_market_time: StockMarketTime) -> str:
+def get_stock_data(stock_symbol: str, company_name: str, stock_market_time: StockMarketTime,
+                   market_data: Optional[dict] = None) -> str:
+    # market_data is this symbol's entry from get_watchlist_market_data, when the watchlist was fetched in one go
     print("Getting stock data...")
-    price_data = get_price_data(stock_symbol, stock_market_time)
+    with metrics.span('price_data'):
+        price_data = market_data['price_data'] if market_data else get_price_data(stock_symbol, stock_market_time)
     print("Getting news data...")
-    news_data = get_news_data(company_name, stock_symbol, stock_market_time)
+    with metrics.span('news_data'):
+        news_data = get_news_data(company_name, stock_symbol, stock_market_time,
+                                  news=market_data['news'] if market_data else None)
     return f"Stock Data for {company_name} ({stock_symbol}):\n\n" \
            f"Price Data:\n{price_data}\n\n" \
            f"News Data:\n{news_data}"
 
 
-def get_price_data(stock_symbol: str, stock_market_time: StockMarketTime) -> str:
-    stock = yf.Ticker(stock_symbol)
+def fetch_news(stock_symbols: List[str], max_workers=NEWS_FETCH_CONCURRENCY) -> Dict[str, list]:
+    def news_for(stock_symbol):
+        return call_with_retries('yfinance', lambda: yf.Ticker(stock_symbol).news) or []
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(stock_symbols)))) as executor:
+        return dict(zip(stock_symbols, executor.map(in_stage_context(news_for), stock_symbols)))
+
+
+def get_watchlist_market_data(watchlist: List[Tuple[str, str]], stock_market_time: StockMarketTime) -> Dict[str, dict]:
+    # price bars for every symbol come in one multi-ticker download while the news is fetched alongside,
+    # so a watchlist takes about as long as a single symbol
+    stock_symbols = [stock_symbol for stock_symbol, _ in watchlist]
+    print(f"Getting market data for {len(stock_symbols)} symbol(s)...")
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        news_future = executor.submit(in_stage_context(fetch_news), stock_symbols)
+        bar_store.update_many(stock_symbols)
+        news_by_symbol = news_future.result()
+    return {
+        stock_symbol: {
+            "price_data": get_price_data(stock_symbol, stock_market_time, refresh=False),
+            "news": news_by_symbol[stock_symbol],
+        }
+        for stock_symbol in stock_symbols
+    }
+
+
+def get_price_data(stock_symbol: str, stock_market_time: StockMarketTime, refresh=True) -> str:
     start = stock_market_time.last_time_close
     end = stock_market_time.next_time_open
-    stock_data = stock.history(period="5d", interval="1m", prepost=True)
-    stock_data = stock_data[(stock_data.index >= start) & (stock_data.index <= end)]
-    # stock_data.to_csv(f"temp/{stock_symbol}_data.csv")
+    # only the bars newer than the local store's last one are downloaded
+    stock_data = bar_store.window(stock_symbol, start, end, refresh=refresh)
     # check if data is empty
-    if stock_data.empty:
+    if not len(stock_data):
         if not stock_market_time.is_mock:
             raise Exception("No stock data available for the specified time period.")
         return (
             f"Previous Close (Yesterday): 142.01\n"
             f"Open Price (Today): 133.91\n"
         )
-    previous_close = stock_data.iloc[0]['Open']
-    open_price = stock_data.iloc[-1]['Open']
-
-    return (
-        f"Previous Close (Yesterday): {previous_close}\n"
-        f"Open Price (Today): {open_price}\n"
+    stats = premarket_stats(stock_data, end)
+    price_data = (
+        f"Previous Close (Yesterday): {stats['previous_close']}\n"
+        f"Open Price (Today): {stats['open_price']}\n"
+        f"Gap Since Previous Close: {stats['gap_percent']:+.2f}%\n"
+        f"Overnight Realized Volatility: {stats['realized_volatility_percent']:.2f}%\n"
     )
-
-
-def get_news_data(company_name: str, stock_symbol: str, stock_market_time: StockMarketTime) -> str:
-    stock = yf.Ticker(stock_symbol)
-    news = stock.news
-    relevant_news = []
-    urls = set()
-    for news_item in tqdm(news):
+    if stats['vwap'] is not None:
+        price_data += f"Overnight VWAP: {stats['vwap']:.2f}\n"
+    if stats['premarket_high'] is not None:
+        price_data += (f"Pre-Market High: {stats['premarket_high']}\n"
+                       f"Pre-Market Low: {stats['premarket_low']}\n"
+                       f"Pre-Market Volume: {stats['premarket_volume']}\n")
+    return price_data
+
+
+def get_news_data(company_name: str, stock_symbol: str, stock_market_time: StockMarketTime,
+                  news: Optional[list] = None) -> str:
+    if news is None:
+        with metrics.span('fetch_news'):
+            news = fetch_news([stock_symbol])[stock_symbol]
+    timed_news = []
+    for news_item in news:
         if 'providerPublishTime' not in news_item:
             print(f"^%^%: Warning: 'providerPublishTime' not found in news_item: {news_item}")
             continue
-        published_timestamp = news_item['providerPublishTime']
-        published_time = datetime.datetime.fromtimestamp(published_timestamp, MARKET_TIME_ZONE)
-        if not stock_market_time.is_mock and not (
-                stock_market_time.last_time_close < published_time < stock_market_time.next_time_open):
-            continue
-        url = news_item.get('link')
-        if not url:
-            continue
-        relevant_news.append(news_item)
-        urls.add(url)
+        if news_item.get('link'):
+            timed_news.append(news_item)
+    if stock_market_time.is_mock:
+        relevant_news = timed_news
+    else:
+        # one vectorized lookup for all the items: the news that ran in the overnight window before the next open
+        calendar = stock_market_time.calendar
+        windows = calendar.overnight_window([news_item['providerPublishTime'] for news_item in timed_news])
+        next_session = calendar.session_index(stock_market_time.next_time_open)
+        relevant_news = [news_item for news_item, window in zip(timed_news, windows) if window == next_session]
     print(f"Number of relevant news items: {len(relevant_news)}")
     if not relevant_news:
         return (f"No relevant news found for {company_name} "
                 f"between {stock_market_time.last_time_close} and "
                 f"{stock_market_time.next_time_open}.")
 
-    text_by_link = asyncio.run(get_text_by_url(urls))
+    # syndicated copies of a story are scraped once: the first item of each headline cluster stands for it
+    headline_clusters = near_duplicate_clusters([news_item.get('title', '') for news_item in relevant_news],
+                                                threshold=HEADLINE_DUPLICATE_THRESHOLD, shingle_size=4, unit='char')
+    relevant_news = [{**relevant_news[cluster[0]], 'cluster_size': len(cluster)} for cluster in headline_clusters]
+    urls = {news_item['link'] for news_item in relevant_news}
+    print(f"Headline clusters: {len(relevant_news)}")
+
+    text_by_link = article_store.get_texts(urls)
+    missing_urls = [url for url in urls if url not in text_by_link]
+    print(f"Articles found in store: {len(text_by_link)}, scraping: {len(missing_urls)}")
+    if missing_urls:
+        with metrics.span('scrape'):
+            scraped_text_by_link = asyncio.run(get_text_by_url(missing_urls))
+        metrics.count('external_calls', len(missing_urls), service='scrape')
+        metrics.count('bytes_transferred', sum(len(text.encode('utf-8')) for text in scraped_text_by_link.values()
+                                               if text), service='scrape', direction='download')
+        article_store.put_texts(scraped_text_by_link)
+        text_by_link.update(scraped_text_by_link)
+    print(f"Article store: {article_store.stats()}")
+    articles_news = [news_item for news_item in relevant_news if text_by_link.get(news_item['link'])]
+    articles = [prepare_article_text(text_by_link[news_item['link']], news_item['link'])
+                for news_item in articles_news]
+    # different headlines over the same body: summarize the longest copy, keep how many sources ran the story
+    body_clusters = near_duplicate_clusters([article['text'] for article in articles],
+                                            threshold=BODY_DUPLICATE_THRESHOLD, shingle_size=5)
+    representatives = [max(cluster, key=lambda i: len(articles[i]['text'])) for cluster in body_clusters]
+    articles_news = [{**articles_news[representative],
+                      'cluster_size': sum(articles_news[i]['cluster_size'] for i in cluster)}
+                     for representative, cluster in zip(representatives, body_clusters)]
+    articles = [articles[representative] for representative in representatives]
+    print(f"Article clusters: {len(articles)}")
+    print(f"Article tokens: {sum(article['tokens_before'] for article in articles)} -> "
+          f"{sum(article['tokens_after'] for article in articles)}")
+    print(f"Summarizing {len(articles_news)} articles...")
+    with metrics.span('summarize'):
+        summaries = asyncio.run(summarize_articles(
+            [(article['text'], article['link']) for article in articles],
+            company_name, stock_symbol))
     news_data = ""
-    # TODO - put it in a thread
-    for news_item in tqdm(relevant_news):
-        link = news_item['link']
-        text = text_by_link.get(link)
-        if not text:
+    for news_item, summary in zip(articles_news, summaries):
+        if not summary:
             continue
 
         published_timestamp = news_item['providerPublishTime']
         published_time = datetime.datetime.fromtimestamp(published_timestamp, MARKET_TIME_ZONE)
-        summary = summarize_with_open_ai(text, link, company_name, stock_symbol)
-        if not summary:
-            continue
-
         news_data += (f"Headline: {news_item['title'].strip()}\n"
                       f"Date: {published_time}\n"
+                      f"Sources: {news_item['cluster_size']}\n"
                       f"Summary: {summary.strip()}\n\n")
 
     return news_data
@@ -0,0 +1,92 @@
+import hashlib
+import os
+from functools import lru_cache
+
+import ffmpeg
+
+from common.ffmpeg_renderer import VIDEO_ENCODE_KWARGS, normalize_audio
+from common.utils.cache import make_key
+from common.utils.consts import CACHE_DIR, DESIRED_HEIGHT, DESIRED_WIDTH
+from common.video_creation import SHORTS_DESIRED_HEIGHT, SHORTS_DESIRED_WIDTH, shorts_frame
+from common.video_proxies import fit_to_frame
+
+DISCLAIMER_DIR = os.path.join(CACHE_DIR, 'disclaimer')
+RENDITION_SIZES = {
+    'main': (DESIRED_WIDTH, DESIRED_HEIGHT),
+    'shorts': (SHORTS_DESIRED_WIDTH, SHORTS_DESIRED_HEIGHT),
+}
+
+
+@lru_cache(maxsize=None)
+def file_digest(path, size, mtime):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1024 * 1024), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def content_hash(path):
+    stat = os.stat(path)
+    return file_digest(os.path.abspath(path), stat.st_size, stat.st_mtime)
+
+
+def encode_disclaimer(disclaimer_video_path, output_path, rendition, encode_kwargs):
+    disclaimer = ffmpeg.input(disclaimer_video_path)
+    video = fit_to_frame(disclaimer.video)
+    if rendition == 'shorts':
+        video = shorts_frame(video)
+    tmp_path = f"{os.path.splitext(output_path)[0]}.{os.getpid()}.tmp.mp4"
+    (
+        ffmpeg
+        .output(video, normalize_audio(disclaimer.audio), tmp_path, acodec='aac', **encode_kwargs)
+        .global_args('-loglevel', 'error')
+        .overwrite_output()
+        .run()
+    )
+    os.replace(tmp_path, output_path)
+
+
+def get_disclaimer_rendition(disclaimer_video_path, rendition='main', output_kwargs=None):
+    # the disclaimer never changes, so each rendition is encoded once with the main render's codec settings
+    encode_kwargs = {**VIDEO_ENCODE_KWARGS, **(output_kwargs or {})}
+    encode_kwargs.pop('threads', None)  # doesn't change the bitstream, don't re-encode over it
+    cache_key = make_key(content_hash(disclaimer_video_path), rendition, RENDITION_SIZES[rendition],
+                         sorted(encode_kwargs.items()))
+    path = os.path.join(DISCLAIMER_DIR, f"{cache_key}.mp4")
+    if not os.path.exists(path):
+        print(f"Encoding {rendition} disclaimer...")
+        os.makedirs(DISCLAIMER_DIR, exist_ok=True)
+        encode_disclaimer(disclaimer_video_path, path, rendition, encode_kwargs)
+    return path
+
+
+def append_disclaimer(body_path, disclaimer_video_path, output_path, rendition='main', output_kwargs=None):
+    # joins the rendered video and the cached disclaimer with the concat demuxer, no frame is re-encoded
+    if not os.path.exists(disclaimer_video_path):
+        print("Disclaimer video not found. Proceeding without it.")
+        os.replace(body_path, output_path)
+        return output_path
+    print("Adding disclaimer video...")
+    disclaimer_path = get_disclaimer_rendition(disclaimer_video_path, rendition, output_kwargs)
+    list_path = f"{os.path.splitext(output_path)[0]}.concat.txt"
+    with open(list_path, 'w') as file:
+        file.writelines(f"file '{os.path.abspath(path)}'\n" for path in (body_path, disclaimer_path))
+    try:
+        (
+            ffmpeg
+            .input(list_path, f='concat', safe=0)
+            .output(output_path, c='copy')
+            .global_args('-loglevel', 'error')
+            .overwrite_output()
+            .run()
+        )
+    finally:
+        os.remove(list_path)
+        os.remove(body_path)
+    return output_path
+
+
+def body_path_for(output_path):
+    base, extension = os.path.splitext(output_path)
+    return f"{base}.body{extension}"
@@ -0,0 +1,34 @@
+import os
+
+# libx264 settings by name; 'balanced' is libx264's own default, what every render used so far
+ENCODER_PROFILES = {
+    'draft': {'preset': 'ultrafast', 'crf': 28},
+    'fast': {'preset': 'veryfast', 'crf': 23},
+    'balanced': {'preset': 'medium', 'crf': 23},
+    'quality': {'preset': 'slow', 'crf': 18},
+}
+ENCODER_PROFILE = os.getenv('ENCODER_PROFILE', 'balanced')
+ENCODER_THREADS = int(os.getenv('ENCODER_THREADS', 0))  # 0 lets x264 decide
+ENCODER_TUNE = os.getenv('ENCODER_TUNE')  # e.g. 'film', 'animation' or 'fastdecode'
+
+
+def encoder_kwargs(profile=ENCODER_PROFILE):
+    # ffmpeg output options for a profile name, or for a dict with the same keys
+    settings = ENCODER_PROFILES[profile] if isinstance(profile, str) else profile
+    kwargs = {'preset': settings['preset'], 'crf': settings['crf']}
+    threads = settings.get('threads', ENCODER_THREADS)
+    if threads:
+        kwargs['threads'] = threads
+    tune = settings.get('tune', ENCODER_TUNE)
+    if tune:
+        kwargs['tune'] = tune
+    return kwargs
+
+
+def moviepy_write_kwargs(output_kwargs):
+    # the same settings as write_videofile arguments
+    ffmpeg_params = ['-pix_fmt', 'yuv420p', '-crf', str(output_kwargs['crf'])]
+    if output_kwargs.get('tune'):
+        ffmpeg_params += ['-tune', output_kwargs['tune']]
+    return {'codec': 'libx264', 'preset': output_kwargs['preset'], 'threads': output_kwargs.get('threads'),
+            'ffmpeg_params': ffmpeg_params}
@@ -1,89 +1,266 @@
 import datetime
-from common.audio_synthesis import text_to_audio
-from common.create_content import create_content
-from common.upload_to_youtube import upload_video_youtube
-from common.utils.consts import MARKET_TIME_ZONE
-from common.utils.open_ai import create_description_youtube_video, match_text_to_video
+import functools
 import glob
+import json
 import os
+import shutil
+import tempfile
+from contextlib import contextmanager
 
+from common.audio_synthesis import ENGINE, VOICE_ID, split_sentences, text_to_audio
+from common.create_content import create_content, load_stock_info
+from common.encoder_profiles import ENCODER_PROFILE
+from common.upload_to_youtube import upload_video_youtube
+from common.utils.artifacts import artifact_store, run_prefix
+from common.utils.checkpoints import RunCheckpoint
+from common.utils.consts import MARKET_TIME_ZONE
+from common.utils.metrics import metrics, publish_run_report
+from common.utils.open_ai import create_description_youtube_video, llm_cache
 from common.utils.stock_market_time import StockMarketTime
-from common.utils.utils import clean_dir
-from common.video_creation import create_video
-from tqdm import tqdm
+from common.utils.video_index import (VIDEO_MATCH_METHOD, assign_videos, match_sentences_to_videos,
+                                     video_map_fingerprint)
+from common.video_creation import RENDER_ENGINE, create_video, create_youtube_shorts_video, shorts_trim_point
 
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+RESULTS_DIR = os.path.join(SCRIPT_DIR, "results")
+BACKGROUND_VIDEOS_DIR = os.path.join(SCRIPT_DIR, "inputs")
+DISCLAIMER_VIDEO_PATH = os.path.join(RESULTS_DIR, "disclaimer_video.mp4")
+STAGES = ['content', 'description', 'tts', 'match_videos', 'render', 'shorts', 'upload']
 
-def execute_daily_stock_analysis(stock_symbol='NVDA', company_name='NVIDIA Corporation', is_mock=False):
+# every stage takes the run and the manifests of the stages it needs, and returns its own manifest: a small dict
+# of artifact keys that fits in an XCom, while the artifacts themselves go to S3 (or ARTIFACT_ROOT)
+
+
+def make_run(stock_symbol='NVDA', company_name='NVIDIA Corporation', is_mock=False):
     now = datetime.datetime.now(MARKET_TIME_ZONE)
-    if is_mock:
-        use_temp_file = True  # change to False for testing all the way through
-        mock_data_input_now = now.replace(hour=9, minute=0, second=0, microsecond=0)
-    else:
-        use_temp_file = False
-        mock_data_input_now = None
-    stock_market_time = StockMarketTime(mock_data_input_now)
-
-    if not is_mock and not stock_market_time.is_next_time_open_today:
-        print("Market Won't Open Today, Exiting...")
-        return
+    mock_data_input_now = now.replace(hour=9, minute=0, second=0, microsecond=0) if is_mock else None
+    # keyed by trading session, so a retry after midnight or a run on a non-trading day resumes the same run
+    session_date = StockMarketTime(mock_data_input_now).session_date
+    return {
+        "stock_symbol": stock_symbol,
+        "company_name": company_name,
+        "is_mock": is_mock,
+        "use_temp_file": is_mock,  # change to False for testing mock runs all the way through
+        "now": now.isoformat(),
+        "mock_data_input_now": mock_data_input_now.isoformat() if mock_data_input_now else None,
+        "prefix": run_prefix(stock_symbol, session_date.isoformat(), is_mock),
+    }
+
+
+def run_now(run):
+    return datetime.datetime.fromisoformat(run['now'])
+
+
+def stock_market_time_for(run):
+    mock_data_input_now = run['mock_data_input_now']
+    return StockMarketTime(datetime.datetime.fromisoformat(mock_data_input_now) if mock_data_input_now else None)
+
+
+def artifact_key(run, name):
+    return f"{run['prefix']}/{name}"
+
+
+@contextmanager
+def workspace(stage):
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    work_dir = tempfile.mkdtemp(prefix=f"{stage}_", dir=RESULTS_DIR)
+    try:
+        yield work_dir
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def instrumented(stage):
+    # every stage writes its own metrics report, whichever worker it runs on
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(run, *args, **kwargs):
+            with metrics.stage(stage, run):
+                return func(run, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def speech_text(text):
+    return text.replace("*", "").replace('"', "'")
+
+
+def market_opens_today(run):
+    if run['is_mock'] or stock_market_time_for(run).is_next_time_open_today:
+        return True
+    print("Market Won't Open Today, Exiting...")
+    return False
+
+
+@instrumented('content')
+def stage_content(run):
+    checkpoint = RunCheckpoint(run)
+    stock_market_time = stock_market_time_for(run)
+
+    def get_stock_info():
+        stock_info = load_stock_info(use_temp_file=run['use_temp_file'],
+                                     stock_symbol=run['stock_symbol'],
+                                     company_name=run['company_name'],
+                                     stock_market_time=stock_market_time)
+        return {"stock_info": artifact_store.put_text(stock_info, artifact_key(run, "stock_info.txt"))}
 
-    print(f"Creating content...")
-    text = create_content(use_temp_file=use_temp_file,
-                          stock_symbol=stock_symbol,
-                          company_name=company_name,
-                          stock_market_time=stock_market_time)
-    title_youtube = f"{company_name} - {stock_symbol} AI Stock Analysis - {now.strftime('%Y-%m-%d')}"
-    description_youtube = create_description_youtube_video(text=text, company_name=company_name,
-                                                           stock_symbol=stock_symbol, now=now)
-
-    # print(f"title_youtube:\n{title_youtube}")
-    # print(f"description_youtube:\n{description_youtube}")
-    text = text.replace("*", "").replace('"', "'")
-
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    audio_path = os.path.join(script_dir, "results/output_audio.mp3")
-    video_path = os.path.join(script_dir, "results/output_video.mp4")
-    youtube_shorts_video_path = os.path.join(script_dir, "results/youtube_shorts_output_video.mp4")
-    disclaimer_video_path = os.path.join(script_dir, "results/disclaimer_video.mp4")
-
-    print("Converting text to audio...")
-    sentences_list_with_timings = text_to_audio(text, audio_path)
-
-    print(f"Matching text to video...")
-    last_video_name = None
-    for sentence in tqdm(sentences_list_with_timings):
-        sentence['video_name'] = match_text_to_video(sentence['sentence'], last_video_name)
-        last_video_name = sentence['video_name']
-        print(f"last_video_name: {last_video_name}")
-
-    background_videos_dir = os.path.join(script_dir, "inputs")
-    background_videos = glob.glob(os.path.join(background_videos_dir, "*.mp4")) or None
-
-    print("Creating video with text...")
-    create_video(
-        audio_path=audio_path,
-        video_path=video_path,
-        sentences_list_with_timings=sentences_list_with_timings,
-        background_videos=background_videos,
-        disclaimer_video_path=disclaimer_video_path,
-        youtube_shorts_video_path=youtube_shorts_video_path
-    )
-
-    print("Uploading video to YouTube...")
-    upload_video_youtube(
-        video_file_path=video_path,
-        title=title_youtube,
-        description=description_youtube,
-        youtube_shorts_video_path=youtube_shorts_video_path,
-        keywords='finance,stock market,AI',
-        category='22',
-        is_mock=is_mock
-    )
-
-    print("Cleaning up...")
-    dir_name = os.path.join(script_dir, "results")
-    clean_dir(dir_name=dir_name)
+    def generate_script():
+        print(f"Creating content...")
+        text = create_content(use_temp_file=run['use_temp_file'],
+                              stock_symbol=run['stock_symbol'],
+                              company_name=run['company_name'],
+                              stock_market_time=stock_market_time,
+                              stock_info=artifact_store.get_text(stock_info['stock_info']))
+        return {"script": artifact_store.put_text(text, artifact_key(run, "script.txt"))}
+
+    stock_info = checkpoint.run('stock_info', get_stock_info)
+    return checkpoint.run('script', generate_script, [stock_info])
+
+
+@instrumented('description')
+def stage_description(run, content):
+    now = run_now(run)
+
+    def describe():
+        text = artifact_store.get_text(content['script'])
+        description_youtube = create_description_youtube_video(text=text, company_name=run['company_name'],
+                                                               stock_symbol=run['stock_symbol'], now=now)
+        return {
+            "title": f"{run['company_name']} - {run['stock_symbol']} AI Stock Analysis - {now.strftime('%Y-%m-%d')}",
+            "description": artifact_store.put_text(description_youtube, artifact_key(run, "description.txt")),
+        }
+
+    return RunCheckpoint(run).run('description', describe, [content])
+
+
+@instrumented('tts')
+def stage_tts(run, content):
+    def synthesize():
+        text = speech_text(artifact_store.get_text(content['script']))
+        with workspace("tts") as work_dir:
+            audio_path = os.path.join(work_dir, "output_audio.mp3")
+            print("Converting text to audio...")
+            sentences_list_with_timings = text_to_audio(text, audio_path)
+            return {
+                "audio": artifact_store.put_file(audio_path, artifact_key(run, "output_audio.mp3")),
+                "sentences": artifact_store.put_json(sentences_list_with_timings,
+                                                     artifact_key(run, "sentences.json")),
+            }
+
+    return RunCheckpoint(run).run('tts', synthesize, [content], config={"voice": VOICE_ID, "engine": ENGINE})
+
+
+@instrumented('match_videos')
+def stage_match_videos(run, content):
+    def match():
+        # matches the script's sentences, so it doesn't have to wait for the speech marks
+        sentences = split_sentences(speech_text(artifact_store.get_text(content['script'])))
+        print(f"Matching text to video...")
+        video_names = match_sentences_to_videos(sentences)
+        print(f"video names: {video_names}")
+        matches = [{"sentence": sentence, "video_name": video_name}
+                   for sentence, video_name in zip(sentences, video_names)]
+        return {"video_matches": artifact_store.put_json(matches, artifact_key(run, "video_matches.json"))}
+
+    return RunCheckpoint(run).run('video_matches', match, [content],
+                                  config={"method": VIDEO_MATCH_METHOD, "video_map": video_map_fingerprint()})
+
+
+@instrumented('render')
+def stage_render(run, tts, matching, engine=RENDER_ENGINE, encoder_profile=ENCODER_PROFILE):
+    def render():
+        texts = artifact_store.get_texts([tts['sentences'], matching['video_matches']])
+        sentences_list_with_timings = assign_videos(json.loads(texts[tts['sentences']]),
+                                                    json.loads(texts[matching['video_matches']]))
+        background_videos = glob.glob(os.path.join(BACKGROUND_VIDEOS_DIR, "*.mp4")) or None
+        with workspace("render") as work_dir:
+            audio_path = artifact_store.get_file(tts['audio'], os.path.join(work_dir, "output_audio.mp3"))
+            video_path = os.path.join(work_dir, "output_video.mp4")
+            # the ffmpeg engines render the Shorts from the same decode as the main video
+            youtube_shorts_video_path = None if engine == 'moviepy' else \
+                os.path.join(work_dir, "youtube_shorts_output_video.mp4")
+            print("Creating video with text...")
+            create_video(
+                audio_path=audio_path,
+                video_path=video_path,
+                sentences_list_with_timings=sentences_list_with_timings,
+                background_videos=background_videos,
+                disclaimer_video_path=DISCLAIMER_VIDEO_PATH,
+                youtube_shorts_video_path=youtube_shorts_video_path,
+                engine=engine,
+                encoder_profile=encoder_profile,
+            )
+            uploads = [(video_path, artifact_key(run, "output_video.mp4"))]
+            if youtube_shorts_video_path:
+                uploads.append((youtube_shorts_video_path, artifact_key(run, "youtube_shorts_output_video.mp4")))
+            keys = artifact_store.put_files(uploads)
+            return {"video": keys[0], "shorts": keys[1] if len(keys) > 1 else None}
+
+    return RunCheckpoint(run).run('render', render, [tts, matching],
+                                  config={"engine": engine, "encoder_profile": encoder_profile})
+
+
+@instrumented('shorts')
+def stage_shorts(run, tts, render):
+    def create_shorts():
+        if render['shorts']:
+            return {"shorts": render['shorts']}
+        sentences_list_with_timings = artifact_store.get_json(tts['sentences'])
+        main_duration = sentences_list_with_timings[-1]['end'] / 1000 if sentences_list_with_timings else None
+        with workspace("shorts") as work_dir:
+            video_path = artifact_store.get_file(render['video'], os.path.join(work_dir, "output_video.mp4"))
+            youtube_shorts_video_path = os.path.join(work_dir, "youtube_shorts_output_video.mp4")
+            create_youtube_shorts_video(video_path, youtube_shorts_video_path, DISCLAIMER_VIDEO_PATH,
+                                        shorts_trim_point(sentences_list_with_timings, main_duration)
+                                        if main_duration else None)
+            return {"shorts": artifact_store.put_file(youtube_shorts_video_path,
+                                                      artifact_key(run, "youtube_shorts_output_video.mp4"))}
+
+    return RunCheckpoint(run).run('shorts', create_shorts, [tts, render])
+
+
+@instrumented('upload')
+def stage_upload(run, description, render, shorts):
+    # once the links are recorded a rerun never uploads the same video twice
+    def upload():
+        with workspace("upload") as work_dir:
+            downloads = [(render['video'], os.path.join(work_dir, "output_video.mp4"))]
+            if shorts['shorts']:
+                downloads.append((shorts['shorts'], os.path.join(work_dir, "youtube_shorts_output_video.mp4")))
+            paths = artifact_store.get_files(downloads)
+            video_path, youtube_shorts_video_path = paths[0], paths[1] if len(paths) > 1 else None
+            print("Uploading video to YouTube...")
+            video_link, shorts_link = upload_video_youtube(
+                video_file_path=video_path,
+                title=description['title'],
+                description=artifact_store.get_text(description['description']),
+                youtube_shorts_video_path=youtube_shorts_video_path,
+                keywords='finance,stock market,AI',
+                category='22',
+                is_mock=run['is_mock']
+            )
+        return {"video_link": video_link, "shorts_link": shorts_link}
+
+    return RunCheckpoint(run).run('upload', upload, [description, render, shorts])
+
+
+def execute_daily_stock_analysis(stock_symbol='NVDA', company_name='NVIDIA Corporation', is_mock=False):
+    # runs the same stages as the Airflow DAG, one after the other in this process
+    run = make_run(stock_symbol, company_name, is_mock)
+    if not market_opens_today(run):
+        return
+    content = stage_content(run)
+    description = stage_description(run, content)
+    tts = stage_tts(run, content)
+    matching = stage_match_videos(run, content)
+    render = stage_render(run, tts, matching)
+    shorts = stage_shorts(run, tts, render)
+    upload = stage_upload(run, description, render, shorts)
+    print(f"Uploaded: {upload}")
 
+    print(f"LLM cache: {llm_cache.stats()}")
+    if metrics.enabled:
+        publish_run_report(run, STAGES)
     print("Script finished successfully.")
 
 # if __name__ == "__main__":
@@ -0,0 +1,156 @@
+import os
+
+import ffmpeg
+
+from common.audio_synthesis import mp3_duration_ms
+from common.utils.consts import DESIRED_HEIGHT, DESIRED_WIDTH, VIDEO_FPS
+from common.utils.timing import StageTimer
+from common.video_creation import plan_background_segments, shorts_frame, shorts_trim_point
+from common.video_proxies import fit_to_frame, get_video_duration, get_video_source
+from common.word_raster import WORD_FONT_SIZE, WORD_STROKE_WIDTH, find_font_path, load_font
+
+ASS_HEADER = """[Script Info]
+ScriptType: v4.00+
+PlayResX: {width}
+PlayResY: {height}
+WrapStyle: 2
+ScaledBorderAndShadow: yes
+
+[V4+ Styles]
+Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, BackColour, Bold, Italic, \
+Underline, StrikeOut, ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, Alignment, MarginL, MarginR, \
+MarginV, Encoding
+Style: Word,{font},{size},&H00FFFFFF,&H00FFFFFF,&H00000000,&H00000000,-1,0,0,0,100,100,0,0,1,{outline},0,5,0,0,0,1
+
+[Events]
+Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
+"""
+VIDEO_ENCODE_KWARGS = {'vcodec': 'libx264', 'r': VIDEO_FPS, 'pix_fmt': 'yuv420p'}
+
+
+def ass_time(milliseconds):
+    centiseconds = int(round(milliseconds / 10))
+    hours, centiseconds = divmod(centiseconds, 360000)
+    minutes, centiseconds = divmod(centiseconds, 6000)
+    seconds, centiseconds = divmod(centiseconds, 100)
+    return f"{hours}:{minutes:02d}:{seconds:02d}.{centiseconds:02d}"
+
+
+def caption_font():
+    # libass sizes fonts by ascent + descent rather than by em, so take both from the raster font's metrics
+    font_path = find_font_path()
+    if not font_path:
+        return "Arial", WORD_FONT_SIZE
+    font = load_font(font_path, WORD_FONT_SIZE)
+    return font.getname()[0], sum(font.getmetrics())
+
+
+def write_word_captions(sentences_list_with_timings, ass_path, offset_ms=0):
+    # one centered event per spoken word, styled like the word clips of the MoviePy engine
+    font, size = caption_font()
+    lines = [ASS_HEADER.format(width=DESIRED_WIDTH, height=DESIRED_HEIGHT, font=font, size=size,
+                               outline=WORD_STROKE_WIDTH)]
+    for sentence in sentences_list_with_timings:
+        for timing in sentence['words_in_sentence']:
+            word = timing['word'].replace('\\', '').replace('{', '').replace('}', '')
+            start, end = max(timing['start'] - offset_ms, 0), timing['end'] - offset_ms
+            if end <= 0:
+                continue
+            lines.append(f"Dialogue: 0,{ass_time(start)},{ass_time(end)},Word,,0,0,0,,{word}\n")
+    with open(ass_path, 'w', encoding='utf-8') as file:
+        file.writelines(lines)
+    return ass_path
+
+
+def background_stream(segments, main_duration):
+    # segments are (video_name, clip_duration) or (video_name, clip_duration, source_offset)
+    streams = []
+    for video_name, clip_duration, *source_offset in segments:
+        input_kwargs = {'ss': source_offset[0]} if source_offset and source_offset[0] > 0 else {}
+        stream = ffmpeg.input(get_video_source(video_name)['path'], t=clip_duration, **input_kwargs).video
+        # the last sentence gets an extra half second that may run past the source, hold its last frame
+        stream = (
+            stream
+            .filter('tpad', stop_mode='clone', stop_duration=clip_duration)
+            .filter('trim', duration=clip_duration)
+            .filter('setpts', 'PTS-STARTPTS')
+        )
+        streams.append(fit_to_frame(stream))
+    if not streams:
+        return ffmpeg.input(f"color=c=black:s={DESIRED_WIDTH}x{DESIRED_HEIGHT}:r={VIDEO_FPS}:d={main_duration}",
+                            f='lavfi').video
+    if len(streams) == 1:
+        return streams[0]
+    return ffmpeg.concat(*streams, v=1, a=0)
+
+
+def normalize_audio(stream):
+    return stream.filter('aformat', sample_fmts='fltp', sample_rates=44100, channel_layouts='stereo')
+
+
+def burn_captions(video, ass_path):
+    font_path = find_font_path()
+    ass_kwargs = {'fontsdir': os.path.dirname(font_path)} if font_path else {}
+    return video.filter('ass', ass_path, **ass_kwargs)
+
+
+def render_video_ffmpeg(
+        audio_path,
+        video_path,
+        sentences_list_with_timings,
+        background_videos,
+        disclaimer_video_path,
+        shorts_video_path=None,
+        output_kwargs=None,
+        timer=None,
+):
+    timer = timer or StageTimer()
+    audio_duration = mp3_duration_ms(audio_path) / 1000
+    with timer.stage('background'):
+        if background_videos is None:
+            segments = []
+        else:
+            segments = plan_background_segments(sentences_list_with_timings, audio_duration, get_video_duration)
+        main_duration = max(audio_duration, sum(clip_duration for _, clip_duration in segments))
+
+    with timer.stage('text_clips'):
+        ass_path = write_word_captions(sentences_list_with_timings, f"{os.path.splitext(video_path)[0]}.ass")
+    video = burn_captions(background_stream(segments, main_duration), ass_path)
+    audio = normalize_audio(ffmpeg.input(audio_path).audio.filter('apad', whole_dur=main_duration))
+
+    if shorts_video_path:
+        # the composed frames are decoded once and split into both renditions
+        shorts_duration = shorts_trim_point(sentences_list_with_timings, main_duration)
+        print(f"Creating YouTube Shorts video of duration {shorts_duration:.2f} seconds...")
+        video_split, audio_split = video.filter_multi_output('split'), audio.filter_multi_output('asplit')
+        video, audio = video_split[0], audio_split[0]
+        shorts_video = shorts_frame(
+            video_split[1].filter('trim', duration=shorts_duration).filter('setpts', 'PTS-STARTPTS'))
+        shorts_audio = audio_split[1].filter('atrim', duration=shorts_duration).filter('asetpts', 'PTS-STARTPTS')
+
+    print("Writing main video with ffmpeg...")
+    # the renditions are encoded without the disclaimer, its cached encodes are appended as a stream copy
+    from common.disclaimer import append_disclaimer, body_path_for
+    encode_kwargs = {'acodec': 'aac', **VIDEO_ENCODE_KWARGS, **(output_kwargs or {})}
+    outputs = [ffmpeg.output(video, audio, body_path_for(video_path), **encode_kwargs)]
+    if shorts_video_path:
+        outputs.append(ffmpeg.output(shorts_video, shorts_audio, body_path_for(shorts_video_path), **encode_kwargs))
+    try:
+        # compositing, both encodes and the Shorts all happen in this one run
+        with timer.stage('encode'):
+            (
+                ffmpeg
+                .merge_outputs(*outputs)
+                .global_args('-loglevel', 'error')
+                .overwrite_output()
+                .run()
+            )
+    finally:
+        os.remove(ass_path)
+    with timer.stage('disclaimer'):
+        append_disclaimer(body_path_for(video_path), disclaimer_video_path, video_path, 'main', output_kwargs)
+        if shorts_video_path:
+            append_disclaimer(body_path_for(shorts_video_path), disclaimer_video_path, shorts_video_path, 'shorts',
+                              output_kwargs)
+    if shorts_video_path:
+        print(f"YouTube Shorts video created at {shorts_video_path}")
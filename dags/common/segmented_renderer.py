@@ -0,0 +1,192 @@
+import math
+import os
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import ffmpeg
+
+from common.audio_synthesis import mp3_duration_ms
+from common.ffmpeg_renderer import (VIDEO_ENCODE_KWARGS, background_stream, burn_captions, normalize_audio,
+                                    write_word_captions)
+from common.utils.consts import VIDEO_FPS
+from common.utils.timing import StageTimer
+from common.video_creation import plan_background_segments, shorts_frame, shorts_trim_point
+from common.video_proxies import get_video_duration
+
+RENDER_WORKERS = int(os.getenv('RENDER_WORKERS', os.cpu_count() or 1))
+RENDER_SEGMENTS = int(os.getenv('RENDER_SEGMENTS', 0))  # 0 means one segment per worker
+
+
+def frame_count(seconds):
+    # index of the first frame at or after the given time, the frame where a clip or caption starting then shows up
+    return math.ceil(round(seconds * VIDEO_FPS, 6))
+
+
+def choose_cut_points(sentences_list_with_timings, main_duration, segment_count):
+    # cuts land on the frame of the sentence start nearest to an even split, so every segment has whole frames
+    candidates = sorted({frame_count(sentence['start'] / 1000) for sentence in sentences_list_with_timings})
+    candidates = [frame for frame in candidates if 0 < frame < frame_count(main_duration)]
+    cuts = []
+    for i in range(1, segment_count):
+        target = frame_count(main_duration * i / segment_count)
+        remaining = [frame for frame in candidates if not cuts or frame > cuts[-1]]
+        if not remaining:
+            break
+        cuts.append(min(remaining, key=lambda frame: abs(frame - target)))
+    return cuts
+
+
+def slice_background(background_segments, start_frame, end_frame):
+    # (video_name, clip_duration, source_offset) for the part of the background timeline inside the frame range,
+    # with clip boundaries snapped to frames the way the single-pass concat lays them out
+    pieces = []
+    position = 0
+    for video_name, clip_duration in background_segments:
+        clip_start, clip_end = frame_count(position), frame_count(position + clip_duration)
+        piece_start, piece_end = max(clip_start, start_frame), min(clip_end, end_frame)
+        if piece_end > piece_start:
+            pieces.append((video_name, (piece_end - piece_start) / VIDEO_FPS, (piece_start - clip_start) / VIDEO_FPS))
+        position += clip_duration
+    return pieces
+
+
+def plan_render_jobs(
+        sentences_list_with_timings,
+        background_videos,
+        audio_duration,
+        work_dir,
+        segment_count,
+        with_shorts=False,
+):
+    # each job is a plain dict, so it can go to a local worker thread or to another Airflow task as is
+    if background_videos is None:
+        background_segments = []
+    else:
+        background_segments = plan_background_segments(sentences_list_with_timings, audio_duration,
+                                                        get_video_duration)
+    main_duration = max(audio_duration, sum(clip_duration for _, clip_duration in background_segments))
+    frames = [0] + choose_cut_points(sentences_list_with_timings, main_duration, segment_count) + \
+        [frame_count(main_duration)]
+    shorts_end_frame = frame_count(shorts_trim_point(sentences_list_with_timings, main_duration)) if with_shorts else 0
+    jobs = []
+    for index, (start_frame, end_frame) in enumerate(zip(frames, frames[1:])):
+        start, end = start_frame / VIDEO_FPS, end_frame / VIDEO_FPS
+        jobs.append({
+            "index": index,
+            "start": start,
+            "frames": end_frame - start_frame,
+            "shorts_frames": min(max(shorts_end_frame - start_frame, 0), end_frame - start_frame),
+            "background": slice_background(background_segments, start_frame, end_frame),
+            "sentences": [sentence for sentence in sentences_list_with_timings
+                          if sentence['end'] > start * 1000 and sentence['start'] < end * 1000],
+            "output_path": os.path.join(work_dir, f"segment_{index:04d}.mp4"),
+            "shorts_output_path": os.path.join(work_dir, f"segment_{index:04d}_shorts.mp4"),
+        })
+    return jobs, main_duration
+
+
+def rendition_outputs(video, output_path, shorts_output_path=None, shorts_frames=0, output_kwargs=None,
+                      **main_kwargs):
+    # one decode of the composed frames feeds the 16:9 output and, when asked for, the first frames of the 9:16 one
+    encode_kwargs = {**VIDEO_ENCODE_KWARGS, **(output_kwargs or {})}
+    if not shorts_output_path:
+        return ffmpeg.output(video, output_path, **main_kwargs, **encode_kwargs)
+    split = video.filter_multi_output('split')
+    shorts_video = shorts_frame(split[1].filter('trim', end_frame=shorts_frames))
+    return ffmpeg.merge_outputs(
+        ffmpeg.output(split[0], output_path, **main_kwargs, **encode_kwargs),
+        ffmpeg.output(shorts_video, shorts_output_path, vframes=shorts_frames, **encode_kwargs),
+    )
+
+
+def render_segment(job, output_kwargs=None):
+    duration = job['frames'] / VIDEO_FPS
+    ass_path = write_word_captions(job['sentences'], f"{os.path.splitext(job['output_path'])[0]}.ass",
+                                   offset_ms=job['start'] * 1000)
+    # hold the last frame if the background runs short, the frame count cuts the segment to its exact length
+    video = background_stream(job['background'], duration).filter('tpad', stop_mode='clone',
+                                                                   stop_duration=duration)
+    video = burn_captions(video, ass_path)
+    shorts_output_path = job['shorts_output_path'] if job.get('shorts_frames') else None
+    try:
+        (
+            rendition_outputs(video, job['output_path'], shorts_output_path, job.get('shorts_frames'),
+                              output_kwargs, vframes=job['frames'])
+            .global_args('-loglevel', 'error')
+            .overwrite_output()
+            .run()
+        )
+    finally:
+        os.remove(ass_path)
+    return job['output_path'], shorts_output_path
+
+
+def concat_segments(segment_paths, audio, video_path, list_path):
+    # the concat demuxer joins the encoded segments as a stream copy, only the audio goes through a filter
+    with open(list_path, 'w') as file:
+        file.writelines(f"file '{path}'\n" for path in segment_paths)
+    video = ffmpeg.input(list_path, f='concat', safe=0).video
+    (
+        ffmpeg
+        .output(video, audio, video_path, vcodec='copy', acodec='aac')
+        .global_args('-loglevel', 'error')
+        .overwrite_output()
+        .run()
+    )
+
+
+def narration(audio_path, duration, trim=False):
+    audio = ffmpeg.input(audio_path).audio.filter('apad', whole_dur=duration)
+    if trim:
+        audio = audio.filter('atrim', duration=duration)
+    return normalize_audio(audio)
+
+
+def render_video_segmented(
+        audio_path,
+        video_path,
+        sentences_list_with_timings,
+        background_videos,
+        disclaimer_video_path,
+        shorts_video_path=None,
+        output_kwargs=None,
+        timer=None,
+        max_workers=RENDER_WORKERS,
+        segment_count=None,
+):
+    from common.disclaimer import append_disclaimer, body_path_for
+    timer = timer or StageTimer()
+    audio_duration = mp3_duration_ms(audio_path) / 1000
+    work_dir = tempfile.mkdtemp(prefix="segments_", dir=os.path.dirname(os.path.abspath(video_path)))
+    try:
+        with timer.stage('background'):
+            jobs, main_duration = plan_render_jobs(sentences_list_with_timings, background_videos, audio_duration,
+                                                   work_dir, segment_count or RENDER_SEGMENTS or max_workers,
+                                                   with_shorts=bool(shorts_video_path))
+        # every segment is an ffmpeg process, threads only wait on them, so share the cores between them
+        output_kwargs = {'threads': max(1, (os.cpu_count() or 1) // min(max_workers, len(jobs))),
+                         **(output_kwargs or {})}
+        print(f"Rendering {len(jobs)} segment(s) with {max_workers} worker(s)...")
+        with timer.stage('encode'), ThreadPoolExecutor(max_workers=max_workers) as executor:
+            rendered = list(executor.map(lambda job: render_segment(job, output_kwargs), jobs))
+
+        print("Joining segments...")
+        with timer.stage('join'):
+            concat_segments([path for path, _ in rendered], narration(audio_path, main_duration),
+                            body_path_for(video_path), os.path.join(work_dir, "segments.txt"))
+        with timer.stage('disclaimer'):
+            append_disclaimer(body_path_for(video_path), disclaimer_video_path, video_path, 'main', output_kwargs)
+        if shorts_video_path:
+            shorts_duration = sum(job['shorts_frames'] for job in jobs) / VIDEO_FPS
+            print(f"Creating YouTube Shorts video of duration {shorts_duration:.2f} seconds...")
+            with timer.stage('join'):
+                concat_segments([path for _, path in rendered if path],
+                                narration(audio_path, shorts_duration, trim=True),
+                                body_path_for(shorts_video_path), os.path.join(work_dir, "shorts_segments.txt"))
+            with timer.stage('disclaimer'):
+                append_disclaimer(body_path_for(shorts_video_path), disclaimer_video_path, shorts_video_path,
+                                  'shorts', output_kwargs)
+            print(f"YouTube Shorts video created at {shorts_video_path}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
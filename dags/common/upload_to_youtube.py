@@ -1,19 +1,49 @@
+import json
 import os
-import sys
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from google.oauth2.credentials import Credentials
-from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
-from googleapiclient.http import MediaFileUpload
+from google.auth.transport.requests import AuthorizedSession, Request
+import requests
 from dotenv import load_dotenv
 
+from common.utils.artifacts import file_sha256
+from common.utils.cache import DiskCache, make_key
+from common.utils.clients import RETRY_ATTEMPTS, backoff_delay, get_connection, rate_limiter
+from common.utils.metrics import in_stage_context, metrics
+
 load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-SCOPES = ['https://www.googleapis.com/auth/youtube.upload']
+# force-ssl covers the videos.update that links the Short to the full video once both are up
+SCOPES = ['https://www.googleapis.com/auth/youtube.upload', 'https://www.googleapis.com/auth/youtube.force-ssl']
+YOUTUBE_UPLOAD_URL = os.getenv('YOUTUBE_UPLOAD_URL', 'https://www.googleapis.com/upload/youtube/v3/videos')
+YOUTUBE_VIDEOS_URL = os.getenv('YOUTUBE_VIDEOS_URL', 'https://www.googleapis.com/youtube/v3/videos')
+UPLOAD_CHUNK_GRANULARITY = 256 * 1024  # every chunk but the last must be a multiple of this
+UPLOAD_CHUNK_SIZE = int(os.getenv('YOUTUBE_UPLOAD_CHUNK_SIZE', 8 * 1024 * 1024))
+UPLOAD_RETRY_ATTEMPTS = int(os.getenv('YOUTUBE_UPLOAD_RETRY_ATTEMPTS', max(RETRY_ATTEMPTS, 8)))
+UPLOAD_TIMEOUT = float(os.getenv('YOUTUBE_UPLOAD_TIMEOUT', 120))
+RETRIABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+RESUME_INCOMPLETE = 308
+
+# resumable sessions live about a week; the state outlives the task so a retry, on any worker, picks it up
+upload_state = DiskCache('youtube_uploads', max_bytes=16 * 1024 * 1024, ttl_seconds=6 * 24 * 3600,
+                         use_s3=os.getenv('YOUTUBE_UPLOAD_STATE_S3', 'true').lower() == 'true')
+
+
+class UploadError(Exception):
+    pass
+
+
+class UploadSessionExpired(UploadError):
+    pass
+
+
+class AuthenticationError(UploadError):
+    pass
 
 
 def authenticate_youtube(conn_id='youtube_api'):
@@ -26,8 +56,7 @@ def authenticate_youtube(conn_id='youtube_api'):
             access_token = os.getenv('access_token')
             token_uri = os.getenv('token_uri', "https://oauth2.googleapis.com/token")
         else:
-            from airflow.hooks.base_hook import BaseHook
-            conn = BaseHook.get_connection(conn_id)
+            conn = get_connection(conn_id)
             extra = conn.extra_dejson
             client_id = extra.get('client_id')
             client_secret = extra.get('client_secret')
@@ -36,8 +65,7 @@ def authenticate_youtube(conn_id='youtube_api'):
             token_uri = extra.get('token_uri', "https://oauth2.googleapis.com/token")
 
         if not client_id or not client_secret or not refresh_token:
-            logger.error('Missing YouTube API credentials.')
-            sys.exit(1)
+            raise AuthenticationError('Missing YouTube API credentials.')
 
         creds = Credentials(
             token=access_token,
@@ -53,15 +81,131 @@ def authenticate_youtube(conn_id='youtube_api'):
             creds.refresh(Request())
 
         return creds
+    except AuthenticationError:
+        raise
     except Exception as e:
-        logger.error(f"Failed to authenticate with YouTube API: {e}")
-        sys.exit(1)
+        # failing the task instead of exiting the worker leaves the retry to Airflow
+        raise AuthenticationError(f"Failed to authenticate with YouTube API: {e}") from e
 
 
-def initialize_upload(youtube, options, is_short=False):
-    print("Uploading video to YouTube...")
+def upload_state_key(file_path, body):
+    # keyed by content, so a retry that downloaded the video again to another path still finds its session
+    return make_key(file_sha256(file_path), body)
+
+
+def load_upload_state(state_key):
+    state = upload_state.get_text(state_key)
+    return json.loads(state) if state else {}
+
+
+def save_upload_state(state_key, state):
+    upload_state.set_text(state_key, json.dumps(state))
+
+
+def parse_range_end(response):
+    # a 308 carries the bytes the server has as "Range: bytes=0-<last byte>", no header means none yet
+    received = response.headers.get('Range')
+    return int(received.rsplit('-', 1)[1]) + 1 if received else 0
+
+
+def check_response(response):
+    # returns the video resource when the upload is complete, the next byte offset while it isn't
+    if response.status_code in (200, 201):
+        return response.json()
+    if response.status_code == RESUME_INCOMPLETE:
+        return parse_range_end(response)
+    if response.status_code in (404, 410):
+        raise UploadSessionExpired(f"Upload session expired ({response.status_code})")
+    if response.status_code in RETRIABLE_STATUS_CODES:
+        raise ConnectionError(f"Retriable HTTP error {response.status_code}")
+    raise UploadError(f"An HTTP error {response.status_code} occurred:\n{response.text}")
+
+
+def start_upload_session(session, file_path, body, upload_url=YOUTUBE_UPLOAD_URL):
+    response = session.post(
+        upload_url,
+        params={'uploadType': 'resumable', 'part': ",".join(body.keys())},
+        json=body,
+        headers={'X-Upload-Content-Length': str(os.path.getsize(file_path)),
+                 'X-Upload-Content-Type': 'video/*'},
+        timeout=UPLOAD_TIMEOUT,
+    )
+    if response.status_code in RETRIABLE_STATUS_CODES:
+        raise ConnectionError(f"Retriable HTTP error {response.status_code}")
+    if response.status_code != 200 or 'Location' not in response.headers:
+        raise UploadError(f"An HTTP error {response.status_code} occurred:\n{response.text}")
+    return response.headers['Location']
+
+
+def query_upload_offset(session, session_uri, total_size):
+    response = session.put(session_uri, headers={'Content-Range': f"bytes */{total_size}"}, timeout=UPLOAD_TIMEOUT)
+    return check_response(response)
+
+
+def send_chunk(session, session_uri, file, offset, chunk_size, total_size):
+    file.seek(offset)
+    chunk = file.read(chunk_size)
+    end = offset + len(chunk) - 1
+    response = session.put(session_uri, data=chunk,
+                           headers={'Content-Range': f"bytes {offset}-{end}/{total_size}"},
+                           timeout=UPLOAD_TIMEOUT)
+    metrics.count('bytes_transferred', len(chunk), service='youtube', direction='upload')
+    return check_response(response)
+
+
+def resumable_upload(session, file_path, body, chunk_size=UPLOAD_CHUNK_SIZE, upload_url=YOUTUBE_UPLOAD_URL,
+                     attempts=UPLOAD_RETRY_ATTEMPTS):
+    # uploads in chunks, asking the server where to continue after every failure; the session URI and the
+    # finished video are kept in upload_state, so a retried task resumes or skips instead of starting over
+    chunk_size = max(UPLOAD_CHUNK_GRANULARITY, chunk_size // UPLOAD_CHUNK_GRANULARITY * UPLOAD_CHUNK_GRANULARITY)
+    total_size = os.path.getsize(file_path)
+    if not total_size:
+        # there's no valid Content-Range for zero bytes, and YouTube would reject the video anyway
+        raise UploadError(f"Nothing to upload, {file_path} is empty")
+    state_key = upload_state_key(file_path, body)
+    state = load_upload_state(state_key)
+    if state.get('video'):
+        print("Video already uploaded in an earlier attempt, skipping...")
+        return state['video']
+
+    limiter = rate_limiter('youtube')
+    failures = 0
+    position = None
+    with open(file_path, 'rb') as file:
+        while True:
+            limiter.acquire()
+            try:
+                if not state.get('session_uri'):
+                    state = {'session_uri': start_upload_session(session, file_path, body, upload_url)}
+                    save_upload_state(state_key, state)
+                    position = 0
+                elif position is None:
+                    position = query_upload_offset(session, state['session_uri'], total_size)
+                    if isinstance(position, int) and position:
+                        print(f"Resuming upload at {position}/{total_size} bytes...")
+                if isinstance(position, int):
+                    position = send_chunk(session, state['session_uri'], file, position, chunk_size, total_size)
+                if isinstance(position, dict):
+                    save_upload_state(state_key, {'video': position})
+                    return position
+                print(f"Uploaded {position}/{total_size} bytes ({position * 100 // total_size}%)")
+                failures = 0
+            except UploadSessionExpired as e:
+                print(f"{e}, starting a new upload session...")
+                state, position = {}, None
+            except (ConnectionError, TimeoutError, requests.exceptions.RequestException) as e:
+                failures += 1
+                if failures >= attempts:
+                    raise
+                delay = backoff_delay(failures - 1)
+                print(f"Upload request failed ({e}), retrying in {delay:.1f}s...")
+                time.sleep(delay)
+                position = None  # ask the server how much it got before sending more
+
+
+def video_body(options):
     tags = options['keywords'].split(',') if options['keywords'] else None
-    body = {
+    return {
         'snippet': {
             'title': options['title'],
             'description': options['description'],
@@ -72,34 +216,58 @@ def initialize_upload(youtube, options, is_short=False):
             'privacyStatus': options['privacyStatus']
         }
     }
+
+
+def initialize_upload(session, options, is_short=False):
+    print("Uploading video to YouTube...")
+    body = video_body(options)
     # if is_short:
     #     body['videoType'] = 'SHORT'
-    try:
-        insert_request = youtube.videos().insert(
-            part=",".join(body.keys()),
-            body=body,
-            media_body=MediaFileUpload(options['file'], chunksize=-1, resumable=True)
-        )
-        response = insert_request.execute()
-        link = f"https://www.youtube.com/watch?v={response['id']}"
-        print(f"Video uploaded successfully: {link}")
-        return link
-    except HttpError as e:
-        logger.error(f"An HTTP error {e.resp.status} occurred:\n{e.content}")
-        sys.exit(1)
+    response = resumable_upload(session, options['file'], body)
+    print(f"Video uploaded successfully: {video_link(response)}")
+    return response
+
 
+def video_link(video):
+    return f"https://www.youtube.com/watch?v={video['id']}"
 
-def upload_youtube_shorts(youtube, options, youtube_shorts_video_path, full_video_link):
+
+def update_video_snippet(session, video_id, options, videos_url=YOUTUBE_VIDEOS_URL, attempts=UPLOAD_RETRY_ATTEMPTS):
+    # an update replaces the whole snippet, so the title, tags and category go along with the description
+    failures = 0
+    while True:
+        rate_limiter('youtube').acquire()
+        try:
+            response = session.put(videos_url, params={'part': 'snippet'},
+                                   json={'id': video_id, 'snippet': video_body(options)['snippet']},
+                                   timeout=UPLOAD_TIMEOUT)
+            if response.status_code in RETRIABLE_STATUS_CODES:
+                raise ConnectionError(f"Retriable HTTP error {response.status_code}")
+            if response.status_code != 200:
+                raise UploadError(f"An HTTP error {response.status_code} occurred:\n{response.text}")
+            return response.json()
+        except (ConnectionError, TimeoutError, requests.exceptions.RequestException) as e:
+            failures += 1
+            if failures >= attempts:
+                raise
+            delay = backoff_delay(failures - 1)
+            print(f"Video update failed ({e}), retrying in {delay:.1f}s...")
+            time.sleep(delay)
+
+
+def youtube_shorts_options(options, youtube_shorts_video_path, full_video_link=None):
+    # the Short goes up before the full video's ID is known, the link is added to its description afterwards
     shorts_options = options.copy()
     shorts_options['file'] = youtube_shorts_video_path
 
     shorts_options['title'] = f"{options['title']} #shorts"
-    shorts_options['description'] = (f"This is only a part from the real video - watch the full video here:\n"
-                                     f"{full_video_link}\n\n#shorts")
+    if full_video_link:
+        shorts_options['description'] = (f"This is only a part from the real video - watch the full video here:\n"
+                                         f"{full_video_link}\n\n#shorts")
+    else:
+        shorts_options['description'] = "This is only a part from the real video.\n\n#shorts"
     shorts_options['keywords'] = options.get('keywords', '') + ',shorts'
-
-    shorts_video_link = initialize_upload(youtube, shorts_options, is_short=True)
-    return shorts_video_link
+    return shorts_options
 
 
 def upload_video_youtube(video_file_path,
@@ -108,13 +276,14 @@ def upload_video_youtube(video_file_path,
                          youtube_shorts_video_path=None,
                          keywords='',
                          category='22',
-                         is_mock=False
+                         is_mock=False,
+                         session=None
                          ):
     privacyStatus = 'public' if not is_mock else 'private'
     video_file_path = os.path.abspath(video_file_path)
 
-    creds = authenticate_youtube()
-    youtube = build('youtube', 'v3', credentials=creds)
+    # the upload endpoint is called directly, so no discovery document is fetched or built
+    session = session or AuthorizedSession(authenticate_youtube())
     options = {
         'file': video_file_path,
         'title': title,
@@ -123,6 +292,21 @@ def upload_video_youtube(video_file_path,
         'keywords': keywords,
         'privacyStatus': privacyStatus
     }
-    full_video_link = initialize_upload(youtube, options)
-    if youtube_shorts_video_path and os.path.exists(youtube_shorts_video_path):
-        upload_youtube_shorts(youtube, options, youtube_shorts_video_path, full_video_link)
+    has_shorts = bool(youtube_shorts_video_path and os.path.exists(youtube_shorts_video_path))
+    shorts_video = None
+    # the Short uploads alongside the full video; leaving the pool waits for it even when the full video fails
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        shorts_future = executor.submit(in_stage_context(initialize_upload), session,
+                                        youtube_shorts_options(options, youtube_shorts_video_path),
+                                        True) if has_shorts else None
+        full_video = initialize_upload(session, options)
+        if shorts_future:
+            shorts_video = shorts_future.result()
+    full_video_link = video_link(full_video)
+    shorts_video_link = None
+    if shorts_video:
+        update_video_snippet(session, shorts_video['id'],
+                             youtube_shorts_options(options, youtube_shorts_video_path, full_video_link))
+        shorts_video_link = video_link(shorts_video)
+        print(f"Linked the Short to the full video: {shorts_video_link}")
+    return full_video_link, shorts_video_link
@@ -0,0 +1,72 @@
+import hashlib
+import json
+import os
+import time
+from typing import Dict, Iterable, Optional
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from common.utils.cache import DiskCache, make_key
+from common.utils.metrics import metrics
+
+TRACKING_PARAMS_PREFIXES = ("utm_", "guc", "_guc", "fbclid", "gclid", "mc_", "ncid", "soc_", ".tsrc", "yptr")
+
+
+def normalize_url(url: str) -> str:
+    parts = urlsplit(url.strip())
+    query = sorted((key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+                   if not key.lower().startswith(TRACKING_PARAMS_PREFIXES))
+    path = parts.path.rstrip('/') or '/'
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), path, urlencode(query), ''))
+
+
+class ArticleStore:
+    def __init__(self,
+                 max_bytes=int(os.getenv('ARTICLE_STORE_MAX_BYTES', 128 * 1024 * 1024)),
+                 ttl_seconds=int(os.getenv('ARTICLE_STORE_TTL_SECONDS', 7 * 24 * 3600)),
+                 use_s3=os.getenv('ARTICLE_STORE_S3', 'true').lower() == 'true'):
+        self.cache = DiskCache('articles', max_bytes=max_bytes, ttl_seconds=ttl_seconds, use_s3=use_s3)
+        self.bytes_saved = 0
+        self.bytes_stored = 0
+        # the hits themselves are counted by the articles cache
+        metrics.register('article_store', lambda: {"bytes_saved": self.bytes_saved, "bytes_stored": self.bytes_stored})
+
+    def get(self, url) -> Optional[dict]:
+        value = self.cache.get(make_key(normalize_url(url)))
+        if value is None:
+            return None
+        self.bytes_saved += len(value)
+        return json.loads(value)
+
+    def put(self, url, text):
+        record = {
+            "url": normalize_url(url),
+            "text": text,
+            "fetched_at": time.time(),
+            "content_hash": hashlib.sha256(text.encode('utf-8')).hexdigest(),
+        }
+        value = json.dumps(record).encode('utf-8')
+        self.bytes_stored += len(value)
+        self.cache.set(make_key(record["url"]), value)
+
+    def get_texts(self, urls: Iterable[str]) -> Dict[str, str]:
+        text_by_link = {}
+        for url in urls:
+            record = self.get(url)
+            if record:
+                text_by_link[url] = record["text"]
+        return text_by_link
+
+    def put_texts(self, text_by_link: Dict[str, Optional[str]]):
+        for url, text in text_by_link.items():
+            # failed fetches are retried on the next run instead of being remembered
+            if text and not text.startswith("Error:"):
+                self.put(url, text)
+
+    def stats(self) -> dict:
+        stats = self.cache.stats()
+        stats["bytes_saved"] = self.bytes_saved
+        stats["bytes_stored"] = self.bytes_stored
+        return stats
+
+
+article_store = ArticleStore()
@@ -0,0 +1,294 @@
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from common.utils.cache import make_key
+from common.utils.clients import get_boto3_client, rate_limiter
+from common.utils.consts import BUCKET_NAME, CACHE_DIR
+from common.utils.metrics import in_stage_context, metrics
+
+# a directory every worker mounts (e.g. a shared volume); when unset, artifacts go to S3
+ARTIFACT_ROOT = os.getenv('ARTIFACT_ROOT')
+ARTIFACT_PREFIX = os.getenv('ARTIFACT_PREFIX', 'runs')
+S3_ENDPOINT_URL = os.getenv('S3_ENDPOINT_URL')  # a local S3 stand-in such as MinIO or moto_server
+ARTIFACT_CONCURRENCY = int(os.getenv('ARTIFACT_CONCURRENCY', 8))
+MULTIPART_THRESHOLD = int(os.getenv('ARTIFACT_MULTIPART_THRESHOLD', 16 * 1024 * 1024))
+MULTIPART_CHUNK_SIZE = int(os.getenv('ARTIFACT_MULTIPART_CHUNK_SIZE', 8 * 1024 * 1024))
+COMPRESS_TEXT = os.getenv('ARTIFACT_COMPRESS_TEXT', 'true').lower() == 'true'
+COMPRESS_MIN_BYTES = 4096
+
+
+def run_prefix(stock_symbol, now_date, is_mock=False):
+    # mock runs get their own tree, so they never resume from or overwrite the real run of the same day
+    return f"{ARTIFACT_PREFIX}/{'mock/' if is_mock else ''}{stock_symbol}/{now_date}"
+
+
+def file_sha256(file_path):
+    sha = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(1024 * 1024), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+class ArtifactStore:
+    """Pipeline artifacts in S3 (or a shared directory) behind a size-bounded local read-through cache.
+
+    A cached copy is only used while its ETag still matches the object's, so rewritten artifacts are never stale.
+    Large files move as multipart uploads and parallel ranged downloads; text can be stored gzip-compressed.
+    """
+
+    def __init__(self,
+                 bucket=BUCKET_NAME,
+                 root=ARTIFACT_ROOT,
+                 endpoint_url=S3_ENDPOINT_URL,
+                 cache_dir=os.path.join(CACHE_DIR, 'artifacts'),
+                 max_cache_bytes=int(os.getenv('ARTIFACT_CACHE_MAX_BYTES', 2 * 1024 * 1024 * 1024)),
+                 max_workers=ARTIFACT_CONCURRENCY,
+                 compress_text=COMPRESS_TEXT):
+        self.bucket = bucket
+        self.root = root
+        self.endpoint_url = endpoint_url
+        self.cache_dir = cache_dir
+        self.max_cache_bytes = max_cache_bytes
+        self.max_workers = max_workers
+        self.compress_text = compress_text
+        self.hits = 0
+        self.misses = 0
+        self.bytes_downloaded = 0
+        self.bytes_uploaded = 0
+        self._lock = threading.Lock()
+        metrics.register('artifact_store', self.stats)
+
+    def client(self):
+        return get_boto3_client('s3', **({'endpoint_url': self.endpoint_url} if self.endpoint_url else {}))
+
+    def transfer_config(self):
+        from boto3.s3.transfer import TransferConfig
+        return TransferConfig(multipart_threshold=MULTIPART_THRESHOLD, multipart_chunksize=MULTIPART_CHUNK_SIZE,
+                              max_concurrency=self.max_workers)
+
+    def _local_path(self, key):
+        return os.path.join(self.root, *key.split('/'))
+
+    def _cache_paths(self, key) -> Tuple[str, str]:
+        name = make_key(self.bucket, key)
+        path = os.path.join(self.cache_dir, name[:2], name)
+        return path, f"{path}.json"
+
+    def _count(self, **deltas):
+        with self._lock:
+            for name, delta in deltas.items():
+                setattr(self, name, getattr(self, name) + delta)
+
+    def _head(self, key) -> Optional[dict]:
+        from botocore.exceptions import ClientError
+        rate_limiter('s3').acquire()
+        try:
+            return self.client().head_object(Bucket=self.bucket, Key=key)
+        except ClientError:
+            return None
+
+    def _read_cache_meta(self, key) -> Optional[dict]:
+        path, meta_path = self._cache_paths(key)
+        try:
+            with open(meta_path) as file:
+                meta = json.load(file)
+        except (FileNotFoundError, ValueError):
+            return None
+        return meta if os.path.exists(path) else None
+
+    def _write_cache(self, key, etag, source_path=None, body=None, content_encoding=None):
+        path, meta_path = self._cache_paths(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        if source_path is not None:
+            shutil.copyfile(source_path, tmp_path)
+        else:
+            with open(tmp_path, 'wb') as file:
+                file.write(body)
+        os.replace(tmp_path, path)
+        tmp_meta_path = f"{meta_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_meta_path, 'w') as file:
+            json.dump({"key": key, "etag": etag, "content_encoding": content_encoding}, file)
+        os.replace(tmp_meta_path, meta_path)
+        self.evict()
+        return path
+
+    def _cached_object(self, key) -> Tuple[str, Optional[str]]:
+        # the local copy is validated with a HEAD request, only a changed or missing object is downloaded
+        head = self._head(key)
+        if head is None:
+            raise FileNotFoundError(f"Artifact {key} not found in {self.bucket}")
+        meta = self._read_cache_meta(key)
+        path, _ = self._cache_paths(key)
+        if meta and meta['etag'] == head['ETag']:
+            self._count(hits=1)
+            os.utime(path, None)  # mtime doubles as the LRU clock
+            return path, meta.get('content_encoding')
+        self._count(misses=1, bytes_downloaded=head['ContentLength'])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.download"
+        rate_limiter('s3').acquire()
+        # objects over the multipart threshold come down as parallel ranged GETs
+        self.client().download_file(self.bucket, key, tmp_path, Config=self.transfer_config())
+        content_encoding = head.get('ContentEncoding')
+        path = self._write_cache(key, head['ETag'], source_path=tmp_path, content_encoding=content_encoding)
+        os.remove(tmp_path)
+        return path, content_encoding
+
+    def put_file(self, file_path, key):
+        sha256 = file_sha256(file_path)
+        if self.root:
+            path = self._local_path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            shutil.copyfile(file_path, tmp_path)
+            os.replace(tmp_path, path)
+            return key
+        rate_limiter('s3').acquire()
+        # upload_file switches to a multipart upload, with parts sent in parallel, above the threshold
+        self.client().upload_file(file_path, self.bucket, key, ExtraArgs={'Metadata': {'sha256': sha256}},
+                                  Config=self.transfer_config())
+        self._count(bytes_uploaded=os.path.getsize(file_path))
+        head = self._head(key)
+        if head:
+            self._write_cache(key, head['ETag'], source_path=file_path)
+        return key
+
+    def get_file(self, key, file_path):
+        os.makedirs(os.path.dirname(os.path.abspath(file_path)), exist_ok=True)
+        if self.root:
+            shutil.copyfile(self._local_path(key), file_path)
+        else:
+            path, _ = self._cached_object(key)
+            shutil.copyfile(path, file_path)
+        return file_path
+
+    def put_text(self, text, key, compress=None):
+        raw = text.encode('utf-8')
+        if self.root:
+            path = self._local_path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'wb') as file:
+                file.write(raw)
+            os.replace(tmp_path, path)
+            return key
+        compress = self.compress_text if compress is None else compress
+        body, extra = raw, {}
+        if compress and len(raw) >= COMPRESS_MIN_BYTES:
+            body, extra = gzip.compress(raw), {'ContentEncoding': 'gzip'}
+        rate_limiter('s3').acquire()
+        # the hash is of the text itself, so it doesn't depend on whether it was compressed
+        response = self.client().put_object(Bucket=self.bucket, Key=key, Body=body,
+                                            Metadata={'sha256': hashlib.sha256(raw).hexdigest()}, **extra)
+        self._count(bytes_uploaded=len(body))
+        self._write_cache(key, response['ETag'], body=body, content_encoding=extra.get('ContentEncoding'))
+        return key
+
+    def get_text(self, key) -> str:
+        if self.root:
+            with open(self._local_path(key), encoding='utf-8') as file:
+                return file.read()
+        path, content_encoding = self._cached_object(key)
+        with open(path, 'rb') as file:
+            body = file.read()
+        if content_encoding == 'gzip':
+            body = gzip.decompress(body)
+        return body.decode('utf-8')
+
+    def put_json(self, data, key, compress=None):
+        return self.put_text(json.dumps(data), key, compress)
+
+    def get_json(self, key):
+        return json.loads(self.get_text(key))
+
+    def get_range(self, key, start, end) -> bytes:
+        # bytes start..end inclusive of the stored object, without fetching the rest of it
+        if self.root:
+            with open(self._local_path(key), 'rb') as file:
+                file.seek(start)
+                return file.read(end - start + 1)
+        rate_limiter('s3').acquire()
+        response = self.client().get_object(Bucket=self.bucket, Key=key, Range=f"bytes={start}-{end}")
+        body = response['Body'].read()
+        self._count(bytes_downloaded=len(body))
+        return body
+
+    def hash(self, key) -> Optional[str]:
+        # sha256 of the stored content, or None when the artifact is missing
+        if self.root:
+            path = self._local_path(key)
+            return file_sha256(path) if os.path.exists(path) else None
+        head = self._head(key)
+        return head.get('Metadata', {}).get('sha256') if head else None
+
+    def _map(self, func, items):
+        items = list(items)
+        if len(items) <= 1:
+            return [func(*item) for item in items]
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(items))) as executor:
+            return list(executor.map(in_stage_context(lambda item: func(*item)), items))
+
+    def put_files(self, items: Iterable[Tuple[str, str]]) -> List[str]:
+        return self._map(self.put_file, items)
+
+    def get_files(self, items: Iterable[Tuple[str, str]]) -> List[str]:
+        return self._map(self.get_file, items)
+
+    def put_texts(self, text_by_key: Dict[str, str]) -> List[str]:
+        return self._map(self.put_text, [(text, key) for key, text in text_by_key.items()])
+
+    def get_texts(self, keys: Iterable[str]) -> Dict[str, str]:
+        keys = list(keys)
+        return dict(zip(keys, self._map(self.get_text, [(key,) for key in keys])))
+
+    def hashes(self, keys: Iterable[str]) -> Dict[str, Optional[str]]:
+        keys = list(keys)
+        return dict(zip(keys, self._map(self.hash, [(key,) for key in keys])))
+
+    def evict(self):
+        entries = []
+        total = 0
+        for root, _, files in os.walk(self.cache_dir):
+            for file_name in files:
+                if file_name.endswith(('.json', '.tmp', '.download')):
+                    continue
+                path = os.path.join(root, file_name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+        if total <= self.max_cache_bytes:
+            return
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_cache_bytes:
+                break
+            for stale_path in (path, f"{path}.json"):
+                try:
+                    os.unlink(stale_path)
+                except OSError:
+                    pass
+            total -= size
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 3) if lookups else 0.0,
+            "bytes_downloaded": self.bytes_downloaded,
+            "bytes_uploaded": self.bytes_uploaded,
+        }
+
+
+artifact_store = ArtifactStore()
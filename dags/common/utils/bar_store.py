@@ -0,0 +1,181 @@
+import datetime
+import fcntl
+import os
+from contextlib import contextmanager
+
+import numpy as np
+
+from common.utils.clients import call_with_retries
+from common.utils.consts import CACHE_DIR, MARKET_TIME_ZONE
+from common.utils.metrics import metrics
+
+BAR_STORE_DIR = os.path.join(CACHE_DIR, 'bars')
+BAR_STORE_RETENTION_DAYS = int(os.getenv('BAR_STORE_RETENTION_DAYS', 30))
+BAR_DTYPE = np.dtype([('time', '<i8'), ('open', '<f8'), ('high', '<f8'), ('low', '<f8'), ('close', '<f8'),
+                      ('volume', '<f8')])
+MAX_INTRADAY_FETCH_DAYS = 7  # Yahoo serves 1-minute bars in spans of at most 7 days
+PREMARKET_START = datetime.time(4, 0)
+
+
+class BarStore:
+    """Append-only 1-minute bars per symbol, stored as fixed-size records and read back as a memory map.
+
+    Timestamps are epoch seconds in ascending order, so a time window is two binary searches.
+    """
+
+    def __init__(self, directory=BAR_STORE_DIR, retention_days=BAR_STORE_RETENTION_DAYS):
+        self.directory = directory
+        self.retention_days = retention_days
+        self.bars_downloaded = 0
+        metrics.register('bar_store', lambda: {"bars_downloaded": self.bars_downloaded})
+
+    def _path(self, stock_symbol):
+        return os.path.join(self.directory, f"{stock_symbol.upper()}_1m.bin")
+
+    @contextmanager
+    def _locked(self, stock_symbol):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(f"{self._path(stock_symbol)}.lock", 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def bars(self, stock_symbol) -> np.ndarray:
+        path = self._path(stock_symbol)
+        if not os.path.exists(path) or os.path.getsize(path) < BAR_DTYPE.itemsize:
+            return np.empty(0, dtype=BAR_DTYPE)
+        return np.memmap(path, dtype=BAR_DTYPE, mode='r', shape=(os.path.getsize(path) // BAR_DTYPE.itemsize,))
+
+    def last_time(self, stock_symbol):
+        bars = self.bars(stock_symbol)
+        return int(bars['time'][-1]) if len(bars) else None
+
+    @staticmethod
+    def fetch(stock_symbol, start=None) -> np.ndarray:
+        import yfinance as yf
+        history_kwargs = {'start': start} if start else {'period': '5d'}
+        stock_data = call_with_retries('yfinance', yf.Ticker(stock_symbol).history,
+                                       interval="1m", prepost=True, **history_kwargs)
+        return bars_from_history(stock_data)
+
+    def append(self, stock_symbol, new_bars):
+        # the newest stored bar may have been still forming when it was fetched, so bars from the first new
+        # timestamp on are replaced, everything before it is kept as is
+        if not len(new_bars):
+            return
+        path = self._path(stock_symbol)
+        bars = self.bars(stock_symbol)
+        keep = int(np.searchsorted(bars['time'], new_bars['time'][0], side='left'))
+        oldest = new_bars['time'][-1] - self.retention_days * 24 * 3600
+        if len(bars) and bars['time'][0] < oldest:
+            # past the retention window, rewrite the file without the old bars
+            kept = np.array(bars[int(np.searchsorted(bars['time'], oldest)):keep])
+            del bars
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            np.concatenate([kept, new_bars]).tofile(tmp_path)
+            os.replace(tmp_path, path)
+            return
+        del bars
+        with open(path, 'ab') as file:
+            file.truncate(keep * BAR_DTYPE.itemsize)
+            file.write(new_bars.tobytes())
+
+    def fetch_start(self, stock_symbol, now):
+        last_time = self.last_time(stock_symbol)
+        if last_time and now.timestamp() - last_time < MAX_INTRADAY_FETCH_DAYS * 24 * 3600 - 60:
+            return datetime.datetime.fromtimestamp(last_time, datetime.timezone.utc)
+        return None
+
+    def update(self, stock_symbol, now=None):
+        now = now or datetime.datetime.now(datetime.timezone.utc)
+        with self._locked(stock_symbol):
+            new_bars = self.fetch(stock_symbol, self.fetch_start(stock_symbol, now))
+            self.bars_downloaded += len(new_bars)
+            print(f"Bar store: {len(new_bars)} bar(s) downloaded for {stock_symbol}")
+            self.append(stock_symbol, new_bars)
+
+    @staticmethod
+    def fetch_many(stock_symbols, start=None) -> dict:
+        import yfinance as yf
+        history_kwargs = {'start': start} if start else {'period': '5d'}
+        # one multi-ticker request, yfinance fetches the symbols on its own threads
+        stock_data = call_with_retries('yfinance', yf.download, list(stock_symbols), interval="1m", prepost=True,
+                                       group_by='ticker', auto_adjust=True, threads=True, progress=False,
+                                       **history_kwargs)
+        bars_by_symbol = {}
+        for stock_symbol in stock_symbols:
+            frame = None
+            if stock_data is not None and not stock_data.empty:
+                if stock_data.columns.nlevels == 1:
+                    frame = stock_data
+                elif stock_symbol in stock_data.columns.get_level_values(0):
+                    frame = stock_data[stock_symbol]
+            bars_by_symbol[stock_symbol] = bars_from_history(frame)
+        return bars_by_symbol
+
+    def update_many(self, stock_symbols, now=None):
+        # the whole watchlist in one download, starting from the oldest bar any of the symbols is missing;
+        # symbols that already had the overlapping bars just get them replaced
+        now = now or datetime.datetime.now(datetime.timezone.utc)
+        starts = [self.fetch_start(stock_symbol, now) for stock_symbol in stock_symbols]
+        start = None if None in starts else min(starts)
+        new_bars_by_symbol = self.fetch_many(stock_symbols, start)
+        for stock_symbol, new_bars in new_bars_by_symbol.items():
+            with self._locked(stock_symbol):
+                self.append(stock_symbol, new_bars)
+            self.bars_downloaded += len(new_bars)
+        print(f"Bar store: {sum(len(bars) for bars in new_bars_by_symbol.values())} bar(s) downloaded for "
+              f"{len(new_bars_by_symbol)} symbol(s)")
+
+    def window(self, stock_symbol, start, end, refresh=True) -> np.ndarray:
+        # bars with start <= time <= end, fetching only what's newer than the stored bars when they don't reach end
+        last_time = self.last_time(stock_symbol)
+        if refresh and (last_time is None or last_time < end.timestamp()):
+            self.update(stock_symbol)
+        bars = self.bars(stock_symbol)
+        times = bars['time']
+        first = int(np.searchsorted(times, start.timestamp(), side='left'))
+        last = int(np.searchsorted(times, end.timestamp(), side='right'))
+        return np.array(bars[first:last])
+
+
+def bars_from_history(stock_data) -> np.ndarray:
+    if stock_data is not None:
+        # a multi-ticker download aligns every symbol on the same index, leaving gaps as NaN rows
+        stock_data = stock_data.dropna(subset=['Close'])
+    if stock_data is None or stock_data.empty:
+        return np.empty(0, dtype=BAR_DTYPE)
+    bars = np.empty(len(stock_data), dtype=BAR_DTYPE)
+    bars['time'] = np.asarray(stock_data.index.tz_convert('UTC').tz_localize(None),
+                              dtype='datetime64[s]').astype(np.int64)
+    for column in ('open', 'high', 'low', 'close', 'volume'):
+        bars[column] = stock_data[column.capitalize()].to_numpy(dtype=np.float64)
+    return bars[np.argsort(bars['time'], kind='stable')]
+
+
+def premarket_stats(bars, next_time_open) -> dict:
+    # bars run from the last close to the next open; the pre-market part starts at 4:00 AM on the open day
+    premarket_start = MARKET_TIME_ZONE.localize(datetime.datetime.combine(next_time_open.date(), PREMARKET_START))
+    premarket = bars[bars['time'] >= premarket_start.timestamp()]
+    previous_close = float(bars['open'][0])
+    last_price = float(bars['close'][-1])
+    volume = bars['volume']
+    typical_price = (bars['high'] + bars['low'] + bars['close']) / 3
+    log_returns = np.diff(np.log(bars['close'][bars['close'] > 0]))
+    return {
+        "previous_close": previous_close,
+        "open_price": float(bars['open'][-1]),
+        "last_price": last_price,
+        "gap_percent": (last_price / previous_close - 1) * 100 if previous_close else 0.0,
+        "vwap": float((typical_price * volume).sum() / volume.sum()) if volume.sum() else None,
+        "premarket_high": float(premarket['high'].max()) if len(premarket) else None,
+        "premarket_low": float(premarket['low'].min()) if len(premarket) else None,
+        "premarket_volume": int(premarket['volume'].sum()),
+        "realized_volatility_percent": float(np.sqrt(np.square(log_returns).sum()) * 100),
+        "bars": len(bars),
+    }
+
+
+bar_store = BarStore()
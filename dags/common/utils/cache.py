@@ -0,0 +1,181 @@
+import hashlib
+import json
+import os
+import struct
+import threading
+import time
+from typing import Optional
+
+from common.utils.clients import get_boto3_client, rate_limiter
+from common.utils.consts import BUCKET_NAME, CACHE_DIR
+from common.utils.metrics import metrics
+
+HEADER = struct.Struct("<d")  # expiry timestamp, 0 means the entry never expires
+# writes between directory scans; other processes sharing the directory are only noticed by a scan
+EVICT_EVERY_WRITES = int(os.getenv('CACHE_EVICT_EVERY_WRITES', 256))
+
+
+def make_key(*parts) -> str:
+    payload = json.dumps(parts, sort_keys=True, default=str, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class DiskCache:
+    """Content-addressed bytes cache: a size-bounded LRU directory on local disk, optionally backed by S3."""
+
+    def __init__(self, name, max_bytes=256 * 1024 * 1024, ttl_seconds=None, use_s3=False, cache_dir=CACHE_DIR):
+        self.name = name
+        self.directory = os.path.join(cache_dir, name)
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.use_s3 = use_s3
+        self.hits = 0
+        self.s3_hits = 0
+        self.misses = 0
+        # running estimate of the directory size, so a write doesn't need to walk the whole tree
+        self._size_estimate = None
+        self._writes_since_scan = 0
+        self._lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+        metrics.register(f"{name}_cache", self.stats)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def _s3_key(self, key):
+        return f"cache/{self.name}/{key}"
+
+    @staticmethod
+    def _unpack(blob) -> Optional[bytes]:
+        if len(blob) < HEADER.size:
+            return None
+        expires_at, = HEADER.unpack_from(blob)
+        if expires_at and expires_at < time.time():
+            return None
+        return blob[HEADER.size:]
+
+    def _pack(self, value: bytes, ttl_seconds) -> bytes:
+        ttl_seconds = self.ttl_seconds if ttl_seconds is None else ttl_seconds
+        expires_at = time.time() + ttl_seconds if ttl_seconds else 0
+        return HEADER.pack(expires_at) + value
+
+    def _write_local(self, key, blob):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as file:
+            file.write(blob)
+        os.replace(tmp_path, path)
+
+    def _read_local(self, key) -> Optional[bytes]:
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as file:
+                blob = file.read()
+        except FileNotFoundError:
+            return None
+        value = self._unpack(blob)
+        if value is None:
+            self._remove(path)
+            return None
+        # mtime doubles as the LRU clock
+        os.utime(path, None)
+        return value
+
+    def _read_s3(self, key) -> Optional[bytes]:
+        try:
+            rate_limiter('s3').acquire()
+            blob = get_boto3_client('s3').get_object(Bucket=BUCKET_NAME, Key=self._s3_key(key))['Body'].read()
+        except Exception:
+            return None
+        value = self._unpack(blob)
+        if value is not None:
+            self._write_local(key, blob)
+        return value
+
+    def _write_s3(self, key, blob):
+        try:
+            rate_limiter('s3').acquire()
+            get_boto3_client('s3').put_object(Bucket=BUCKET_NAME, Key=self._s3_key(key), Body=blob)
+        except Exception as e:
+            print(f"Failed to write cache entry {self._s3_key(key)} to S3: {e}")
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+    def get(self, key) -> Optional[bytes]:
+        value = self._read_local(key)
+        if value is None and self.use_s3:
+            value = self._read_s3(key)
+            if value is not None:
+                with self._lock:
+                    self.s3_hits += 1
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key, value: bytes, ttl_seconds=None):
+        blob = self._pack(value, ttl_seconds)
+        self._write_local(key, blob)
+        if self.use_s3:
+            self._write_s3(key, blob)
+        with self._lock:
+            self._writes_since_scan += 1
+            if self._size_estimate is not None:
+                self._size_estimate += len(blob)
+            should_evict = (self._size_estimate is None or self._size_estimate > self.max_bytes or
+                            self._writes_since_scan >= EVICT_EVERY_WRITES)
+        if should_evict:
+            self.evict()
+
+    def get_text(self, key) -> Optional[str]:
+        value = self.get(key)
+        return value.decode('utf-8') if value is not None else None
+
+    def set_text(self, key, value: str, ttl_seconds=None):
+        self.set(key, value.encode('utf-8'), ttl_seconds)
+
+    def evict(self):
+        entries = []
+        total = 0
+        for root, _, files in os.walk(self.directory):
+            for file_name in files:
+                # temp files belong to writes in flight, removing one would fail that writer's os.replace
+                if file_name.endswith('.tmp'):
+                    continue
+                path = os.path.join(root, file_name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+        if total > self.max_bytes:
+            # down to 90% of the limit, so the next writes don't trigger another scan right away
+            target = self.max_bytes * 0.9
+            entries.sort()
+            for _, size, path in entries:
+                if total <= target:
+                    break
+                self._remove(path)
+                total -= size
+        with self._lock:
+            self._size_estimate = total
+            self._writes_since_scan = 0
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "name": self.name,
+            "hits": self.hits,
+            "s3_hits": self.s3_hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 3) if lookups else 0.0,
+        }
@@ -0,0 +1,67 @@
+import datetime
+import os
+from typing import Optional
+
+from common.utils.artifacts import artifact_store
+from common.utils.cache import make_key
+
+USE_CHECKPOINTS = os.getenv('USE_CHECKPOINTS', 'true').lower() == 'true'
+CHECKPOINT_STAGES = ['stock_info', 'script', 'description', 'tts', 'video_matches', 'render', 'shorts', 'upload']
+
+
+class RunCheckpoint:
+    """Per-run manifest of stage outputs, keyed by (symbol, trading date, mock) through the run's artifact prefix.
+
+    Every stage has its own entry, so stages running in parallel tasks never overwrite each other's.
+    """
+
+    def __init__(self, run, enabled=USE_CHECKPOINTS):
+        self.prefix = run['prefix']
+        self.identity = [run['stock_symbol'], run['company_name'], run['is_mock']]
+        self.enabled = enabled
+
+    def _key(self, stage):
+        return f"{self.prefix}/checkpoints/{stage}.json"
+
+    def load(self, stage) -> Optional[dict]:
+        try:
+            return artifact_store.get_json(self._key(stage))
+        except Exception:
+            return None
+
+    def manifest(self) -> dict:
+        return {stage: self.load(stage) for stage in CHECKPOINT_STAGES}
+
+    def inputs_hash(self, stage, upstream, config):
+        # upstream manifests carry the content hashes of their artifacts, so a changed script invalidates
+        # everything made from it even though the artifact keys stay the same
+        return make_key(stage, self.identity, [manifest.get('hashes', manifest) for manifest in upstream], config)
+
+    def is_artifact(self, value):
+        return isinstance(value, str) and value.startswith(f"{self.prefix}/")
+
+    @staticmethod
+    def is_valid(entry, inputs_hash) -> bool:
+        if not entry or entry.get('inputs_hash') != inputs_hash:
+            return False
+        recorded = entry['outputs'].get('hashes', {})
+        return artifact_store.hashes(recorded) == recorded
+
+    def run(self, stage, func, upstream=(), config=None) -> dict:
+        inputs_hash = self.inputs_hash(stage, upstream, config)
+        if self.enabled:
+            entry = self.load(stage)
+            if self.is_valid(entry, inputs_hash):
+                print(f"Checkpoint for '{stage}' is valid, skipping the stage...")
+                return entry['outputs']
+            print(f"Checkpoint for '{stage}' is {'stale' if entry else 'missing'}, running the stage...")
+        outputs = func()
+        outputs['hashes'] = artifact_store.hashes(value for value in outputs.values() if self.is_artifact(value))
+        if self.enabled:
+            artifact_store.put_json({
+                "stage": stage,
+                "inputs_hash": inputs_hash,
+                "outputs": outputs,
+                "completed_at": datetime.datetime.utcnow().isoformat(),
+            }, self._key(stage))
+        return outputs
@@ -0,0 +1,164 @@
+import asyncio
+import os
+import random
+import threading
+import time
+from functools import lru_cache
+
+from dotenv import load_dotenv
+
+from common.utils.metrics import metrics
+
+load_dotenv()
+
+RETRY_ATTEMPTS = int(os.getenv('CLIENT_RETRY_ATTEMPTS', 4))
+RETRY_BASE_DELAY = float(os.getenv('CLIENT_RETRY_BASE_DELAY', 1.0))
+RETRY_MAX_DELAY = float(os.getenv('CLIENT_RETRY_MAX_DELAY', 30.0))
+MAX_POOL_CONNECTIONS = int(os.getenv('CLIENT_MAX_POOL_CONNECTIONS', 20))
+# requests per second for each external service, override with e.g. RATE_LIMIT_OPENAI=5
+RATE_LIMITS = {
+    'openai': float(os.getenv('RATE_LIMIT_OPENAI', 10)),
+    'polly': float(os.getenv('RATE_LIMIT_POLLY', 8)),
+    's3': float(os.getenv('RATE_LIMIT_S3', 100)),
+    'youtube': float(os.getenv('RATE_LIMIT_YOUTUBE', 5)),
+}
+
+_lock = threading.Lock()
+_clients = {}
+_rate_limiters = {}
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None, service=None):
+        self.service = service
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, tokens=1) -> float:
+        # takes the tokens now (possibly going negative) and returns how long the caller has to wait for them;
+        # every request to an external service goes through here, which makes it the place to count them
+        metrics.count('external_calls', tokens, service=self.service)
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= tokens
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def acquire(self, tokens=1):
+        wait = self.reserve(tokens)
+        if wait:
+            time.sleep(wait)
+
+    async def acquire_async(self, tokens=1):
+        wait = self.reserve(tokens)
+        if wait:
+            await asyncio.sleep(wait)
+
+
+def rate_limiter(service) -> TokenBucket:
+    with _lock:
+        if service not in _rate_limiters:
+            _rate_limiters[service] = TokenBucket(RATE_LIMITS.get(service, 10), service=service)
+        return _rate_limiters[service]
+
+
+def backoff_delay(attempt) -> float:
+    return min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+
+def call_with_retries(service, func, *args, retry_on=(Exception,), attempts=RETRY_ATTEMPTS, **kwargs):
+    limiter = rate_limiter(service)
+    for attempt in range(attempts):
+        limiter.acquire()
+        try:
+            return func(*args, **kwargs)
+        except retry_on as e:
+            if attempt == attempts - 1:
+                raise
+            delay = backoff_delay(attempt)
+            metrics.count('external_call_retries', service=service)
+            print(f"{service} call failed ({e}), retrying in {delay:.1f}s...")
+            time.sleep(delay)
+
+
+@lru_cache(maxsize=None)
+def get_connection(conn_id):
+    # one metadata-DB lookup per connection per task process
+    from airflow.hooks.base_hook import BaseHook
+    return BaseHook.get_connection(conn_id)
+
+
+def _get_or_create(key, factory):
+    with _lock:
+        if key not in _clients:
+            _clients[key] = factory()
+        return _clients[key]
+
+
+def get_aws_credentials(conn_id='aws_default') -> dict:
+    if os.environ.get("LOCAL"):
+        aws_access_key_id = os.getenv('AWS_ACCESS_KEY_ID')
+        aws_secret_access_key = os.getenv('AWS_SECRET_ACCESS_KEY')
+        region_name = os.getenv('AWS_REGION_NAME', 'us-east-1')
+    else:
+        conn = get_connection(conn_id)
+        extra = conn.extra_dejson or {}
+        aws_access_key_id = conn.login
+        aws_secret_access_key = conn.password
+        region_name = extra.get('region_name', 'us-east-1')
+    return dict(aws_access_key_id=aws_access_key_id,
+                aws_secret_access_key=aws_secret_access_key,
+                region_name=region_name)
+
+
+def get_aws_session(conn_id='aws_default'):
+    import boto3
+    return _get_or_create(('aws_session', conn_id), lambda: boto3.Session(**get_aws_credentials(conn_id)))
+
+
+def get_boto3_client(service, conn_id='aws_default', **client_kwargs):
+    from botocore.config import Config
+    config = Config(retries={'max_attempts': RETRY_ATTEMPTS, 'mode': 'adaptive'},
+                    max_pool_connections=MAX_POOL_CONNECTIONS)
+    session = get_aws_session(conn_id)
+    # boto3 clients are thread safe once created, but creating them from a shared session is not
+    return _get_or_create(('boto3', service, conn_id, tuple(sorted(client_kwargs.items()))),
+                          lambda: session.client(service, config=config, **client_kwargs))
+
+
+def get_openai_credentials(conn_id='openai_default') -> dict:
+    if os.environ.get("LOCAL"):
+        organization = os.getenv('OPEN_AI_ORGANIZATION_ID')
+        project = os.getenv('OPEN_AI_PROJECT_ID')
+        api_key = os.getenv('OPEN_AI_TOKEN')
+    else:
+        conn = get_connection(conn_id)
+        extra = conn.extra_dejson
+        organization = extra.get('organization')
+        project = extra.get('project')
+        api_key = extra.get('api_key')
+    return dict(organization=organization, project=project, api_key=api_key)
+
+
+def get_openai_client(conn_id='openai_default'):
+    from openai import OpenAI
+    return _get_or_create(('openai', conn_id),
+                          lambda: OpenAI(max_retries=RETRY_ATTEMPTS, **get_openai_credentials(conn_id)))
+
+
+def get_async_openai_client(conn_id='openai_default'):
+    # the async client's connection pool is bound to the running event loop, so it is shared per loop
+    from openai import AsyncOpenAI
+    loop = asyncio.get_running_loop()
+    return _get_or_create(('async_openai', conn_id, id(loop)),
+                          lambda: AsyncOpenAI(max_retries=RETRY_ATTEMPTS, **get_openai_credentials(conn_id)))
+
+
+def release_async_openai_client(conn_id='openai_default'):
+    loop = asyncio.get_running_loop()
+    with _lock:
+        return _clients.pop(('async_openai', conn_id, id(loop)), None)
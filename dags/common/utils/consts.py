@@ -1,5 +1,12 @@
+import os
+import tempfile
+
 import pytz
 
 MARKET_TIME_ZONE = pytz.timezone('US/Eastern')
 BUCKET_NAME = "ai-stock-insights"
-DISCLAIMER_VIDEO_TEXT = "Disclaimer: This video contains an AI-generated estimate and is for informational purposes only. It is not intended as financial advice and should not be used for real-life investment decisions."
\ No newline at end of file
+DESIRED_WIDTH, DESIRED_HEIGHT = 1920, 1080
+VIDEO_FPS = 24
+DISCLAIMER_VIDEO_TEXT = "Disclaimer: This video contains an AI-generated estimate and is for informational purposes only. It is not intended as financial advice and should not be used for real-life investment decisions."
+
+CACHE_DIR = os.getenv('CACHE_DIR', os.path.join(tempfile.gettempdir(), 'ai_stock_insights_cache'))
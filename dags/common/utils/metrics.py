@@ -0,0 +1,338 @@
+import contextvars
+import datetime
+import json
+import os
+import re
+import resource
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Callable, Dict
+
+from common.utils.consts import CACHE_DIR
+
+METRICS_ENABLED = os.getenv('PIPELINE_METRICS_ENABLED', 'true').lower() == 'true'
+METRICS_DIR = os.getenv('PIPELINE_METRICS_DIR', os.path.join(CACHE_DIR, 'metrics'))
+# node_exporter's textfile collector directory; no Prometheus file is written when unset
+PROMETHEUS_TEXTFILE_DIR = os.getenv('PROMETHEUS_TEXTFILE_DIR')
+METRIC_PREFIX = 'daily_stock_analysis'
+_NULL_SPAN = nullcontext()
+# the stage the calling code runs under; asyncio tasks inherit it, pool threads get it through in_stage_context()
+_current_stage = contextvars.ContextVar('metrics_stage', default=None)
+
+
+def cpu_seconds():
+    # the whole process plus the subprocesses it waited for (ffmpeg, the browser), so threads are included too
+    times = os.times()
+    return times.user + times.system, times.children_user + times.children_system
+
+
+def peak_rss_mb():
+    # high-water mark of the process and of its largest child, ru_maxrss is in kilobytes on Linux
+    peak_kb = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                  resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return round(peak_kb / 1024, 1)
+
+
+def stats_delta(before, after) -> dict:
+    # the stores count from process start, a stage only owns what changed while it ran
+    delta = {key: value - before.get(key, 0) for key, value in after.items()
+             if isinstance(value, (int, float)) and not isinstance(value, bool) and key != 'hit_ratio'}
+    if 'hits' in delta and 'misses' in delta:
+        lookups = delta['hits'] + delta['misses']
+        delta['hit_ratio'] = round(delta['hits'] / lookups, 3) if lookups else None
+    return delta
+
+
+def in_stage_context(func):
+    # for work handed to a thread pool: runs func under the submitting code's stage, each call in its own copy of
+    # the context because one context can't be entered by several threads at once
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.copy().run(func, *args, **kwargs)
+
+
+class PipelineMetrics:
+    """Spans (wall/CPU time, peak RSS) and counters (external calls, tokens, bytes) for one task process.
+
+    Every stage produces a report of what happened while it ran, together with the change in the hit and byte
+    counts of the caches and stores registered as sources. Counters and spans are attributed to the active stage of
+    the calling context, so stages running side by side in one process keep their own; the sources are process-wide,
+    a report lists the stages that overlapped it. When disabled, span() hands back a shared no-op context and count()
+    returns right away, so the call sites cost next to nothing.
+    """
+
+    def __init__(self, enabled=METRICS_ENABLED):
+        self.enabled = enabled
+        self.spans = []
+        self.counters = {}
+        self.sources: Dict[str, Callable[[], dict]] = {}
+        self.active_stages: Dict[str, set] = {}  # running stage -> the stages that ran alongside it
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def register(self, name, stats):
+        # stats() returns the source's cumulative counters, it's only called at stage boundaries
+        self.sources[name] = stats
+
+    def current_stage(self):
+        stage = _current_stage.get()
+        if stage is None and len(self.active_stages) == 1:
+            # a thread started without the stage's context, but there's only one stage it can belong to
+            stage = next(iter(self.active_stages), None)
+        return stage
+
+    def count(self, name, value=1, **labels):
+        if not self.enabled or not value:
+            return
+        key = (self.current_stage(), name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def span(self, name):
+        if not self.enabled:
+            return _NULL_SPAN
+        return self._span(name)
+
+    @contextmanager
+    def _span(self, name):
+        stack = self._local.__dict__.setdefault('stack', [])
+        stack.append(name)
+        path = '/'.join(stack)
+        stage = self.current_stage()
+        started_at = time.time()
+        start, (cpu, child_cpu), peak = time.perf_counter(), cpu_seconds(), peak_rss_mb()
+        failed = False
+        try:
+            yield
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            end_cpu, end_child_cpu = cpu_seconds()
+            end_peak = peak_rss_mb()
+            stack.pop()
+            with self._lock:
+                self.spans.append({
+                    "stage": stage,
+                    "span": path,
+                    "started_at": started_at,
+                    "wall_seconds": round(time.perf_counter() - start, 3),
+                    "cpu_seconds": round(end_cpu - cpu, 3),
+                    "child_cpu_seconds": round(end_child_cpu - child_cpu, 3),
+                    "peak_rss_mb": end_peak,
+                    "peak_rss_growth_mb": round(end_peak - peak, 1),
+                    "failed": failed,
+                })
+
+    def snapshot(self) -> dict:
+        sources = {}
+        for name, stats in self.sources.items():
+            try:
+                sources[name] = stats()
+            except Exception as e:
+                print(f"Metrics: couldn't read {name} stats ({e})")
+        with self._lock:
+            return {"counters": dict(self.counters), "sources": sources, "spans": len(self.spans)}
+
+    def report_since(self, before, stage, run, status, overlapping) -> dict:
+        after = self.snapshot()
+        counters = []
+        for (counter_stage, name, labels), value in after['counters'].items():
+            if counter_stage != stage:
+                continue
+            delta = value - before['counters'].get((counter_stage, name, labels), 0)
+            if delta:
+                counters.append({"name": name, "labels": dict(labels), "value": delta})
+        return {
+            "stage": stage,
+            "stock_symbol": run['stock_symbol'],
+            "prefix": run['prefix'],
+            "status": status,
+            "finished_at": datetime.datetime.utcnow().isoformat(),
+            "spans": [span for span in self.spans[before['spans']:after['spans']] if span['stage'] == stage],
+            "counters": counters,
+            # cache and store counters are shared by the process, they include the overlapping stages' lookups
+            "sources": {name: stats_delta(before['sources'].get(name, {}), stats)
+                        for name, stats in after['sources'].items()},
+            "overlapping_stages": sorted(overlapping),
+        }
+
+    @contextmanager
+    def stage(self, stage, run):
+        if not self.enabled:
+            yield
+            return
+        before = self.snapshot()
+        token = _current_stage.set(stage)
+        with self._lock:
+            overlapping = self.active_stages[stage] = set(self.active_stages)
+            for other in overlapping:
+                self.active_stages[other].add(stage)
+        status = 'failed'
+        try:
+            with self.span(stage):
+                yield
+            status = 'success'
+        finally:
+            _current_stage.reset(token)
+            with self._lock:
+                overlapping = self.active_stages.pop(stage)
+            try:
+                publish_stage_report(self.report_since(before, stage, run, status, overlapping), run)
+            except Exception as e:
+                # metrics never fail a stage
+                print(f"Metrics: couldn't publish the '{stage}' report ({e})")
+
+
+def metric_name(name):
+    return re.sub(r'[^a-zA-Z0-9_]', '_', name).lower()
+
+
+def prometheus_labels(labels) -> str:
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"') for value in labels.values())
+    return '{' + ','.join(f'{key}="{value}"' for key, value in zip(labels, escaped)) + '}'
+
+
+def prometheus_text(report) -> str:
+    samples = {}
+
+    def add(name, help_text, labels, value):
+        if value is not None:
+            samples.setdefault(f"{METRIC_PREFIX}_{metric_name(name)}", (help_text, []))[1].append((labels, value))
+
+    base_labels = {"stage": report['stage'], "stock_symbol": report['stock_symbol']}
+    add('stage_success', "1 when the stage finished, 0 when it failed", base_labels,
+        int(report['status'] == 'success'))
+    add('stage_finished_timestamp_seconds', "When the stage report was written", base_labels, time.time())
+    # a span that ran several times is one sample per metric: times add up, the peak is the highest
+    by_path = {}
+    for span in report['spans']:
+        total = by_path.setdefault(span['span'], dict.fromkeys(('wall_seconds', 'cpu_seconds', 'child_cpu_seconds',
+                                                                 'peak_rss_mb'), 0))
+        for key in ('wall_seconds', 'cpu_seconds', 'child_cpu_seconds'):
+            total[key] = round(total[key] + span[key], 3)
+        total['peak_rss_mb'] = max(total['peak_rss_mb'], span['peak_rss_mb'])
+    for path, total in by_path.items():
+        labels = {**base_labels, "span": path}
+        add('span_wall_seconds', "Wall time of the span", labels, total['wall_seconds'])
+        add('span_cpu_seconds', "CPU time of the process during the span", labels, total['cpu_seconds'])
+        add('span_child_cpu_seconds', "CPU time of subprocesses that finished during the span", labels,
+            total['child_cpu_seconds'])
+        add('span_peak_rss_megabytes', "Peak resident set size at the end of the span", labels, total['peak_rss_mb'])
+    for counter in report['counters']:
+        add(counter['name'], f"{counter['name']} during the stage", {**base_labels, **counter['labels']},
+            counter['value'])
+    for source, stats in report['sources'].items():
+        for key, value in stats.items():
+            add(f"source_{key}", f"{key} of the cache or store during the stage", {**base_labels, "source": source},
+                value)
+    lines = []
+    for name, (help_text, values) in samples.items():
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+        lines += [f"{name}{prometheus_labels(labels)} {value}" for labels, value in values]
+    return '\n'.join(lines) + '\n'
+
+
+def write_atomic(path, text):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as file:
+        file.write(text)
+    # the textfile collector must never read a half-written file
+    os.replace(tmp_path, path)
+
+
+def report_key(run, stage):
+    return f"{run['prefix']}/metrics/{stage}.json"
+
+
+def format_counter(counter) -> str:
+    labels = ','.join(f"{key}={value}" for key, value in sorted(counter['labels'].items()))
+    return f"{counter['name']}{{{labels}}}={counter['value']}" if labels else f"{counter['name']}={counter['value']}"
+
+
+def summary(report) -> str:
+    spans = report['spans']
+    root = next((span for span in spans if span['span'] == report['stage']), None)
+    lines = [f"Metrics [{report['stage']}] {report['status']}" + (
+        f": wall {root['wall_seconds']:.1f}s, cpu {root['cpu_seconds']:.1f}s "
+        f"(+{root['child_cpu_seconds']:.1f}s in subprocesses), peak RSS {root['peak_rss_mb']:.0f} MB" if root else '')]
+    if report.get('overlapping_stages'):
+        lines.append(f"  ran alongside {', '.join(report['overlapping_stages'])} (cache and store counts are shared)")
+    for span in spans:
+        if span is not root:
+            lines.append(f"  {span['span']}: {span['wall_seconds']:.2f}s wall, {span['cpu_seconds']:.2f}s cpu")
+    if report['counters']:
+        lines.append("  " + ", ".join(sorted(format_counter(counter) for counter in report['counters'])))
+    for source, stats in report['sources'].items():
+        if any(stats.values()):
+            lines.append(f"  {source}: " + ", ".join(f"{key}={value}" for key, value in stats.items()))
+    return '\n'.join(lines)
+
+
+def publish_stage_report(report, run):
+    from common.utils.artifacts import artifact_store
+    stage, stock_symbol = report['stage'], report['stock_symbol']
+    text = json.dumps(report, indent=2)
+    write_atomic(os.path.join(METRICS_DIR, *run['prefix'].split('/'), f"{stage}.json"), text)
+    if PROMETHEUS_TEXTFILE_DIR:
+        write_atomic(os.path.join(PROMETHEUS_TEXTFILE_DIR, f"{METRIC_PREFIX}_{stock_symbol}_{stage}.prom"),
+                     prometheus_text(report))
+    # next to the run's other artifacts, so the run report can be put together from whichever worker ran the stage
+    artifact_store.put_text(text, report_key(run, stage))
+    print(summary(report))
+
+
+def run_report(run, stages) -> dict:
+    """Merges the stage reports of a run into {prefix}/metrics/run.json and prints the totals."""
+    from common.utils.artifacts import artifact_store
+    reports = {}
+    for stage in stages:
+        try:
+            reports[stage] = artifact_store.get_json(report_key(run, stage))
+        except Exception:
+            continue
+    totals, sources = {}, {}
+    for report in reports.values():
+        for counter in report['counters']:
+            key = (counter['name'], tuple(sorted(counter['labels'].items())))
+            totals[key] = totals.get(key, 0) + counter['value']
+        for source, stats in report['sources'].items():
+            merged = sources.setdefault(source, {})
+            for key, value in stats.items():
+                if key != 'hit_ratio' and value is not None:
+                    merged[key] = merged.get(key, 0) + value
+    for stats in sources.values():
+        if 'hits' in stats and 'misses' in stats:
+            lookups = stats['hits'] + stats['misses']
+            stats['hit_ratio'] = round(stats['hits'] / lookups, 3) if lookups else None
+    stage_seconds = {stage: next((span['wall_seconds'] for span in report['spans'] if span['span'] == stage), None)
+                     for stage, report in reports.items()}
+    report = {
+        "stock_symbol": run['stock_symbol'],
+        "prefix": run['prefix'],
+        "stages": stage_seconds,
+        "failed_stages": [stage for stage, report in reports.items() if report['status'] != 'success'],
+        "peak_rss_mb": max((span['peak_rss_mb'] for report in reports.values() for span in report['spans']),
+                           default=None),
+        "counters": [{"name": name, "labels": dict(labels), "value": value}
+                     for (name, labels), value in totals.items()],
+        "sources": sources,
+    }
+    text = json.dumps(report, indent=2)
+    write_atomic(os.path.join(METRICS_DIR, *run['prefix'].split('/'), "run.json"), text)
+    artifact_store.put_text(text, report_key(run, "run"))
+    print("Run metrics: " + ", ".join(f"{stage} {seconds:.1f}s" for stage, seconds in stage_seconds.items()
+                                     if seconds is not None))
+    print("Run counters: " + ", ".join(sorted(format_counter(counter) for counter in report['counters'])))
+    return report
+
+
+def publish_run_report(run, stages):
+    try:
+        return run_report(run, stages)
+    except Exception as e:
+        print(f"Metrics: couldn't publish the run report ({e})")
+
+
+metrics = PipelineMetrics()
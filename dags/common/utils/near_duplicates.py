@@ -0,0 +1,83 @@
+import re
+import zlib
+from typing import List
+
+import numpy as np
+
+MINHASH_PERMUTATIONS = 128
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+MAX_HASH = np.uint64(0xFFFFFFFF)
+# fixed seed, so signatures are comparable across processes and runs
+_permutations = np.random.RandomState(1)
+PERMUTATION_A = _permutations.randint(1, 2 ** 31 - 1, size=MINHASH_PERMUTATIONS).astype(np.uint64)
+PERMUTATION_B = _permutations.randint(0, 2 ** 31 - 1, size=MINHASH_PERMUTATIONS).astype(np.uint64)
+
+
+def shingles(text, size, unit='word') -> set:
+    text = re.sub(r'\s+', ' ', (text or '').lower()).strip()
+    if unit == 'word':
+        tokens = re.findall(r"[a-z0-9]+", text)
+        return {' '.join(tokens[i:i + size]) for i in range(max(1, len(tokens) - size + 1))} - {''}
+    return {text[i:i + size] for i in range(max(1, len(text) - size + 1))} - {''}
+
+
+def minhash(shingle_set, num_perm=MINHASH_PERMUTATIONS) -> np.ndarray:
+    # every shingle goes through all the permutations at once, the signature is the column minimum
+    hashes = np.fromiter((zlib.crc32(shingle.encode('utf-8')) for shingle in shingle_set), dtype=np.uint64,
+                         count=len(shingle_set))
+    permuted = (hashes[:, None] * PERMUTATION_A[:num_perm] + PERMUTATION_B[:num_perm]) % MERSENNE_PRIME & MAX_HASH
+    return permuted.min(axis=0)
+
+
+def lsh_bands(threshold, num_perm=MINHASH_PERMUTATIONS, recall=0.95):
+    # the widest bands (fewest candidate pairs) that still bring up pairs at the threshold with the given
+    # probability; candidates are checked against the full signature anyway, missed pairs are lost for good
+    splits = [(num_perm // rows, rows) for rows in range(1, num_perm + 1) if num_perm % rows == 0]
+    good = [(bands, rows) for bands, rows in splits if 1 - (1 - threshold ** rows) ** bands >= recall]
+    return max(good, key=lambda split: split[1]) if good else (num_perm, 1)
+
+
+def near_duplicate_clusters(texts, threshold=0.7, shingle_size=3, unit='word',
+                            num_perm=MINHASH_PERMUTATIONS) -> List[List[int]]:
+    """Groups the indexes of texts whose estimated Jaccard similarity reaches the threshold.
+
+    Clusters come in order of their first member and every text is in exactly one of them, singletons included.
+    """
+    shingle_sets = [shingles(text, shingle_size, unit) for text in texts]
+    # texts without a single shingle can't be compared, they stay on their own
+    indexes = [i for i, shingle_set in enumerate(shingle_sets) if shingle_set]
+    signatures = np.array([minhash(shingle_sets[i], num_perm) for i in indexes]).reshape(len(indexes), num_perm)
+    bands, rows = lsh_bands(threshold, num_perm)
+
+    parent = list(range(len(texts)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    buckets = {}
+    for band in range(bands):
+        band_values = signatures[:, band * rows:(band + 1) * rows]
+        for position, i in enumerate(indexes):
+            members = buckets.setdefault((band, band_values[position].tobytes()), [])
+            merged = False
+            for other_position in members:
+                other = indexes[other_position]
+                if find(i) == find(other):
+                    merged = True
+                    continue
+                # a shared bucket only makes them candidates, the full signatures decide
+                if np.mean(signatures[position] == signatures[other_position]) >= threshold:
+                    parent[find(i)] = find(other)
+                    merged = True
+            # a text that joined a cluster already in the bucket doesn't need to be compared again, which keeps
+            # buckets of heavily syndicated stories short
+            if not merged:
+                members.append(position)
+
+    clusters = {}
+    for i in range(len(texts)):
+        clusters.setdefault(find(i), []).append(i)
+    return sorted(clusters.values(), key=lambda cluster: cluster[0])
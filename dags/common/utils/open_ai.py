@@ -1,47 +1,97 @@
+import asyncio
+import json
 import os
-from openai import OpenAI
-from common.inputs.video_map import VIDEO_DESCRIPTION_MAP
+from common.utils.cache import DiskCache, make_key
+from common.utils.clients import (get_async_openai_client, get_openai_client, rate_limiter,
+                                  release_async_openai_client)
 from common.utils.consts import DISCLAIMER_VIDEO_TEXT
-from common.utils.utils import fix_video_name
+from common.utils.metrics import metrics
 from dotenv import load_dotenv
 
 load_dotenv()
 
 
+SUMMARY_CONCURRENCY = int(os.getenv('SUMMARY_CONCURRENCY', 8))
+LLM_CACHE_ENABLED = os.getenv('LLM_CACHE_ENABLED', 'true').lower() == 'true'
+
+llm_cache = DiskCache('llm',
+                      max_bytes=int(os.getenv('LLM_CACHE_MAX_BYTES', 64 * 1024 * 1024)),
+                      ttl_seconds=int(os.getenv('LLM_CACHE_TTL_SECONDS', 3 * 24 * 3600)),
+                      use_s3=os.getenv('LLM_CACHE_S3', 'true').lower() == 'true')
+
+
+def count_usage(model, usage):
+    if usage is None:
+        return
+    metrics.count('llm_tokens', usage.prompt_tokens, model=model, kind='prompt')
+    metrics.count('llm_tokens', getattr(usage, 'completion_tokens', 0) or 0, model=model, kind='completion')
+
+
 class OpenAIClient():
-    def __init__(self, conn_id='openai_default'):
-        if os.environ.get("LOCAL"):
-            organization = os.getenv('OPEN_AI_ORGANIZATION_ID')
-            project = os.getenv('OPEN_AI_PROJECT_ID')
-            api_key = os.getenv('OPEN_AI_TOKEN')
-        else:
-            from airflow.hooks.base_hook import BaseHook
-            conn = BaseHook.get_connection(conn_id)
-            extra = conn.extra_dejson
-            organization = extra.get('organization')
-            project = extra.get('project')
-            api_key = extra.get('api_key')
-        self.client = OpenAI(
-            organization=organization,
-            project=project,
-            api_key=api_key
-        )
+    def __init__(self, conn_id='openai_default', use_cache=LLM_CACHE_ENABLED):
+        self.client = get_openai_client(conn_id)
+        self.use_cache = use_cache
 
     def generate_text(self, prompt, model="gpt-4o-mini"):
+        cache_key = make_key(model, prompt, {})
+        if self.use_cache:
+            cached = llm_cache.get_text(cache_key)
+            if cached is not None:
+                return cached
         try:
+            rate_limiter('openai').acquire()
             response = self.client.chat.completions.create(
                 messages=[{"role": "user", "content": prompt}],
                 model=model,
             )
+            count_usage(model, response.usage)
+            result = response.choices[0].message.content
+        except Exception as e:
+            print(f"Error: {e}")
+            result = None
+        if self.use_cache and result is not None:
+            llm_cache.set_text(cache_key, result)
+        return result
+
+    def embed_texts(self, texts, model="text-embedding-3-small"):
+        rate_limiter('openai').acquire()
+        response = self.client.embeddings.create(input=list(texts), model=model)
+        count_usage(model, response.usage)
+        return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+
+class AsyncOpenAIClient():
+    def __init__(self, conn_id='openai_default', use_cache=LLM_CACHE_ENABLED):
+        self.conn_id = conn_id
+        self.client = get_async_openai_client(conn_id)
+        self.use_cache = use_cache
+
+    async def generate_text(self, prompt, model="gpt-4o-mini", response_format=None):
+        kwargs = {"response_format": response_format} if response_format else {}
+        cache_key = make_key(model, prompt, kwargs)
+        if self.use_cache:
+            cached = await asyncio.to_thread(llm_cache.get_text, cache_key)
+            if cached is not None:
+                return cached
+        try:
+            await rate_limiter('openai').acquire_async()
+            response = await self.client.chat.completions.create(
+                messages=[{"role": "user", "content": prompt}],
+                model=model,
+                **kwargs,
+            )
+            count_usage(model, response.usage)
             result = response.choices[0].message.content
         except Exception as e:
             print(f"Error: {e}")
             result = None
+        if self.use_cache and result is not None:
+            await asyncio.to_thread(llm_cache.set_text, cache_key, result)
         return result
 
 
-def check_if_article_relevant(text, link, company_name, stock_symbol, client) -> bool:
-    prompt = (
+def relevance_prompt(text, link, company_name, stock_symbol):
+    return (
         "You are a financial analyst specializing in evaluating news articles for their potential impact on a company's stock price.\n"
         "Analyze the following article and determine whether it is relevant to the future stock price movement of the specified company.\n"
         "Consider factors such as financial performance, market conditions, legal issues, management changes, or other significant events that could influence the stock price.\n"
@@ -52,20 +102,10 @@ def check_if_article_relevant(text, link, company_name, stock_symbol, client) ->
         f"Article Link: {link}\n"
         f"Article Text: {text}"
     )
-    response = client.generate_text(prompt)
-    try:
-        return response.strip().lower() == 'true'
-    except Exception as e:
-        print(f"Error: {e}")
-        return False
 
 
-def summarize_with_open_ai(text, link, company_name, stock_symbol):
-    client = OpenAIClient()
-    is_article_relevant = check_if_article_relevant(text, link, company_name, stock_symbol, client)
-    if not is_article_relevant:
-        return None
-    prompt = (
+def summary_prompt(text, link, company_name, stock_symbol):
+    return (
         f"You are a financial analyst with expertise in assessing news impact on stock prices in the immediate term.\n"
         f"Please perform the following tasks:\n"
         f"1. **Summarize** the following news article related to {company_name} ({stock_symbol}) in 2-3 sentences.\n"
@@ -75,8 +115,65 @@ def summarize_with_open_ai(text, link, company_name, stock_symbol):
         f"Article Link: {link}\n\n"
         f"Article Text:\n{text}\n"
     )
-    summary = client.generate_text(prompt)
-    return summary
+
+
+def relevance_and_summary_prompt(text, link, company_name, stock_symbol):
+    return (
+        f"You are a financial analyst with expertise in assessing news impact on stock prices in the immediate term.\n"
+        f"First decide whether the article below is relevant to the future stock price movement of {company_name} ({stock_symbol}). "
+        f"Consider factors such as financial performance, market conditions, legal issues, management changes, or other significant events that could influence the stock price.\n"
+        f"If it is relevant, please perform the following tasks:\n"
+        f"1. **Summarize** the article in 2-3 sentences.\n"
+        f"2. **Evaluate** the likely impact of this news on the company's stock price for the next trading day. Indicate whether the impact is **positive**, **negative**, or **neutral**.\n"
+        f"3. **Explain** your reasoning in 1-2 sentences.\n"
+        f"Number each part of the summary accordingly.\n"
+        f"Respond with a JSON object with the keys \"relevant\" (true or false) and \"summary\" "
+        f"(the numbered summary as a single string, or an empty string when the article is not relevant).\n\n"
+        f"Article Link: {link}\n\n"
+        f"Article Text:\n{text}\n"
+    )
+
+
+def parse_relevance(response) -> bool:
+    try:
+        return response.strip().lower() == 'true'
+    except Exception as e:
+        print(f"Error: {e}")
+        return False
+
+
+async def summarize_article_async(client, semaphore, text, link, company_name, stock_symbol):
+    async with semaphore:
+        response = await client.generate_text(relevance_and_summary_prompt(text, link, company_name, stock_symbol),
+                                              response_format={"type": "json_object"})
+        try:
+            result = json.loads(response)
+            if not result.get("relevant"):
+                return None
+            summary = result.get("summary")
+            if isinstance(summary, str) and summary.strip():
+                return summary
+        except Exception as e:
+            print(f"Structured summary failed for {link}, falling back to two calls: {e}")
+        # fall back to the separate relevance and summary prompts
+        response = await client.generate_text(relevance_prompt(text, link, company_name, stock_symbol))
+        if not parse_relevance(response):
+            return None
+        return await client.generate_text(summary_prompt(text, link, company_name, stock_symbol))
+
+
+async def summarize_articles(articles, company_name, stock_symbol, max_concurrency=SUMMARY_CONCURRENCY) -> list:
+    # articles is a list of (text, link); summaries come back in the same order, None for irrelevant articles
+    client = AsyncOpenAIClient()
+    semaphore = asyncio.Semaphore(max(1, max_concurrency))
+    try:
+        return await asyncio.gather(*(
+            summarize_article_async(client, semaphore, text, link, company_name, stock_symbol)
+            for text, link in articles
+        ))
+    finally:
+        release_async_openai_client(client.conn_id)
+        await client.client.close()
 
 
 def generate_stock_opening_analysis(text, company_name, stock_symbol):
@@ -87,6 +184,8 @@ def generate_stock_opening_analysis(text, company_name, stock_symbol):
         f"provide a concise and insightful analysis of how the stock is likely to perform when the market opens today.\n"
         f"Your explanation should be professional, use clear language, and be suitable for an audio briefing to investors.\n\n"
         f"Latest News Summary:\n{text}\n\n"
+        f"Each story lists how many sources carried it; a story reported by many sources is more significant "
+        f"to the market than one carried by a single outlet.\n\n"
         f"Your analysis should include:\n"
         f"1. A prediction on whether the stock will go **up** or **down** at market open, and why.\n"
         f"2. An estimated percentage of the expected price movement.\n"
@@ -97,29 +196,6 @@ def generate_stock_opening_analysis(text, company_name, stock_symbol):
     return results
 
 
-def match_text_to_video(text, last_video_name) -> str:
-    client = OpenAIClient()
-
-    video_description_map = VIDEO_DESCRIPTION_MAP.copy()
-    if last_video_name:
-        del video_description_map[last_video_name]
-
-    prompt = f"""
-    You are given a mapping of video descriptions and their corresponding video file names.
-    Here is the video description map: {video_description_map}
-
-    Your task is to analyze the following sentence and find the video whose description from the description map holds the most relevance.
-
-    Sentence: "{text}"
-
-    Return ONLY the name of the video file that best matches the sentence.
-    """
-
-    response = client.generate_text(prompt)
-    response = fix_video_name(response)
-    return response
-
-
 def create_description_youtube_video(text, company_name, stock_symbol, now):
     print(f"creating description...")
     client = OpenAIClient()
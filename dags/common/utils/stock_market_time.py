@@ -1,10 +1,9 @@
-from datetime import datetime, timedelta, time
+from datetime import datetime, timedelta
 
 from common.utils.consts import MARKET_TIME_ZONE
+from common.utils.trading_calendar import trading_calendar
 
-MARKET_OPEN_TIME = time(9, 30)  # Market opens at 9:30 AM
-MARKET_CLOSE_TIME = time(16, 0)  # Market closes at 4:00 PM
-OPEN_DAYS = [0, 1, 2, 3, 4]  # Monday to Friday
+OPEN_DAYS = [0, 1, 2, 3, 4]  # Monday to Friday, less the NYSE holidays in the trading calendar
 
 
 class StockMarketTime:
@@ -15,80 +14,37 @@ class StockMarketTime:
         else:
             self.now = datetime.now(MARKET_TIME_ZONE)
             self.is_mock = False
+        # sessions (holidays and early closes included) come from the precomputed calendar, lookups are bisects
+        self.calendar = trading_calendar()
         self.is_market_open = self.is_market_currently_open()
         self.last_time_open = self.get_last_market_open_datetime()
         self.next_time_open = self.get_next_market_open_datetime()
         self.last_time_close = self.get_last_market_close_datetime()
         self.next_time_close = self.get_next_market_close_datetime()
         self.is_next_time_open_today = self.next_time_open.date() == self.now.date()
+        # the session in progress, or the next one; the same from the previous close until this session's close
+        self.session_date = self.next_time_close.date()
 
     def is_market_currently_open(self):
-        now_time = self.now.time()
-        now_weekday = self.now.weekday()
-        return (
-                now_weekday in OPEN_DAYS and
-                MARKET_OPEN_TIME <= now_time < MARKET_CLOSE_TIME
-        )
+        return self.calendar.is_open(self.now)
 
     def get_previous_business_day(self, date):
-        date -= timedelta(days=1)
-        while date.weekday() not in OPEN_DAYS:
-            date -= timedelta(days=1)
-        return date
+        return self.calendar.previous_session(date)
 
     def get_next_business_day(self, date):
-        date += timedelta(days=1)
-        while date.weekday() not in OPEN_DAYS:
-            date += timedelta(days=1)
-        return date
+        return self.calendar.next_session(date)
 
     def get_last_market_open_datetime(self):
-        date = self.now
-        while True:
-            if date.weekday() in OPEN_DAYS:
-                naive_open_time = datetime.combine(date.date(), MARKET_OPEN_TIME)
-                open_time = MARKET_TIME_ZONE.localize(naive_open_time)
-                if open_time <= self.now:
-                    return open_time
-            date -= timedelta(days=1)
+        return self.calendar.last_open(self.now)
 
     def get_next_market_open_datetime(self):
-        date = self.now
-        while True:
-            if date.weekday() in OPEN_DAYS:
-                naive_open_time = datetime.combine(date.date(), MARKET_OPEN_TIME)
-                open_time = MARKET_TIME_ZONE.localize(naive_open_time)
-                if open_time > self.now:
-                    return open_time
-            date += timedelta(days=1)
+        return self.calendar.next_open(self.now)
 
     def get_last_market_close_datetime(self):
-        date = self.now
-        while True:
-            if date.weekday() in OPEN_DAYS:
-                naive_close_time = datetime.combine(date.date(), MARKET_CLOSE_TIME)
-                close_time = MARKET_TIME_ZONE.localize(naive_close_time)
-                if close_time <= self.now:
-                    return close_time
-            date -= timedelta(days=1)
+        return self.calendar.last_close(self.now)
 
     def get_next_market_close_datetime(self):
-        date = self.now
-        while True:
-            if date.weekday() in OPEN_DAYS:
-                naive_close_time = datetime.combine(date.date(), MARKET_CLOSE_TIME)
-                close_time = MARKET_TIME_ZONE.localize(naive_close_time)
-                if close_time > self.now:
-                    if self.is_market_open:
-                        return close_time
-                    elif close_time.time() >= self.now.time():
-                        return close_time
-                elif self.is_market_currently_open():
-                    today_close_time = MARKET_TIME_ZONE.localize(
-                        datetime.combine(self.now.date(), MARKET_CLOSE_TIME)
-                    )
-                    return today_close_time
-            date += timedelta(days=1)
+        return self.calendar.next_close(self.now)
 
     def time_until_next_open(self):
         if self.is_market_open:
@@ -0,0 +1,86 @@
+import hashlib
+import os
+import re
+
+ARTICLE_TOKEN_BUDGET = int(os.getenv('ARTICLE_TOKEN_BUDGET', 2000))
+TOKENIZER_ENCODING = "o200k_base"  # the gpt-4o family encoding
+MIN_WORDS_PER_LINE = 4
+# picks the largest article-like container instead of the whole body, so navigation and footers stay out
+MAIN_TEXT_JS = """() => {
+    const candidates = Array.from(document.querySelectorAll(
+        'article, .caas-body, [data-testid="article-content"], [itemprop="articleBody"], main, [role="main"]'));
+    let best = null;
+    for (const el of candidates) {
+        if (!best || el.innerText.length > best.innerText.length) best = el;
+    }
+    if (!best || best.innerText.length < 500) best = document.body;
+    return best ? best.innerText : null;
+}"""
+BOILERPLATE_PATTERNS = re.compile(
+    r"(cookie|privacy policy|terms of (service|use)|sign in|sign up|subscribe|newsletter|advertisement|"
+    r"all rights reserved|©|copyright|related (articles|stories|quotes)|read more|recommended stories|"
+    r"share this|follow us|download the app|view comments|story continues)",
+    re.IGNORECASE,
+)
+
+_encoding = None
+
+
+def get_encoding():
+    global _encoding
+    if _encoding is None:
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding(TOKENIZER_ENCODING)
+        except Exception as e:
+            print(f"tiktoken unavailable, approximating token counts: {e}")
+            _encoding = False
+    return _encoding
+
+
+def count_tokens(text) -> int:
+    encoding = get_encoding()
+    if encoding:
+        return len(encoding.encode(text, disallowed_special=()))
+    return len(re.findall(r"\w+|[^\w\s]", text))
+
+
+def truncate_to_tokens(text, max_tokens) -> str:
+    encoding = get_encoding()
+    if encoding:
+        tokens = encoding.encode(text, disallowed_special=())
+        return text if len(tokens) <= max_tokens else encoding.decode(tokens[:max_tokens])
+    pieces = list(re.finditer(r"\w+|[^\w\s]", text))
+    return text if len(pieces) <= max_tokens else text[:pieces[max_tokens].start()]
+
+
+def is_boilerplate(line) -> bool:
+    words = line.split()
+    if len(words) < MIN_WORDS_PER_LINE and not line.endswith(('.', '!', '?', ':')):
+        return True
+    return len(words) < 25 and bool(BOILERPLATE_PATTERNS.search(line))
+
+
+def strip_boilerplate(text) -> str:
+    paragraphs = []
+    seen = set()
+    for line in text.splitlines():
+        line = re.sub(r"\s+", " ", line).strip()
+        if not line or is_boilerplate(line):
+            continue
+        fingerprint = hashlib.md5(re.sub(r"\W+", "", line.lower()).encode('utf-8')).hexdigest()
+        if fingerprint in seen:
+            continue
+        seen.add(fingerprint)
+        paragraphs.append(line)
+    return "\n".join(paragraphs)
+
+
+def prepare_article_text(text, link=None, token_budget=ARTICLE_TOKEN_BUDGET) -> dict:
+    tokens_before = count_tokens(text)
+    cleaned = strip_boilerplate(text)
+    if count_tokens(cleaned) > token_budget:
+        cleaned = truncate_to_tokens(cleaned, token_budget)
+    tokens_after = count_tokens(cleaned)
+    print(f"Article {link}: {tokens_before} -> {tokens_after} tokens")
+    return {"link": link, "text": cleaned, "tokens_before": tokens_before, "tokens_after": tokens_after}
@@ -0,0 +1,25 @@
+import time
+from contextlib import contextmanager
+
+from common.utils.metrics import metrics
+
+
+class StageTimer:
+    # accumulates wall time per named stage, in the order the stages first ran
+    def __init__(self):
+        self.timings = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            with metrics.span(name):
+                yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0.0) + time.perf_counter() - start
+
+    def total(self):
+        return sum(self.timings.values())
+
+    def summary(self):
+        return ", ".join(f"{name} {seconds:.1f}s" for name, seconds in self.timings.items())
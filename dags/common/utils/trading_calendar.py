@@ -0,0 +1,167 @@
+import bisect
+import datetime
+import os
+from functools import lru_cache
+
+import numpy as np
+
+from common.utils.consts import MARKET_TIME_ZONE
+
+MARKET_OPEN_TIME = datetime.time(9, 30)
+MARKET_CLOSE_TIME = datetime.time(16, 0)
+EARLY_CLOSE_TIME = datetime.time(13, 0)
+CALENDAR_YEARS_BACK = int(os.getenv('TRADING_CALENDAR_YEARS_BACK', 10))
+CALENDAR_YEARS_AHEAD = int(os.getenv('TRADING_CALENDAR_YEARS_AHEAD', 5))
+# one-off closures (national days of mourning, weather) that no rule produces
+SPECIAL_CLOSURES = {
+    datetime.date(2001, 9, 11), datetime.date(2001, 9, 12), datetime.date(2001, 9, 13), datetime.date(2001, 9, 14),
+    datetime.date(2004, 6, 11), datetime.date(2007, 1, 2), datetime.date(2012, 10, 29), datetime.date(2012, 10, 30),
+    datetime.date(2018, 12, 5), datetime.date(2025, 1, 9),
+}
+
+
+def easter(year) -> datetime.date:
+    # anonymous Gregorian algorithm
+    a, b, c = year % 19, year // 100, year % 100
+    d, e = divmod(b, 4)
+    g = (8 * b + 13) // 25
+    h = (19 * a + b - d - g + 15) % 30
+    i, k = divmod(c, 4)
+    l = (32 + 2 * e + 2 * i - h - k) % 7
+    m = (a + 11 * h + 22 * l) // 451
+    month, day = divmod(h + l - 7 * m + 114, 31)
+    return datetime.date(year, month, day + 1)
+
+
+def nth_weekday(year, month, weekday, n) -> datetime.date:
+    # n-th (1-based) given weekday of the month, n=-1 for the last one
+    if n > 0:
+        first = datetime.date(year, month, 1)
+        return first + datetime.timedelta(days=(weekday - first.weekday()) % 7 + 7 * (n - 1))
+    last = datetime.date(year + month // 12, month % 12 + 1, 1) - datetime.timedelta(days=1)
+    return last - datetime.timedelta(days=(last.weekday() - weekday) % 7)
+
+
+def observed(date) -> datetime.date:
+    # a holiday on Saturday is observed on Friday, on Sunday on Monday
+    if date.weekday() == 5:
+        return date - datetime.timedelta(days=1)
+    if date.weekday() == 6:
+        return date + datetime.timedelta(days=1)
+    return date
+
+
+def nyse_holidays(year) -> set:
+    holidays = {
+        nth_weekday(year, 2, 0, 3),  # Washington's Birthday
+        easter(year) - datetime.timedelta(days=2),  # Good Friday
+        nth_weekday(year, 5, 0, -1),  # Memorial Day
+        observed(datetime.date(year, 7, 4)),
+        nth_weekday(year, 9, 0, 1),  # Labor Day
+        nth_weekday(year, 11, 3, 4),  # Thanksgiving
+        observed(datetime.date(year, 12, 25)),
+    }
+    new_year = datetime.date(year, 1, 1)
+    if new_year.weekday() != 5:  # the NYSE doesn't close the Friday before for a Saturday New Year's Day
+        holidays.add(observed(new_year))
+    if year >= 1998:
+        holidays.add(nth_weekday(year, 1, 0, 3))  # Martin Luther King Jr. Day
+    if year >= 2022:
+        holidays.add(observed(datetime.date(year, 6, 19)))  # Juneteenth
+    return holidays
+
+
+def nyse_early_closes(year) -> set:
+    early_closes = {nth_weekday(year, 11, 3, 4) + datetime.timedelta(days=1)}  # the day after Thanksgiving
+    july_3 = datetime.date(year, 7, 3)
+    if july_3.weekday() < 4:  # Independence Day falls Tuesday to Friday
+        early_closes.add(july_3)
+    christmas_eve = datetime.date(year, 12, 24)
+    if christmas_eve.weekday() < 4:
+        early_closes.add(christmas_eve)
+    return early_closes
+
+
+class TradingCalendar:
+    """Sorted NYSE session open and close timestamps, so every last/next lookup is a binary search."""
+
+    def __init__(self, first_year, last_year):
+        self.first_year = first_year
+        self.last_year = last_year
+        holidays = set(SPECIAL_CLOSURES)
+        early_closes = set()
+        for year in range(first_year, last_year + 1):
+            holidays |= nyse_holidays(year)
+            early_closes |= nyse_early_closes(year)
+        self.session_dates = []
+        opens, closes = [], []
+        date = datetime.date(first_year, 1, 1)
+        while date.year <= last_year:
+            if date.weekday() < 5 and date not in holidays:
+                close_time = EARLY_CLOSE_TIME if date in early_closes else MARKET_CLOSE_TIME
+                # DST never switches during a weekday session, so the close is a fixed offset from the open
+                naive_open_time = datetime.datetime.combine(date, MARKET_OPEN_TIME)
+                open_timestamp = MARKET_TIME_ZONE.localize(naive_open_time).timestamp()
+                self.session_dates.append(date)
+                opens.append(open_timestamp)
+                closes.append(open_timestamp + (datetime.datetime.combine(date, close_time) -
+                                                naive_open_time).total_seconds())
+            date += datetime.timedelta(days=1)
+        # plain lists for bisect on single lookups, numpy copies for the vectorized queries
+        self.opens, self.closes = opens, closes
+        self.open_array, self.close_array = np.array(opens), np.array(closes)
+
+    @staticmethod
+    def _datetime(timestamp) -> datetime.datetime:
+        return datetime.datetime.fromtimestamp(timestamp, MARKET_TIME_ZONE)
+
+    def _checked(self, index, lookup):
+        if not 0 <= index < len(self.opens):
+            raise ValueError(f"{lookup} is outside the trading calendar ({self.first_year}-{self.last_year})")
+        return index
+
+    def last_open(self, now) -> datetime.datetime:
+        return self._datetime(self.opens[self._checked(bisect.bisect_right(self.opens, now.timestamp()) - 1, now)])
+
+    def next_open(self, now) -> datetime.datetime:
+        return self._datetime(self.opens[self._checked(bisect.bisect_right(self.opens, now.timestamp()), now)])
+
+    def last_close(self, now) -> datetime.datetime:
+        return self._datetime(self.closes[self._checked(bisect.bisect_right(self.closes, now.timestamp()) - 1, now)])
+
+    def next_close(self, now) -> datetime.datetime:
+        return self._datetime(self.closes[self._checked(bisect.bisect_right(self.closes, now.timestamp()), now)])
+
+    def is_open(self, now) -> bool:
+        index = bisect.bisect_right(self.opens, now.timestamp()) - 1
+        return index >= 0 and now.timestamp() < self.closes[index]
+
+    def is_session(self, date) -> bool:
+        index = bisect.bisect_left(self.session_dates, date)
+        return index < len(self.session_dates) and self.session_dates[index] == date
+
+    def previous_session(self, date) -> datetime.date:
+        return self.session_dates[self._checked(bisect.bisect_left(self.session_dates, date) - 1, date)]
+
+    def next_session(self, date) -> datetime.date:
+        return self.session_dates[self._checked(bisect.bisect_right(self.session_dates, date), date)]
+
+    def session_index(self, open_time) -> int:
+        return bisect.bisect_left(self.opens, open_time.timestamp())
+
+    def overnight_window(self, timestamps) -> np.ndarray:
+        """For each epoch timestamp, the index of the session whose pre-open window (from the previous session's
+        close to its open, both exclusive) it falls in, or -1 when it is during or exactly at a session's hours."""
+        timestamps = np.asarray(timestamps, dtype=np.float64)
+        upcoming = np.searchsorted(self.open_array, timestamps, side='right')
+        previous_close = self.close_array[np.clip(upcoming - 1, 0, len(self.close_array) - 1)]
+        at_open = np.isin(timestamps, self.open_array)
+        in_window = ((upcoming == 0) | (timestamps > previous_close)) & ~at_open
+        return np.where(in_window, upcoming, -1)
+
+
+@lru_cache(maxsize=None)
+def trading_calendar(first_year=None, last_year=None) -> TradingCalendar:
+    # built once per process; the default range covers mocked dates in the recent past as well as the future
+    this_year = datetime.date.today().year
+    return TradingCalendar(first_year or this_year - CALENDAR_YEARS_BACK, last_year or this_year + CALENDAR_YEARS_AHEAD)
@@ -1,13 +1,12 @@
+import asyncio
 import os
 import logging
-import random
-import time
 from playwright.async_api import async_playwright
-from common.inputs.video_map import VIDEO_DESCRIPTION_MAP
 from dotenv import load_dotenv
-import boto3
 import shutil
-from common.utils.consts import BUCKET_NAME
+from common.utils.artifacts import artifact_store
+from common.utils.clients import get_boto3_client
+from common.utils.text_extraction import MAIN_TEXT_JS
 
 load_dotenv()
 
@@ -24,49 +23,132 @@ if not os.path.exists(executable_path):
     raise FileNotFoundError(f"Chromium executable not found at {executable_path}")
 
 
+SCRAPE_CONCURRENCY = int(os.getenv('SCRAPE_CONCURRENCY', 5))
+SCRAPE_PAGE_TIMEOUT_MS = int(os.getenv('SCRAPE_PAGE_TIMEOUT_MS', 30000))
+ARTICLE_READY_TIMEOUT_MS = 8000
+BLOCKED_RESOURCE_TYPES = {"image", "font", "media"}
+BLOCKED_DOMAINS = (
+    "doubleclick.net", "googlesyndication.com", "googletagmanager.com", "googletagservices.com",
+    "google-analytics.com", "adservice.google.com", "amazon-adsystem.com", "scorecardresearch.com",
+    "taboola.com", "outbrain.com", "criteo.com", "criteo.net", "adnxs.com", "moatads.com",
+    "chartbeat.com", "quantserve.com", "facebook.net", "connect.facebook.net", "bidswitch.net",
+    "rubiconproject.com", "pubmatic.com", "casalemedia.com", "openx.net", "yieldmo.com",
+    "advertising.com", "adsrvr.org", "demdex.net", "omtrdc.net", "hotjar.com",
+)
+# resolves once the main article text is rendered, so we don't have to sleep a fixed amount per page
+ARTICLE_READY_JS = """() => {
+    const el = document.querySelector('article, .caas-body, [data-testid="article-content"], main');
+    return !!el && el.innerText.length > 500;
+}"""
+
+
+async def block_heavy_requests(route):
+    request = route.request
+    if request.resource_type in BLOCKED_RESOURCE_TYPES:
+        return await route.abort()
+    host = request.url.split("/")[2] if "://" in request.url else ""
+    if any(host == domain or host.endswith("." + domain) for domain in BLOCKED_DOMAINS):
+        return await route.abort()
+    return await route.continue_()
+
+
 async def open_finance_yahoo(p):
     base_url = "https://finance.yahoo.com/"
     browser = await p.chromium.launch(headless=True,
                                       # executable_path=executable_path,
                                       )
-    page = await browser.new_page()
-    await page.goto(base_url)
-    await page.wait_for_timeout(10000)
+    context = await browser.new_context()
+    await context.route("**/*", block_heavy_requests)
+    page = await context.new_page()
+    await page.goto(base_url, wait_until="domcontentloaded")
     try:
-        time.sleep(0.2)
+        await page.wait_for_selector("button#scroll-down-btn", timeout=5000)
         await page.click("button#scroll-down-btn")
         await page.click("button.btn.secondary.reject-all")
     except Exception:
         pass
-    return browser, page
+    # the consent cookies live on the context, so every page opened from it skips the consent wall
+    return browser, context, page
 
 
-async def get_text_from_url(url, page):
+async def get_text_from_url(url, page, timeout_ms=SCRAPE_PAGE_TIMEOUT_MS):
+    await page.goto(url, wait_until="domcontentloaded", timeout=timeout_ms)
     try:
-        await page.goto(url)
-        await page.wait_for_timeout(10000)
-        body_handle = await page.query_selector("body")
-        if body_handle:
-            text_raw = await page.evaluate("document.body.innerText")
-        else:
-            text_raw = "Error: Body element is not present on the page."
-        return text_raw
-    except Exception as e:
-        print(f"Error fetching text from URL {url}: {e}")
-        return None
+        await page.wait_for_function(ARTICLE_READY_JS, timeout=ARTICLE_READY_TIMEOUT_MS)
+    except Exception:
+        # no recognizable article container, fall back to whatever the body holds
+        pass
+    body_handle = await page.query_selector("body")
+    if body_handle:
+        text_raw = await page.evaluate(MAIN_TEXT_JS)
+    else:
+        text_raw = "Error: Body element is not present on the page."
+    return text_raw
+
+
+class PagePool:
+    def __init__(self, context, size):
+        self.context = context
+        self.size = size
+        self.pages = asyncio.Queue()
+
+    async def open(self, first_page=None):
+        if first_page:
+            await self.pages.put(first_page)
+        while self.pages.qsize() < self.size:
+            await self.pages.put(await self.context.new_page())
+
+    async def drop_slot(self):
+        self.size -= 1
+        print(f"Browser page lost, the page pool is down to {self.size} page(s)")
+        if not self.size:
+            # nothing will ever be put back, so waiting fetches get a marker that fails them
+            await self.pages.put(None)
+
+    async def fetch(self, url, timeout_ms):
+        page = await self.pages.get()
+        if page is None:
+            await self.pages.put(None)
+            return None, "No browser pages left"
+        try:
+            text = await asyncio.wait_for(get_text_from_url(url, page, timeout_ms), timeout=timeout_ms / 1000)
+            return text, None
+        except Exception as e:
+            # a timed out page may still be navigating, replace it instead of reusing it
+            try:
+                await page.close()
+            except Exception:
+                pass
+            try:
+                page = await self.context.new_page()
+            except Exception:
+                page = None
+            return None, f"{type(e).__name__}: {e}"
+        finally:
+            # only an open page goes back, a closed one would fail every later fetch on its slot
+            if page is not None and not page.is_closed():
+                await self.pages.put(page)
+            else:
+                await self.drop_slot()
 
 
-async def get_text_by_url(urls):
+async def get_text_by_url(urls, max_concurrency=SCRAPE_CONCURRENCY, timeout_ms=SCRAPE_PAGE_TIMEOUT_MS):
     text_by_link = {}
-    time.sleep(0.2)
+    urls = list(urls)
+    if not urls:
+        return text_by_link
     async with async_playwright() as p:
-        browser, page = await open_finance_yahoo(p)
+        browser, context, page = await open_finance_yahoo(p)
         if not browser or not page:
             print("Failed to open browser or page.")
             return text_by_link
         try:
-            for url in urls:
-                text = await get_text_from_url(url, page)
+            pool = PagePool(context, size=max(1, min(max_concurrency, len(urls))))
+            await pool.open(first_page=page)
+            results = await asyncio.gather(*(pool.fetch(url, timeout_ms) for url in urls))
+            for url, (text, error) in zip(urls, results):
+                if error:
+                    print(f"Error fetching text from URL {url}: {error}")
                 text_by_link[url] = text
             return text_by_link
         finally:
@@ -74,40 +156,19 @@ async def get_text_by_url(urls):
 
 
 def get_s3_client(conn_id='aws_default'):
-    if os.environ.get("LOCAL"):
-        aws_access_key_id = os.getenv('AWS_ACCESS_KEY_ID')
-        aws_secret_access_key = os.getenv('AWS_SECRET_ACCESS_KEY')
-        region_name = os.getenv('AWS_REGION_NAME', 'us-east-1')
-    else:
-        from airflow.hooks.base_hook import BaseHook
-        conn = BaseHook.get_connection(conn_id)
-        extra = conn.extra_dejson or {}
-        aws_access_key_id = conn.login
-        aws_secret_access_key = conn.password
-        region_name = extra.get('region_name', 'us-east-1')
-    s3_client = boto3.Session(
-        aws_access_key_id=aws_access_key_id,
-        aws_secret_access_key=aws_secret_access_key,
-        region_name=region_name
-    ).client('s3')
-
-    return s3_client
+    return get_boto3_client('s3', conn_id)
 
 
 def save_to_s3(file_name, data, file_type='txt'):
-    s3_client = get_s3_client()
-
-    s3_client.put_object(Bucket=BUCKET_NAME, Key=f"{file_name}.{file_type}", Body=data)
+    artifact_store.put_text(data, f"{file_name}.{file_type}")
 
 
 def read_from_s3(file_name, file_type='txt'):
-    s3_client = get_s3_client()
     try:
-        response = s3_client.get_object(Bucket=BUCKET_NAME, Key=f"{file_name}.{file_type}")
+        return artifact_store.get_text(f"{file_name}.{file_type}")
     except Exception as e:
         print(f"File {file_name}.{file_type} not found in S3\n: {e}")
         return None
-    return response['Body'].read().decode('utf-8')
 
 
 def setup_logging():
@@ -119,16 +180,6 @@ def setup_logging():
     pass
 
 
-def fix_video_name(name):
-    if not name.endswith(".mp4"):
-        name += ".mp4"
-    if name not in VIDEO_DESCRIPTION_MAP.keys():
-        name = None
-    if not name:
-        return random.choice(["Interactive_Trading_Screen.mp4", "Stock_Ticker_Grid.mp4"])
-    return name
-
-
 def clean_dir(dir_name):
     if os.path.exists(dir_name) and os.path.isdir(dir_name):
         for entry in os.listdir(dir_name):
@@ -0,0 +1,153 @@
+import hashlib
+import os
+import re
+from typing import List, Optional
+
+import numpy as np
+
+from common.inputs import video_map
+from common.inputs.video_map import VIDEO_DESCRIPTION_MAP
+from common.utils.consts import CACHE_DIR
+
+EMBEDDING_MODEL = os.getenv('VIDEO_MATCH_EMBEDDING_MODEL', 'text-embedding-3-small')
+VIDEO_MATCH_METHOD = os.getenv('VIDEO_MATCH_METHOD', 'embedding')  # 'embedding' or 'lexical'
+INDEX_DIR = os.path.join(CACHE_DIR, 'video_index')
+STOP_WORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "for", "from", "has", "have", "in", "is", "it", "its",
+    "of", "on", "or", "that", "the", "this", "to", "was", "were", "will", "with", "which", "such", "their",
+}
+
+
+def video_map_fingerprint() -> str:
+    with open(video_map.__file__, 'rb') as file:
+        return hashlib.sha256(file.read()).hexdigest()[:16]
+
+
+def normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def tokenize(text):
+    return [token for token in re.findall(r"[a-z0-9]+", text.lower()) if token not in STOP_WORDS]
+
+
+class LexicalScorer:
+    # TF-IDF over the video descriptions, needs no network
+    def __init__(self, descriptions):
+        documents = [tokenize(description) for description in descriptions]
+        self.vocabulary = {token: i for i, token in enumerate(sorted({t for doc in documents for t in doc}))}
+        document_frequency = np.zeros(len(self.vocabulary))
+        for doc in documents:
+            for token in set(doc):
+                document_frequency[self.vocabulary[token]] += 1
+        self.idf = np.log((1 + len(documents)) / (1 + document_frequency)) + 1
+        self.matrix = normalize_rows(self.vectorize_tokens(documents))
+
+    def vectorize_tokens(self, documents):
+        matrix = np.zeros((len(documents), len(self.vocabulary)))
+        for row, doc in enumerate(documents):
+            for token in doc:
+                column = self.vocabulary.get(token)
+                if column is not None:
+                    matrix[row, column] += 1
+        return np.log1p(matrix) * self.idf
+
+    def score(self, sentences):
+        queries = normalize_rows(self.vectorize_tokens([tokenize(sentence) for sentence in sentences]))
+        return queries @ self.matrix.T
+
+
+class EmbeddingScorer:
+    def __init__(self, names, descriptions, client=None, model=EMBEDDING_MODEL):
+        self.model = model
+        self.client = client
+        self.matrix = self.load_or_build(names, descriptions)
+
+    def get_client(self):
+        if self.client is None:
+            from common.utils.open_ai import OpenAIClient
+            self.client = OpenAIClient()
+        return self.client
+
+    def embed(self, texts):
+        return np.asarray(self.get_client().embed_texts(texts, model=self.model), dtype=np.float32)
+
+    def load_or_build(self, names, descriptions):
+        # the index is rebuilt only when video_map.py (or the embedding model) changes
+        index_path = os.path.join(INDEX_DIR, f"{video_map_fingerprint()}_{self.model}.npz")
+        if os.path.exists(index_path):
+            stored = np.load(index_path)
+            if list(stored['names']) == list(names):
+                return stored['matrix']
+        print(f"Building video description index at {index_path}...")
+        matrix = normalize_rows(self.embed([description.strip() for description in descriptions]))
+        os.makedirs(INDEX_DIR, exist_ok=True)
+        tmp_path = f"{index_path}.{os.getpid()}.tmp.npz"
+        np.savez(tmp_path, names=np.asarray(names), matrix=matrix)
+        os.replace(tmp_path, index_path)
+        return matrix
+
+    def score(self, sentences):
+        return normalize_rows(self.embed(sentences)) @ self.matrix.T
+
+
+class VideoIndex:
+    def __init__(self, description_map=None, method=VIDEO_MATCH_METHOD):
+        description_map = description_map or VIDEO_DESCRIPTION_MAP
+        self.names = list(description_map.keys())
+        descriptions = list(description_map.values())
+        self.lexical = LexicalScorer(descriptions)
+        self.embedding = None
+        if method == 'embedding':
+            try:
+                self.embedding = EmbeddingScorer(self.names, descriptions)
+            except Exception as e:
+                print(f"Embedding index unavailable, using lexical matching: {e}")
+
+    def score(self, sentences):
+        if self.embedding is not None:
+            try:
+                return self.embedding.score(sentences)
+            except Exception as e:
+                print(f"Embedding scoring failed, using lexical matching: {e}")
+        return self.lexical.score(sentences)
+
+    def match(self, sentences: List[str], last_video_name: Optional[str] = None) -> List[str]:
+        if not sentences:
+            return []
+        scores = self.score(sentences)
+        # the two best candidates per sentence are enough to honour "not the same as the previous video"
+        top_two = np.argsort(-scores, axis=1)[:, :2]
+        matches = []
+        for best, runner_up in top_two:
+            name = self.names[best]
+            if name == last_video_name and len(self.names) > 1:
+                name = self.names[runner_up]
+            matches.append(name)
+            last_video_name = name
+        return matches
+
+
+_video_index = None
+
+
+def match_sentences_to_videos(sentences: List[str], last_video_name: Optional[str] = None) -> List[str]:
+    global _video_index
+    if _video_index is None:
+        _video_index = VideoIndex()
+    return _video_index.match(sentences, last_video_name)
+
+
+def assign_videos(sentences_list_with_timings, matches):
+    # matches are made on the script's own sentence split, which Polly's speech marks nearly always agree with;
+    # when they don't, the spoken sentences are matched again
+    video_names = [match['video_name'] for match in matches]
+    if [tokenize(sentence['sentence']) for sentence in sentences_list_with_timings] != \
+            [tokenize(match['sentence']) for match in matches]:
+        print("Speech marks split the script differently, matching the spoken sentences...")
+        video_names = match_sentences_to_videos([sentence['sentence'] for sentence in sentences_list_with_timings])
+    for sentence, video_name in zip(sentences_list_with_timings, video_names):
+        sentence['video_name'] = video_name
+    return sentences_list_with_timings
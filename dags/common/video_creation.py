@@ -9,7 +9,18 @@ from moviepy.editor import (
 )
 import ffmpeg
 
-DESIRED_WIDTH, DESIRED_HEIGHT = 1920, 1080
+from common.encoder_profiles import ENCODER_PROFILE, encoder_kwargs, moviepy_write_kwargs
+from common.utils.consts import DESIRED_HEIGHT, DESIRED_WIDTH, VIDEO_FPS
+from common.utils.timing import StageTimer
+from common.video_proxies import get_video_duration, get_video_source
+from common.word_raster import (WORD_COLOR, WORD_FONT_SIZE, WORD_STROKE_COLOR, WORD_STROKE_WIDTH,
+                                 make_word_clip)
+
+FILLER_VIDEO_NAME = "Interactive_Trading_Screen.mp4"
+SHORTS_DESIRED_WIDTH, SHORTS_DESIRED_HEIGHT = 1080, 1920
+SHORTS_DURATION_RATIO = 0.8
+WORD_RENDERER = os.getenv('WORD_RENDERER', 'raster')  # 'raster' (cached PIL bitmaps) or 'imagemagick'
+RENDER_ENGINE = os.getenv('RENDER_ENGINE', 'moviepy')  # 'moviepy', 'ffmpeg' or 'segmented'
 
 
 def load_audio(audio_path):
@@ -19,6 +30,9 @@ def load_audio(audio_path):
 def resize_video(bg_video, clip_duration, video_name):
     bg_clip = bg_video.subclip(0, clip_duration)
     desired_width, desired_height = DESIRED_WIDTH, DESIRED_HEIGHT
+    if tuple(bg_clip.size) == (desired_width, desired_height):
+        # proxies are already conformed to the output frame
+        return bg_clip
     try:
         bg_clip = bg_clip.resize(width=desired_width)
         if bg_clip.h > desired_height:
@@ -31,146 +45,154 @@ def resize_video(bg_video, clip_duration, video_name):
     return bg_clip
 
 
-def load_background_clips(background_videos, total_audio_duration, sentences_list_with_timings):
-    if background_videos is None:
-        return None, []
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    inputs_dir = os.path.join(script_dir, 'inputs')
-    background_clips = []
-    bg_videos = []
+def plan_background_segments(sentences_list_with_timings, total_audio_duration, get_video_duration):
+    # same rules as load_background_clips, as a list of (video_name, clip_duration) for engines that
+    # don't open the clips themselves; get_video_duration returns None for videos that can't be used
+    segments = []
     current_duration = 0
-    print(f"Creating background clips...")
     for sentence in sentences_list_with_timings:
         video_name = sentence['video_name']
         if current_duration >= total_audio_duration:
             break
-        file_name = os.path.join(inputs_dir, video_name)
-        try:
-            bg_video = VideoFileClip(file_name)
-            bg_videos.append(bg_video)
-        except Exception as e:
-            print(f"Error loading video '{file_name}': {e}")
+        video_duration = get_video_duration(video_name)
+        if video_duration is None:
             continue
-        clip_duration = (sentence['end'] - sentence['start']) / 1000
-        video_duration = bg_video.duration
-        clip_duration = min(clip_duration, video_duration)
+        clip_duration = min((sentence['end'] - sentence['start']) / 1000, video_duration)
         if clip_duration <= 0:
             continue
         if sentence.get("is_last_sentence") is True:
             clip_duration += 0.5
-        bg_clip = resize_video(bg_video, clip_duration, video_name)
-        background_clips.append(bg_clip)
+        segments.append((video_name, clip_duration))
         current_duration += clip_duration
     while current_duration < total_audio_duration:
-        video_name = "Interactive_Trading_Screen.mp4"
-        file_name = os.path.join(inputs_dir, video_name)
-        try:
-            bg_video = VideoFileClip(file_name)
-            bg_videos.append(bg_video)
-        except Exception as e:
-            print(f"Error loading video '{file_name}': {e}")
+        video_duration = get_video_duration(FILLER_VIDEO_NAME)
+        if video_duration is None:
             break
-        clip_duration = min(bg_video.duration, total_audio_duration - current_duration)
-        bg_clip = resize_video(bg_video, clip_duration, video_name)
-        background_clips.append(bg_clip)
+        clip_duration = min(video_duration, total_audio_duration - current_duration)
+        segments.append((FILLER_VIDEO_NAME, clip_duration))
         current_duration += clip_duration
+    return segments
+
+
+class BackgroundClipPool:
+    # opens each source once per run and hands out subclips of the shared reader
+    def __init__(self):
+        self.readers = {}
+
+    def get(self, video_name):
+        if video_name not in self.readers:
+            source = get_video_source(video_name)
+            self.readers[video_name] = VideoFileClip(source['path'], audio=False) if source else None
+        return self.readers[video_name]
+
+    def clips(self):
+        return [reader for reader in self.readers.values() if reader is not None]
+
+    def close(self):
+        for reader in self.clips():
+            reader.close()
+        self.readers = {}
+
+
+def load_background_clips(background_videos, total_audio_duration, sentences_list_with_timings):
+    if background_videos is None:
+        return None, []
+    print(f"Creating background clips...")
+    # durations come from the metadata index, so nothing is probed or opened while planning
+    segments = plan_background_segments(sentences_list_with_timings, total_audio_duration, get_video_duration)
+    pool = BackgroundClipPool()
+    background_clips = []
+    for video_name, clip_duration in segments:
+        try:
+            bg_video = pool.get(video_name)
+        except Exception as e:
+            print(f"Error loading video '{video_name}': {e}")
+            continue
+        if bg_video is None:
+            continue
+        # the last sentence's extra half second may run past the source, moviepy holds the last frame
+        background_clips.append(resize_video(bg_video, clip_duration, video_name))
     if background_clips:
         try:
             concatenated_background = concatenate_videoclips(background_clips)
-            return concatenated_background, bg_videos
+            return concatenated_background, pool.clips()
         except Exception as e:
             print(f"Error concatenating video clips: {e}")
-            return None, bg_videos
+            return None, pool.clips()
     else:
-        return None, bg_videos
+        return None, pool.clips()
+
+
+def make_imagemagick_word_clip(word):
+    return TextClip(
+        word,
+        fontsize=WORD_FONT_SIZE,
+        color=WORD_COLOR,
+        stroke_color=WORD_STROKE_COLOR,
+        stroke_width=WORD_STROKE_WIDTH,
+        font='Arial-Bold',
+        method='caption'
+    )
 
 
-def generate_text_clips(sentences_list_with_timings):
+def generate_text_clips(sentences_list_with_timings, renderer=WORD_RENDERER):
     clips = []
     print("Generating background text clips...")
+    make_clip = make_word_clip if renderer == 'raster' else make_imagemagick_word_clip
     for sentence in sentences_list_with_timings:
         for timing in sentence['words_in_sentence']:
             word = timing['word']
             start_time_in_seconds = timing['start'] / 1000.0
             duration = (timing['end'] - timing['start']) / 1000.0
-            text_clip = TextClip(
-                word,
-                fontsize=160,
-                color='white',
-                stroke_color='black',
-                stroke_width=6,
-                font='Arial-Bold',
-                method='caption'
-            ).set_start(start_time_in_seconds).set_duration(duration).set_position('center')
+            text_clip = make_clip(word).set_start(start_time_in_seconds).set_duration(duration).set_position('center')
             clips.append(text_clip)
     return clips
 
 
-def add_disclaimer(video, disclaimer_video_path):
-    print("Adding disclaimer video...")
-    if os.path.exists(disclaimer_video_path):
-        disclaimer_clip = VideoFileClip(disclaimer_video_path)
-        final_video = concatenate_videoclips([video, disclaimer_clip], method="compose")
-        return final_video, disclaimer_clip
-    else:
-        print("Disclaimer video not found. Proceeding without it.")
-        return video, None
+def shorts_trim_point(sentences_list_with_timings, main_duration):
+    # keeps roughly the first 80% of the video, ending on the last sentence that finishes by then
+    limit = main_duration * SHORTS_DURATION_RATIO
+    sentence_ends = [sentence['end'] / 1000 for sentence in sentences_list_with_timings
+                     if 0 < sentence['end'] / 1000 <= limit]
+    return max(sentence_ends) if sentence_ends else limit
 
 
-def create_youtube_shorts_video(full_video_path, shorts_video_path, disclaimer_video_path):
-    try:
-        import ffmpeg
-    except ImportError:
-        print("Please install the 'ffmpeg' package to create YouTube Shorts videos.")
-        shorts_video_path = None
-        return None
-    probe = ffmpeg.probe(full_video_path)
-    duration = float(probe['format']['duration'])
-    trimmed_duration = duration - 7
-    if trimmed_duration <= 0:
-        trimmed_duration = duration
-    trimmed_duration *= 0.8
+def shorts_frame(video):
+    split = video.filter_multi_output('split')
+    # Scale the original video to fit the width, maintaining aspect ratio
+    scaled_video = split[0].filter('scale', SHORTS_DESIRED_WIDTH, -1)
+    # Create a blurred background by scaling and blurring the original video
+    blurred_bg = (
+        split[1]
+        .filter('scale', SHORTS_DESIRED_WIDTH, SHORTS_DESIRED_HEIGHT)
+        .filter('boxblur', luma_radius=10, luma_power=1)
+    )
+    # Overlay the scaled video onto the blurred background, centered vertically
+    return ffmpeg.overlay(blurred_bg, scaled_video, x=0, y='(H-h)/2').filter('setsar', 1)
+
+
+def create_youtube_shorts_video(full_video_path, shorts_video_path, disclaimer_video_path, trimmed_duration=None,
+                                output_kwargs=None):
+    # used by the MoviePy engine, the ffmpeg engines render the Shorts from the same decode as the main video
+    if trimmed_duration is None:
+        probe = ffmpeg.probe(full_video_path)
+        duration = float(probe['format']['duration'])
+        trimmed_duration = duration - 7
+        if trimmed_duration <= 0:
+            trimmed_duration = duration
+        trimmed_duration *= SHORTS_DURATION_RATIO
     print(f"Creating YouTube Shorts video of duration {trimmed_duration:.2f} seconds...")
-    SHORTS_DESIRED_WIDTH, SHORTS_DESIRED_HEIGHT = 1080, 1920
-
-    def process_input(video_input):
-        # Scale the original video to fit the width, maintaining aspect ratio
-        scaled_video = video_input.video.filter('scale', SHORTS_DESIRED_WIDTH, -1)
-        # Create a blurred background by scaling and blurring the original video
-        blurred_bg = (
-            video_input.video
-            .filter('scale', SHORTS_DESIRED_WIDTH, SHORTS_DESIRED_HEIGHT)
-            .filter('boxblur', luma_radius=10, luma_power=1)
-        )
-        # Overlay the scaled video onto the blurred background, centered vertically
-        overlaid = ffmpeg.overlay(blurred_bg, scaled_video, x=0, y='(H-h)/2')
-        return overlaid
-
-    if os.path.exists(disclaimer_video_path):
-        print("Disclaimer video found, processing with disclaimer.")
-        in1 = ffmpeg.input(full_video_path, ss=0, t=trimmed_duration)
-        in2 = ffmpeg.input(disclaimer_video_path)
-        v1 = process_input(in1)
-        v2 = process_input(in2)
-        a1 = in1.audio
-        a2 = in2.audio
-        v_concat = ffmpeg.concat(v1, v2, v=1, a=0).node
-        a_concat = ffmpeg.concat(a1, a2, v=0, a=1).node
-        out = ffmpeg.output(
-            v_concat[0], a_concat[0], shorts_video_path,
-            vcodec='libx264', acodec='aac', strict='experimental'
-        ).global_args('-loglevel', 'error').overwrite_output()
-        out.run()
-    else:
-        print("Disclaimer video not found. Proceeding without it.")
-        in1 = ffmpeg.input(full_video_path, ss=0, t=trimmed_duration)
-        v1 = process_input(in1)
-        a1 = in1.audio
-        out = ffmpeg.output(
-            v1, a1, shorts_video_path,
-            vcodec='libx264', acodec='aac', strict='experimental'
-        ).global_args('-loglevel', 'error').overwrite_output()
-        out.run()
+    from common.disclaimer import append_disclaimer, body_path_for
+    from common.ffmpeg_renderer import VIDEO_ENCODE_KWARGS, normalize_audio
+    in1 = ffmpeg.input(full_video_path, ss=0, t=trimmed_duration)
+    v1 = shorts_frame(in1.video)
+    a1 = normalize_audio(in1.audio)
+    out = ffmpeg.output(
+        v1, a1, body_path_for(shorts_video_path), acodec='aac', **{**VIDEO_ENCODE_KWARGS, **(output_kwargs or {})}
+    ).global_args('-loglevel', 'error').overwrite_output()
+    out.run()
+    append_disclaimer(body_path_for(shorts_video_path), disclaimer_video_path, shorts_video_path, 'shorts',
+                      output_kwargs)
     print(f"YouTube Shorts video created at {shorts_video_path}")
 
 
@@ -180,25 +202,67 @@ def create_video(
         sentences_list_with_timings,
         background_videos,
         disclaimer_video_path,
-        youtube_shorts_video_path,
+        youtube_shorts_video_path=None,
+        engine=RENDER_ENGINE,
+        encoder_profile=ENCODER_PROFILE,
+        timer=None,
 ):
-    audio = load_audio(audio_path)
-    background_clip, bg_video_clips = load_background_clips(
-        background_videos, audio.duration, sentences_list_with_timings
-    )
-    text_clips = generate_text_clips(sentences_list_with_timings)
-    if background_clip:
-        main_video = CompositeVideoClip([background_clip] + text_clips)
+    timer = timer or StageTimer()
+    output_kwargs = encoder_kwargs(encoder_profile)
+    if engine == 'ffmpeg':
+        from common.ffmpeg_renderer import render_video_ffmpeg
+        render_video_ffmpeg(audio_path, video_path, sentences_list_with_timings, background_videos,
+                            disclaimer_video_path, youtube_shorts_video_path, output_kwargs, timer)
+    elif engine == 'segmented':
+        from common.segmented_renderer import render_video_segmented
+        render_video_segmented(audio_path, video_path, sentences_list_with_timings, background_videos,
+                               disclaimer_video_path, youtube_shorts_video_path, output_kwargs, timer)
     else:
-        main_video = CompositeVideoClip(text_clips)
-    main_video = main_video.set_audio(audio)
-    final_main_video, disclaimer_clip = add_disclaimer(main_video, disclaimer_video_path)
+        main_duration = render_video_moviepy(audio_path, video_path, sentences_list_with_timings,
+                                             background_videos, disclaimer_video_path, output_kwargs, timer)
+        if youtube_shorts_video_path:
+            with timer.stage('shorts'):
+                create_youtube_shorts_video(video_path, youtube_shorts_video_path, disclaimer_video_path,
+                                            shorts_trim_point(sentences_list_with_timings, main_duration),
+                                            output_kwargs)
+    print(f"Render stages ({engine}, {encoder_profile}): {timer.summary()}")
+    return timer
+
+
+def render_video_moviepy(
+        audio_path,
+        video_path,
+        sentences_list_with_timings,
+        background_videos,
+        disclaimer_video_path,
+        output_kwargs=None,
+        timer=None,
+):
+    timer = timer or StageTimer()
+    output_kwargs = output_kwargs or encoder_kwargs()
+    audio = load_audio(audio_path)
+    with timer.stage('background'):
+        background_clip, bg_video_clips = load_background_clips(
+            background_videos, audio.duration, sentences_list_with_timings
+        )
+    with timer.stage('text_clips'):
+        text_clips = generate_text_clips(sentences_list_with_timings)
+    with timer.stage('composite'):
+        if background_clip:
+            main_video = CompositeVideoClip([background_clip] + text_clips)
+        else:
+            main_video = CompositeVideoClip(text_clips)
+        main_video = main_video.set_audio(audio)
+    main_duration = main_video.duration
     print("Writing main video...")
-    final_main_video.write_videofile(video_path, fps=24, audio_codec="aac")
-    if disclaimer_clip:
-        disclaimer_clip.close()
+    # the disclaimer is appended afterwards from its cached encode, matching these codec settings
+    from common.disclaimer import append_disclaimer, body_path_for
+    with timer.stage('encode'):
+        main_video.write_videofile(body_path_for(video_path), fps=VIDEO_FPS, audio_codec="aac", audio_fps=44100,
+                                   **moviepy_write_kwargs(output_kwargs))
+    with timer.stage('disclaimer'):
+        append_disclaimer(body_path_for(video_path), disclaimer_video_path, video_path, 'main', output_kwargs)
 
-    final_main_video.close()
     main_video.close()
     audio.close()
     if background_clip:
@@ -207,5 +271,4 @@ def create_video(
         clip.close()
     for bg_clip in bg_video_clips:
         bg_clip.close()
-
-    create_youtube_shorts_video(video_path, youtube_shorts_video_path, disclaimer_video_path)
+    return main_duration
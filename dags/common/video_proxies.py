@@ -0,0 +1,132 @@
+import json
+import os
+import threading
+from fractions import Fraction
+
+import ffmpeg
+
+from common.utils.cache import make_key
+from common.utils.consts import CACHE_DIR, DESIRED_HEIGHT, DESIRED_WIDTH, VIDEO_FPS
+
+INPUTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'inputs')
+PROXY_DIR = os.path.join(CACHE_DIR, 'video_proxies')
+INDEX_PATH = os.path.join(PROXY_DIR, 'index.json')
+PROXY_PIX_FMT = 'yuv420p'
+USE_VIDEO_PROXIES = os.getenv('USE_VIDEO_PROXIES', 'true').lower() == 'true'
+
+_lock = threading.RLock()
+_index = None
+
+
+def scale_and_crop(stream):
+    # resize to the target width and center-crop, as resize_video does; a source that ends up too short stays short
+    return (
+        stream
+        .filter('fps', fps=VIDEO_FPS)
+        .filter('scale', DESIRED_WIDTH, -2)
+        .filter('crop', DESIRED_WIDTH, f'min(ih,{DESIRED_HEIGHT})')
+        .filter('setsar', 1)
+    )
+
+
+def fit_to_frame(stream):
+    # concat needs every segment at the output size, so a short source is padded after the crop
+    return scale_and_crop(stream).filter('pad', DESIRED_WIDTH, DESIRED_HEIGHT, '(ow-iw)/2', '(oh-ih)/2')
+
+
+def source_key(source_path, use_proxy):
+    stat = os.stat(source_path)
+    key_parts = [os.path.abspath(source_path), stat.st_size, stat.st_mtime]
+    if use_proxy:
+        key_parts += [DESIRED_WIDTH, DESIRED_HEIGHT, VIDEO_FPS, PROXY_PIX_FMT, 'scale_and_crop']
+    return make_key(*key_parts)
+
+
+def load_index():
+    global _index
+    if _index is None:
+        try:
+            with open(INDEX_PATH) as file:
+                _index = json.load(file)
+        except (FileNotFoundError, ValueError):
+            _index = {}
+    return _index
+
+
+def save_index_entry(key, entry):
+    os.makedirs(PROXY_DIR, exist_ok=True)
+    index = load_index()
+    index[key] = entry
+    # merge with entries other processes may have written meanwhile
+    try:
+        with open(INDEX_PATH) as file:
+            index = {**json.load(file), **index}
+    except (FileNotFoundError, ValueError):
+        pass
+    tmp_path = f"{INDEX_PATH}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as file:
+        json.dump(index, file, indent=2)
+    os.replace(tmp_path, INDEX_PATH)
+
+
+def probe_metadata(path):
+    probe = ffmpeg.probe(path)
+    video_stream = next(stream for stream in probe['streams'] if stream['codec_type'] == 'video')
+    return {
+        "duration": float(probe['format']['duration']),
+        "fps": float(Fraction(video_stream['r_frame_rate'])),
+        "size": [int(video_stream['width']), int(video_stream['height'])],
+    }
+
+
+def transcode_proxy(source_path, proxy_path):
+    print(f"Creating proxy for '{os.path.basename(source_path)}'...")
+    os.makedirs(os.path.dirname(proxy_path), exist_ok=True)
+    tmp_path = f"{os.path.splitext(proxy_path)[0]}.{os.getpid()}.tmp.mp4"
+    (
+        scale_and_crop(ffmpeg.input(source_path).video)
+        .output(tmp_path, vcodec='libx264', preset='veryfast', crf=18, pix_fmt=PROXY_PIX_FMT, g=VIDEO_FPS)
+        .global_args('-loglevel', 'error')
+        .overwrite_output()
+        .run()
+    )
+    os.replace(tmp_path, proxy_path)
+
+
+def get_video_source(video_name, use_proxy=USE_VIDEO_PROXIES):
+    # returns {"path", "duration", "fps", "size"} for an input video, or None when it can't be used
+    source_path = video_name if os.path.isabs(video_name) else os.path.join(INPUTS_DIR, video_name)
+    if not os.path.exists(source_path):
+        print(f"Error loading video '{source_path}': file not found")
+        return None
+    key = source_key(source_path, use_proxy)
+    with _lock:
+        entry = load_index().get(key)
+        if entry and os.path.exists(entry['path']):
+            return entry
+        path = source_path
+        try:
+            if use_proxy:
+                path = os.path.join(PROXY_DIR, f"{key}.mp4")
+                if not os.path.exists(path):
+                    transcode_proxy(source_path, path)
+            entry = {"path": path, **probe_metadata(path)}
+        except Exception as e:
+            if not use_proxy:
+                print(f"Error loading video '{source_path}': {e}")
+                return None
+            print(f"Proxy for '{source_path}' failed, using the source: {e}")
+            return get_video_source(video_name, use_proxy=False)
+        save_index_entry(key, entry)
+        return entry
+
+
+def get_video_duration(video_name):
+    source = get_video_source(video_name)
+    return source['duration'] if source else None
+
+
+def prepare_video_proxies(inputs_dir=INPUTS_DIR):
+    for file_name in sorted(os.listdir(inputs_dir)):
+        if file_name.endswith('.mp4'):
+            get_video_source(os.path.join(inputs_dir, file_name))
@@ -0,0 +1,86 @@
+import io
+import os
+from functools import lru_cache
+
+import numpy as np
+from moviepy.editor import ImageClip
+from PIL import Image, ImageDraw, ImageFont
+
+from common.utils.cache import DiskCache, make_key
+
+WORD_FONT_SIZE = 160
+WORD_STROKE_WIDTH = 6
+WORD_COLOR = 'white'
+WORD_STROKE_COLOR = 'black'
+# TrueType equivalents of ImageMagick's 'Arial-Bold', first match wins
+FONT_CANDIDATES = [
+    os.getenv('WORD_FONT_PATH', ''),
+    '/usr/share/fonts/truetype/liberation/LiberationSans-Bold.ttf',
+    '/usr/share/fonts/truetype/msttcorefonts/Arial_Bold.ttf',
+    '/System/Library/Fonts/Supplemental/Arial Bold.ttf',
+    '/Library/Fonts/Arial Bold.ttf',
+    '/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf',
+]
+MEMORY_CACHE_SIZE = int(os.getenv('WORD_RASTER_MEMORY_CACHE_SIZE', 1024))
+
+raster_cache = DiskCache('word_raster',
+                         max_bytes=int(os.getenv('WORD_RASTER_CACHE_MAX_BYTES', 256 * 1024 * 1024)),
+                         use_s3=False)
+
+
+@lru_cache(maxsize=None)
+def find_font_path():
+    for path in FONT_CANDIDATES:
+        if path and os.path.exists(path):
+            return path
+    return None
+
+
+@lru_cache(maxsize=16)
+def load_font(font_path, font_size):
+    if font_path:
+        return ImageFont.truetype(font_path, font_size)
+    print("No TrueType font found, falling back to PIL's default font.")
+    return ImageFont.load_default()
+
+
+def rasterize_word(word, font_path, font_size, stroke_width, color, stroke_color):
+    font = load_font(font_path, font_size)
+    left, top, right, bottom = ImageDraw.Draw(Image.new('RGBA', (1, 1))).textbbox(
+        (0, 0), word, font=font, stroke_width=stroke_width)
+    image = Image.new('RGBA', (max(1, right - left), max(1, bottom - top)), (0, 0, 0, 0))
+    ImageDraw.Draw(image).text((-left, -top), word, font=font, fill=color,
+                               stroke_width=stroke_width, stroke_fill=stroke_color)
+    pixels = np.asarray(image)
+    rgb = np.ascontiguousarray(pixels[:, :, :3])
+    mask = pixels[:, :, 3].astype(np.float32) / 255.0
+    return rgb, mask
+
+
+def font_fingerprint(font_path):
+    if not font_path:
+        return None
+    stat = os.stat(font_path)
+    return font_path, stat.st_size, stat.st_mtime
+
+
+@lru_cache(maxsize=MEMORY_CACHE_SIZE)
+def get_word_raster(word, font_size=WORD_FONT_SIZE, stroke_width=WORD_STROKE_WIDTH,
+                    color=WORD_COLOR, stroke_color=WORD_STROKE_COLOR):
+    # returns (rgb uint8 HxWx3, mask float32 HxW); shared by every occurrence of the word, do not modify
+    font_path = find_font_path()
+    cache_key = make_key(word, font_fingerprint(font_path), font_size, stroke_width, color, stroke_color)
+    cached = raster_cache.get(cache_key)
+    if cached is not None:
+        with np.load(io.BytesIO(cached)) as stored:
+            return stored['rgb'], stored['mask']
+    rgb, mask = rasterize_word(word, font_path, font_size, stroke_width, color, stroke_color)
+    buffer = io.BytesIO()
+    np.savez_compressed(buffer, rgb=rgb, mask=mask)
+    raster_cache.set(cache_key, buffer.getvalue())
+    return rgb, mask
+
+
+def make_word_clip(word, **raster_kwargs):
+    rgb, mask = get_word_raster(word, **raster_kwargs)
+    return ImageClip(rgb).set_mask(ImageClip(mask, ismask=True))
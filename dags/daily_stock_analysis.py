@@ -1,8 +1,14 @@
+from datetime import timedelta
+
 from airflow import DAG
-from airflow.operators.python import get_current_context, task
+from airflow.decorators import task
+from airflow.operators.python import get_current_context
 import pendulum
 
-from common.execute_daily_stock_analysis import execute_daily_stock_analysis
+from common.execute_daily_stock_analysis import (STAGES, make_run, market_opens_today, stage_content,
+                                                 stage_description, stage_match_videos, stage_render, stage_shorts,
+                                                 stage_tts, stage_upload)
+from common.utils.metrics import metrics, publish_run_report
 
 default_args = {
     'owner': 'admin',
@@ -11,6 +17,7 @@ default_args = {
     'email_on_failure': True,
     'email_on_retry': False,
     'retries': 1,
+    'retry_delay': timedelta(minutes=1),
 }
 
 local_tz = pendulum.timezone("US/Eastern")
@@ -23,28 +30,76 @@ with DAG(
         start_date=pendulum.datetime(2024, 1, 1, tz=local_tz),
         catchup=False,
         max_active_runs=1,
-        concurrency=1,
+        max_active_tasks=3,  # description, TTS and video matching run side by side
         tags=['stock', 'youtube'],
 ) as dag:
-    @task(task_id="daily_stock_analysis")
-    def daily_stock_analysis():
-        try:
-            context = get_current_context()
-            dag_run = context['dag_run']
-            stock_symbol = dag_run.conf.get('stock_symbol', "NVDA")
-            company_name = dag_run.conf.get('company_name', "NVIDIA Corporation")
-            is_mock = dag_run.conf.get('is_mock', False)
-            """ex:
+    # every task hands the next ones a small manifest of artifact keys through XCom, the artifacts themselves are
+    # in S3, so each task retries on its own without redoing the ones before it
+
+    @task(task_id="plan_run")
+    def plan_run():
+        context = get_current_context()
+        dag_run = context['dag_run']
+        stock_symbol = dag_run.conf.get('stock_symbol', "NVDA")
+        company_name = dag_run.conf.get('company_name', "NVIDIA Corporation")
+        is_mock = dag_run.conf.get('is_mock', False)
+        """ex:
 {
     "is_mock": true
 }
-            """
-            print(f"Task 'daily_stock_analysis' starts with:"
-                  f" stock_symbol={stock_symbol}, company_name={company_name}, is_mock={is_mock}")
-            execute_daily_stock_analysis(stock_symbol=stock_symbol, company_name=company_name, is_mock=is_mock)
-        except Exception as e:
-            print(f"Error: {e}")
-            raise e
+        """
+        print(f"Task 'daily_stock_analysis' starts with:"
+              f" stock_symbol={stock_symbol}, company_name={company_name}, is_mock={is_mock}")
+        return make_run(stock_symbol=stock_symbol, company_name=company_name, is_mock=is_mock)
+
+
+    @task.short_circuit(task_id="market_opens_today")
+    def check_market(run):
+        return market_opens_today(run)
+
+
+    @task(task_id="create_content", retries=2)
+    def content_task(run):
+        return stage_content(run)
+
+
+    @task(task_id="create_description", retries=3, retry_exponential_backoff=True)
+    def description_task(run, content):
+        return stage_description(run, content)
+
+
+    @task(task_id="text_to_audio", retries=3, retry_exponential_backoff=True)
+    def tts_task(run, content):
+        return stage_tts(run, content)
+
+
+    @task(task_id="match_videos", retries=2)
+    def matching_task(run, content):
+        return stage_match_videos(run, content)
+
+
+    @task(task_id="render_video", retries=1, execution_timeout=timedelta(hours=1))
+    def render_task(run, tts, matching):
+        return stage_render(run, tts, matching)
+
+
+    @task(task_id="create_shorts", retries=1)
+    def shorts_task(run, tts, render):
+        return stage_shorts(run, tts, render)
+
+
+    @task(task_id="upload_to_youtube", retries=5, retry_delay=timedelta(minutes=2), retry_exponential_backoff=True)
+    def upload_task(run, description, render, shorts):
+        upload = stage_upload(run, description, render, shorts)
+        # the last task puts the stage reports of the whole run together
+        if metrics.enabled:
+            publish_run_report(run, STAGES)
+        return upload
 
 
-    run_this = daily_stock_analysis()
+    run = plan_run()
+    content = content_task(run)
+    check_market(run) >> content
+    tts = tts_task(run, content)
+    render = render_task(run, tts, matching_task(run, content))
+    upload_task(run, description_task(run, content), render, shorts_task(run, tts, render))
@@ -0,0 +1,8 @@
+import os
+import sys
+import tempfile
+
+# the DAG code imports its package as `common`, the way Airflow puts dags/ on the path
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'dags'))
+os.environ.setdefault('CACHE_DIR', tempfile.mkdtemp(prefix='ai_stock_insights_test_cache_'))
+os.environ.setdefault('YOUTUBE_UPLOAD_STATE_S3', 'false')
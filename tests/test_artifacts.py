@@ -0,0 +1,87 @@
+import gzip
+import os
+
+import pytest
+from moto import mock_aws
+
+from common.utils import artifacts
+from common.utils.artifacts import ArtifactStore, file_sha256, run_prefix
+from common.utils.clients import get_boto3_client
+
+BUCKET = 'artifact-test-bucket'
+
+
+@pytest.fixture
+def store(monkeypatch, tmp_path):
+    monkeypatch.setenv('LOCAL', '1')
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    with mock_aws():
+        get_boto3_client('s3').create_bucket(Bucket=BUCKET)
+        yield ArtifactStore(bucket=BUCKET, root=None, endpoint_url=None, cache_dir=str(tmp_path / "cache"),
+                            max_cache_bytes=256 * 1024 * 1024, max_workers=4, compress_text=True)
+
+
+def test_text_round_trip_is_gzipped_above_the_threshold(store):
+    text = "price moved on the news\n" * 1000
+    store.put_text(text, "runs/NVDA/script.txt")
+    store.put_text("short", "runs/NVDA/short.txt")
+    client = store.client()
+    head = client.head_object(Bucket=BUCKET, Key="runs/NVDA/script.txt")
+    assert head['ContentEncoding'] == 'gzip'
+    assert head['ContentLength'] < len(text)
+    raw = client.get_object(Bucket=BUCKET, Key="runs/NVDA/script.txt")['Body'].read()
+    assert gzip.decompress(raw).decode('utf-8') == text
+    assert 'ContentEncoding' not in client.head_object(Bucket=BUCKET, Key="runs/NVDA/short.txt")
+    assert store.get_text("runs/NVDA/script.txt") == text
+    assert store.get_text("runs/NVDA/short.txt") == "short"
+    assert store.get_json(store.put_json({"a": [1, 2]}, "runs/NVDA/data.json")) == {"a": [1, 2]}
+
+
+def test_cached_copy_is_used_until_the_etag_changes(store):
+    store.put_text("first version", "runs/NVDA/description.txt")
+    assert store.get_text("runs/NVDA/description.txt") == "first version"
+    assert (store.hits, store.misses) == (1, 0)
+
+    # rewritten behind the store's back: the HEAD sees a new ETag and the stale copy is replaced
+    store.client().put_object(Bucket=BUCKET, Key="runs/NVDA/description.txt", Body=b"second version")
+    assert store.get_text("runs/NVDA/description.txt") == "second version"
+    assert (store.hits, store.misses) == (1, 1)
+    assert store.get_text("runs/NVDA/description.txt") == "second version"
+    assert (store.hits, store.misses) == (2, 1)
+
+    with pytest.raises(FileNotFoundError):
+        store.get_text("runs/NVDA/missing.txt")
+
+
+def test_large_files_go_up_in_parts(store, monkeypatch, tmp_path):
+    # S3 parts other than the last must be at least 5 MiB
+    monkeypatch.setattr(artifacts, 'MULTIPART_THRESHOLD', 5 * 1024 * 1024)
+    monkeypatch.setattr(artifacts, 'MULTIPART_CHUNK_SIZE', 5 * 1024 * 1024)
+    large = tmp_path / "output_video.mp4"
+    large.write_bytes(os.urandom(11 * 1024 * 1024))
+    small = tmp_path / "output_audio.mp3"
+    small.write_bytes(os.urandom(1024 * 1024))
+    store.put_files([(str(large), "runs/NVDA/output_video.mp4"), (str(small), "runs/NVDA/output_audio.mp3")])
+
+    client = store.client()
+    # a multipart ETag ends in the number of parts
+    assert client.head_object(Bucket=BUCKET, Key="runs/NVDA/output_video.mp4")['ETag'].strip('"').endswith('-3')
+    assert '-' not in client.head_object(Bucket=BUCKET, Key="runs/NVDA/output_audio.mp3")['ETag']
+    assert store.hashes(["runs/NVDA/output_video.mp4"]) == {"runs/NVDA/output_video.mp4": file_sha256(str(large))}
+
+    # with the local cache gone the file comes back from S3 in ranged parts
+    store.max_cache_bytes = 0
+    store.evict()
+    store.max_cache_bytes = 256 * 1024 * 1024
+    downloaded = store.get_file("runs/NVDA/output_video.mp4", str(tmp_path / "download" / "output_video.mp4"))
+    assert file_sha256(downloaded) == file_sha256(str(large))
+    assert store.misses == 1
+    assert store.get_range("runs/NVDA/output_video.mp4", 10, 19) == large.read_bytes()[10:20]
+
+
+def test_mock_and_real_runs_of_the_same_day_do_not_share_a_prefix():
+    real = run_prefix('NVDA', '2026-10-16')
+    mock = run_prefix('NVDA', '2026-10-16', is_mock=True)
+    assert real != mock
+    assert not real.startswith(f"{mock}/") and not mock.startswith(f"{real}/")
@@ -0,0 +1,35 @@
+import sys
+
+from moto import mock_aws
+
+from common.utils.cache import DiskCache
+from common.utils.clients import get_boto3_client
+from common.utils.consts import BUCKET_NAME
+
+
+def test_s3_tier_works_without_the_browser_utils(monkeypatch, tmp_path):
+    # a worker without Chromium can't import common.utils.utils, the S3 tier must not need it
+    monkeypatch.setitem(sys.modules, 'common.utils.utils', None)
+    monkeypatch.setenv('LOCAL', '1')
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    with mock_aws():
+        get_boto3_client('s3').create_bucket(Bucket=BUCKET_NAME)
+        DiskCache('s3_tier', use_s3=True, cache_dir=str(tmp_path / "writer")).set_text('key', 'value')
+        reader = DiskCache('s3_tier', use_s3=True, cache_dir=str(tmp_path / "reader"))
+        assert reader.get_text('key') == 'value'
+        assert reader.s3_hits == 1
+        # a second read is served from the local copy the S3 hit left behind
+        assert reader.get_text('key') == 'value'
+        assert reader.s3_hits == 1
+
+
+def test_s3_failures_fall_back_to_a_miss(monkeypatch, tmp_path):
+    def unavailable(*args, **kwargs):
+        raise RuntimeError("no S3 here")
+
+    monkeypatch.setattr('common.utils.cache.get_boto3_client', unavailable)
+    cache = DiskCache('s3_down', use_s3=True, cache_dir=str(tmp_path))
+    cache.set_text('key', 'value')
+    assert cache.get_text('key') == 'value'
+    assert cache.get_text('missing') is None
@@ -0,0 +1,17 @@
+import os
+
+import pytest
+
+pytest.importorskip('airflow')
+from airflow.models import DagBag  # noqa: E402
+
+DAG_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'dags',
+                        'daily_stock_analysis.py')
+
+
+def test_daily_dag_imports_cleanly():
+    dag_bag = DagBag(dag_folder=DAG_FILE, include_examples=False)
+    assert dag_bag.import_errors == {}
+    dag = dag_bag.get_dag('daily_stock_analysis')
+    assert dag is not None
+    assert 'market_opens_today' in dag.task_ids
@@ -0,0 +1,21 @@
+import datetime
+
+from common.utils.consts import MARKET_TIME_ZONE
+from common.utils.stock_market_time import StockMarketTime
+
+
+def at(*args):
+    return MARKET_TIME_ZONE.localize(datetime.datetime(*args))
+
+
+def test_session_date_is_the_same_for_every_run_before_that_session_closes():
+    # from Friday 2024-07-05 after the close, through the weekend, into Monday's session
+    session = datetime.date(2024, 7, 8)
+    for now in [at(2024, 7, 5, 16, 30), at(2024, 7, 6, 0, 30), at(2024, 7, 7, 23, 59), at(2024, 7, 8, 8, 45),
+                at(2024, 7, 8, 12, 0)]:
+        assert StockMarketTime(now).session_date == session
+
+
+def test_session_date_skips_holidays():
+    # Independence Day 2024 was a Thursday
+    assert StockMarketTime(at(2024, 7, 4, 9, 0)).session_date == datetime.date(2024, 7, 5)
@@ -0,0 +1,185 @@
+import json
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from common import upload_to_youtube
+from common.upload_to_youtube import UPLOAD_CHUNK_GRANULARITY, UploadError, resumable_upload, upload_video_youtube
+from common.utils.cache import DiskCache
+
+BODY = {'snippet': {'title': 'test'}, 'status': {'privacyStatus': 'private'}}
+
+
+class StandInServer:
+    """A local stand-in for YouTube's resumable upload endpoint.
+
+    Each entry of fail_chunks makes the matching chunk PUT commit only half of its bytes and answer 503, the way a
+    connection dropped mid-chunk leaves the server with part of it.
+    """
+
+    def __init__(self, fail_chunks=()):
+        self.received = bytearray()
+        self.total_size = None
+        self.fail_chunks = set(fail_chunks)
+        self.requests = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, status, headers=None, body=b''):
+                self.send_response(status)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers['Content-Length']))
+                server.requests.append(('POST', None))
+                server.total_size = int(self.headers['X-Upload-Content-Length'])
+                self._reply(200, {'Location': f"http://127.0.0.1:{self.server.server_port}/session/1"})
+
+            def do_PUT(self):
+                content_range = self.headers['Content-Range']
+                chunk = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                server.requests.append(('PUT', content_range))
+                status_query = re.fullmatch(r'bytes \*/(\d+)', content_range)
+                if not status_query:
+                    start, end, _ = map(int, re.fullmatch(r'bytes (\d+)-(\d+)/(\d+)', content_range).groups())
+                    assert start == len(server.received), "chunks must continue where the server stopped"
+                    assert len(chunk) == end - start + 1
+                    chunk_index = start // UPLOAD_CHUNK_GRANULARITY
+                    if chunk_index in server.fail_chunks:
+                        server.fail_chunks.discard(chunk_index)
+                        server.received += chunk[:len(chunk) // 2]
+                        return self._reply(503)
+                    server.received += chunk
+                if len(server.received) == server.total_size:
+                    return self._reply(200, {'Content-Type': 'application/json'}, json.dumps({'id': 'abc'}).encode())
+                headers = {'Range': f"bytes=0-{len(server.received) - 1}"} if server.received else {}
+                self._reply(308, headers)
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_port}/upload"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture(autouse=True)
+def upload_state(monkeypatch, tmp_path):
+    # every test starts without sessions or finished uploads from the others
+    state = DiskCache('youtube_uploads', cache_dir=str(tmp_path / "cache"))
+    monkeypatch.setattr(upload_to_youtube, 'upload_state', state)
+    return state
+
+
+@pytest.fixture
+def video(tmp_path):
+    path = tmp_path / "video.mp4"
+    path.write_bytes(bytes(range(256)) * (4 * UPLOAD_CHUNK_GRANULARITY // 256) + b'tail')
+    return path
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    delays = []
+    monkeypatch.setattr(upload_to_youtube.time, 'sleep', delays.append)
+    return delays
+
+
+def upload(server, video, attempts=upload_to_youtube.UPLOAD_RETRY_ATTEMPTS):
+    return resumable_upload(requests.Session(), str(video), BODY, chunk_size=UPLOAD_CHUNK_GRANULARITY,
+                            upload_url=server.url, attempts=attempts)
+
+
+def test_interrupted_chunk_is_resumed_from_the_committed_range(video, sleeps):
+    server = StandInServer(fail_chunks={1})
+    try:
+        assert upload(server, video) == {'id': 'abc'}
+    finally:
+        server.close()
+    assert bytes(server.received) == video.read_bytes()
+    # one back-off, then the offset query that the 308 Range answer resumes from
+    assert len(sleeps) == 1
+    assert ('PUT', f"bytes */{video.stat().st_size}") in server.requests
+    assert [method for method, _ in server.requests].count('POST') == 1
+
+
+def test_retried_task_reuses_the_stored_session(video, sleeps):
+    server = StandInServer(fail_chunks={2})
+    try:
+        # the first task gives up on the failure, the second one picks up the same session
+        with pytest.raises(ConnectionError):
+            upload(server, video, attempts=1)
+        assert upload(server, video) == {'id': 'abc'}
+        # once finished, a rerun doesn't talk to the server at all
+        request_count = len(server.requests)
+        assert upload(server, video) == {'id': 'abc'}
+        assert len(server.requests) == request_count
+    finally:
+        server.close()
+    assert bytes(server.received) == video.read_bytes()
+    assert [method for method, _ in server.requests].count('POST') == 1
+
+
+def test_empty_file_is_rejected(tmp_path):
+    path = tmp_path / "empty.mp4"
+    path.write_bytes(b'')
+    with pytest.raises(UploadError):
+        resumable_upload(requests.Session(), str(path), BODY, upload_url="http://127.0.0.1:9/upload")
+
+
+class SnippetUpdates:
+    """Records the videos.update calls made through it, in place of an authorized session."""
+
+    def __init__(self):
+        self.updates = []
+
+    def put(self, url, params=None, json=None, timeout=None):
+        self.updates.append((params, json))
+        response = requests.Response()
+        response.status_code = 200
+        response._content = b'{}'
+        return response
+
+
+def test_short_uploads_alongside_the_full_video_and_is_linked_afterwards(monkeypatch, tmp_path):
+    shorts_started = threading.Event()
+    uploaded = []
+
+    def stand_in_upload(session, file_path, body, **kwargs):
+        if file_path.endswith("short.mp4"):
+            shorts_started.set()
+            assert 'watch?v=' not in body['snippet']['description']
+            uploaded.append('short')
+            return {'id': 'short-id'}
+        # the full video only finishes once the Short is on its way, which a sequential upload never gets to
+        assert shorts_started.wait(timeout=5)
+        uploaded.append('full')
+        return {'id': 'full-id'}
+
+    monkeypatch.setattr(upload_to_youtube, 'resumable_upload', stand_in_upload)
+    for name in ("full.mp4", "short.mp4"):
+        (tmp_path / name).write_bytes(b'video')
+    session = SnippetUpdates()
+    full_link, shorts_link = upload_video_youtube(str(tmp_path / "full.mp4"), 'Title', 'Description',
+                                                  youtube_shorts_video_path=str(tmp_path / "short.mp4"),
+                                                  keywords='finance', session=session)
+    assert full_link == "https://www.youtube.com/watch?v=full-id"
+    assert shorts_link == "https://www.youtube.com/watch?v=short-id"
+    assert sorted(uploaded) == ['full', 'short']
+    [(params, update)] = session.updates
+    assert params == {'part': 'snippet'}
+    assert update['id'] == 'short-id'
+    assert full_link in update['snippet']['description']
+    assert update['snippet']['title'] == 'Title #shorts'
+    assert update['snippet']['categoryId'] == '22'